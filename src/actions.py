@@ -0,0 +1,159 @@
+#! /usr/bin/env python3
+"""
+A module to delete, rename, or replace with a hard link a query file that has already been verified as a duplicate.
+"""
+import os.path
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def rename_file(query_p,
+                trial,
+                quiet_trial,
+                prefix="compareFoldersPendingDelete"):
+    """
+    Rename a query file.
+
+    :param query_p: The full path to the file being renamed.
+    :param trial: Whether to do a trial run instead of actually renaming.
+    :param prefix: The prefix to prepend to the name. Defaults to "compareFoldersPendingDelete"
+    :param quiet_trial: Whether to suppress any progress information during a trial run.
+
+    :return: Nothing.
+    """
+
+    i = 0
+    path = f"{os.path.split(query_p)[0]}{os.path.sep}"
+    name = f"{os.path.split(query_p)[1]}"
+    file_n = f"{path}{prefix}_{name}"
+    while os.path.exists(file_n):
+        i += 1
+        file_n = f"{path}{prefix}{i}_{name}"
+    if not trial:
+        try:
+            os.rename(query_p, file_n)
+        except FileNotFoundError:
+            raise ValueError(f"File not found: {query_p}")
+        except PermissionError:
+            raise ValueError(f"Permission error trying to rename: {query_p}")
+    else:
+        if not quiet_trial:
+            query_p = query_p.replace(" ", "\ ")
+            file_n = file_n.replace(" ", "\ ")
+            print(f"mv {query_p} {file_n}")
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def delete_file(query_p,
+                trial,
+                quiet_trial):
+    """
+    Rename a query file.
+
+    :param query_p: The full path to the file being renamed.
+    :param trial: Whether to do a trial run instead of actually renaming.
+    :param quiet_trial: Whether to suppress any progress information during a trial run.
+
+    :return: Nothing.
+    """
+
+    if not trial:
+        try:
+            os.remove(query_p)
+        except FileNotFoundError:
+            raise ValueError(f"File not found: {query_p}")
+        except PermissionError:
+            raise ValueError(f"Permission error trying to delete: {query_p}")
+    else:
+        if not quiet_trial:
+            query_p = query_p.replace(" ", "\ ")
+            print(f"rm {query_p}")
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def hardlink_file(query_p,
+                  canonical_p,
+                  trial,
+                  quiet_trial,
+                  prefix="compareFoldersPendingLink"):
+    """
+    Replace a query file with a hard link to its canonical file. The link is first created under a temporary name next
+    to the query file and then renamed over it, so the query path always exists, either as the original file or as the
+    link.
+
+    :param query_p: The full path to the file being replaced.
+    :param canonical_p: The full path to the canonical file to link to.
+    :param trial: Whether to do a trial run instead of actually replacing the file.
+    :param quiet_trial: Whether to suppress any progress information during a trial run.
+    :param prefix: The prefix of the temporary name of the link. Defaults to "compareFoldersPendingLink"
+
+    :return: Nothing.
+    """
+
+    try:
+        query_stat = os.stat(query_p)
+        canonical_stat = os.stat(canonical_p)
+    except FileNotFoundError as e:
+        raise ValueError(f"File not found: {e.filename}")
+
+    if (query_stat.st_dev, query_stat.st_ino) == (canonical_stat.st_dev, canonical_stat.st_ino):
+        return
+
+    if query_stat.st_dev != canonical_stat.st_dev:
+        raise ValueError(f"Cannot hard link across devices: {query_p}")
+
+    if trial:
+        if not quiet_trial:
+            query_p = query_p.replace(" ", "\ ")
+            canonical_p = canonical_p.replace(" ", "\ ")
+            print(f"ln -f {canonical_p} {query_p}")
+        return
+
+    i = 0
+    path = f"{os.path.split(query_p)[0]}{os.path.sep}"
+    name = f"{os.path.split(query_p)[1]}"
+    link_n = f"{path}{prefix}_{name}"
+    while os.path.lexists(link_n):
+        i += 1
+        link_n = f"{path}{prefix}{i}_{name}"
+
+    try:
+        os.link(canonical_p, link_n)
+    except PermissionError:
+        raise ValueError(f"Permission error trying to hard link: {query_p}")
+
+    try:
+        os.replace(link_n, query_p)
+    except OSError as e:
+        os.remove(link_n)
+        if isinstance(e, PermissionError):
+            raise ValueError(f"Permission error trying to replace: {query_p}")
+        raise
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def delete_or_rename_file(query_p,
+                          do_rename,
+                          trial,
+                          quiet_trial,
+                          do_hardlink=False,
+                          canonical_p=None):
+    """
+    Deletes, renames, or replaces with a hard link a specific file. The file must already have been verified as a
+    duplicate.
+
+    :param query_p: The path to the query file.
+    :param do_rename: Whether to rename the files instead of deleting them.
+    :param trial: Do not actually run the rename or delete operation.
+    :param quiet_trial: If running a trial, do not print out debug info.
+    :param do_hardlink: Whether to replace the file with a hard link to the canonical file instead of deleting it.
+    :param canonical_p: The path to the canonical file. Required if do_hardlink is True.
+
+    :return: Nothing.
+    """
+
+    if do_hardlink:
+        hardlink_file(query_p, canonical_p, trial, quiet_trial)
+    elif do_rename:
+        rename_file(query_p, trial, quiet_trial)
+    else:
+        delete_file(query_p, trial, quiet_trial)
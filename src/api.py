@@ -0,0 +1,487 @@
+#! /usr/bin/env python3
+"""
+A module to run compares and apply deletions from other Python code, without any prompts or screen output.
+
+compare() runs the scans and the compare of a Session and yields a typed record for each result as soon as the session
+produces it, so a pipeline can act on the duplicates while the compare is still running, and the session never holds
+the results in memory. records_from_log() yields the same records from a result log written earlier by compareFolders.
+apply_deletions() takes any iterable of these records, verifies each duplicate in the same way as deleteFiles, and
+deletes, renames, or hard links the query file, yielding the outcome for each one.
+
+For example:
+
+    session_obj = Session(query_items=["/path/to/query"], canonical_dir="/path/to/canonical")
+    for outcome in api.apply_deletions(api.compare(session_obj, name=True), options="n", trial=True):
+        print(outcome)
+"""
+import collections
+
+from src import actions
+from src import checksum
+from src import metrics
+from src import resultlog
+from src.verifier import Verifier
+
+ACTIONS = ["delete", "rename", "hardlink"]
+
+# The outcome recorded for a duplicate once its action has been taken (the same words are used in deletion journals).
+ACTION_OUTCOMES = {"delete": "deleted", "rename": "renamed", "hardlink": "linked"}
+
+
+class Record(object):
+    """
+    The base class of the records yielded by this module. Records are compared and printed by the values of their slots.
+    """
+
+    __slots__ = ()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _values(self) -> tuple:
+        """
+        :return: A tuple of the values of the record's slots, in order.
+        """
+
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __eq__(self,
+               other) -> bool:
+        return type(self) is type(other) and self._values() == other._values()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __hash__(self) -> int:
+        return hash((type(self).__name__,) + self._values())
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{slot}={getattr(self, slot)!r}" for slot in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class Duplicate(Record):
+    """
+    A query file that is identical to one or more canonical files (or, in a self compare, to the file that is kept).
+    """
+
+    __slots__ = ("query_p", "matches")
+    status = "D"
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self,
+                 query_p,
+                 matches):
+        """
+        :param query_p: The path to the query file.
+        :param matches: The paths of the canonical files it matches.
+
+        :return: Nothing.
+        """
+
+        self.query_p = query_p
+        self.matches = tuple(matches)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def log_record(self) -> tuple:
+        """
+        :return: The record as it is written to (and read from) a result log.
+        """
+
+        return (self.status, self.query_p) + self.matches
+
+
+class Unique(Record):
+    """
+    A query file that has no duplicates.
+    """
+
+    __slots__ = ("query_p",)
+    status = "U"
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self,
+                 query_p):
+        """
+        :param query_p: The path to the query file.
+
+        :return: Nothing.
+        """
+
+        self.query_p = query_p
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def log_record(self) -> tuple:
+        """
+        :return: The record as it is written to (and read from) a result log.
+        """
+
+        return self.status, self.query_p
+
+
+class SourceError(Record):
+    """
+    A query file that could not be read, so it is not known whether it has duplicates.
+    """
+
+    __slots__ = ("query_p",)
+    status = "SE"
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self,
+                 query_p):
+        """
+        :param query_p: The path to the query file.
+
+        :return: Nothing.
+        """
+
+        self.query_p = query_p
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def log_record(self) -> tuple:
+        """
+        :return: The record as it is written to (and read from) a result log.
+        """
+
+        return self.status, self.query_p
+
+
+class PossibleMatchError(Record):
+    """
+    A canonical file that could not be read while a query file was being compared to it, so the query file may be
+    missing a match.
+    """
+
+    __slots__ = ("canonical_p", "query_p")
+    status = "PME"
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self,
+                 canonical_p,
+                 query_p=None):
+        """
+        :param canonical_p: The path to the canonical file.
+        :param query_p: The path to the query file it was being compared to, if known.
+
+        :return: Nothing.
+        """
+
+        self.canonical_p = canonical_p
+        self.query_p = query_p
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def log_record(self) -> tuple:
+        """
+        :return: The record as it is written to (and read from) a result log.
+        """
+
+        return self.status, self.canonical_p
+
+
+class ActionResult(Record):
+    """
+    The outcome of applying an action to a single duplicate.
+    """
+
+    __slots__ = ("query_p", "canonical_p", "outcome", "error")
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self,
+                 query_p,
+                 canonical_p,
+                 outcome,
+                 error=None):
+        """
+        :param query_p: The path to the query file.
+        :param canonical_p: The path to the canonical file it was verified against, or None if it had none.
+        :param outcome: One of "deleted", "renamed", or "linked" if the action was taken (or, in a trial, would have
+               been), "missing" if the query file is no longer a duplicate of the canonical file (or one of them is
+               gone), or "error".
+        :param error: A description of the error if the outcome is "error", otherwise None.
+
+        :return: Nothing.
+        """
+
+        self.query_p = query_p
+        self.canonical_p = canonical_p
+        self.outcome = outcome
+        self.error = error
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def records_from_result(result) -> list:
+    """
+    :param result: A result dictionary as produced by Session (with "status", "query_p", "matches", and
+           "possible_match_errors" keys).
+
+    :return: A list of the records for the result: a Duplicate, Unique, or SourceError for the query file, followed by a
+             PossibleMatchError for each canonical file that could not be read.
+    """
+
+    query_p = result["query_p"]
+    if result["status"] == "D":
+        records = [Duplicate(query_p, result["matches"])]
+    elif result["status"] == "U":
+        records = [Unique(query_p)]
+    else:
+        records = [SourceError(query_p)]
+
+    for canonical_p in result["possible_match_errors"]:
+        records.append(PossibleMatchError(canonical_p, query_p))
+    return records
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def compare(session_obj,
+            name=False,
+            file_type=False,
+            parent=False,
+            rel_path=False,
+            ctime=False,
+            mtime=False,
+            skip_checksum=False,
+            self_compare=False,
+            keeper_rule="first",
+            scan=True,
+            concurrent_scan=False):
+    """
+    Runs a compare (or a self compare) on a session and yields the records of its results as they are produced. The
+    results are not retained by the session, but its counts (duplicate_count, unique_count, etc.) are kept up to date.
+    Scan errors do not stop the compare; they can be read from session_obj.query_scan and session_obj.canonical_scan.
+
+    :param session_obj: The Session object.
+    :param name: If True, file names must match.
+    :param file_type: If True, file extensions must match.
+    :param parent: If True, the names of the parent directories must match.
+    :param rel_path: If True, the paths relative to the scan roots must match.
+    :param ctime: If True, the creation times must match.
+    :param mtime: If True, the modification times must match.
+    :param skip_checksum: If True, files that pass the metadata checks are considered duplicates without being
+           checksummed.
+    :param self_compare: If True, find the duplicates among the query files themselves instead of comparing them to the
+           canonical files. Defaults to False.
+    :param keeper_rule: With self_compare, how the file to keep is picked from each cluster, one of
+           session.KEEPER_RULES. Defaults to "first".
+    :param scan: If True, run the scans first. Set to False if the session has already been scanned. Defaults to True.
+    :param concurrent_scan: If True, scan the query items and the canonical directory at the same time. Defaults to
+           False.
+
+    :return: A generator that yields a Duplicate, Unique, or SourceError for each query file, each followed by a
+             PossibleMatchError for any of its candidates that could not be read. Raises an OSError if a scan fails
+             outright (for example, if it cannot spill to disk), and a ValueError if the keeper rule is unknown.
+    """
+
+    if scan:
+        if self_compare:
+            collections.deque(session_obj.do_query_scan(), maxlen=0)
+        elif concurrent_scan:
+            collections.deque(session_obj.do_concurrent_scan(), maxlen=0)
+        else:
+            collections.deque(session_obj.do_query_scan(), maxlen=0)
+            collections.deque(session_obj.do_canonical_scan(), maxlen=0)
+
+    pending = collections.deque()
+
+    def result_handler(result):
+        pending.extend(records_from_result(result))
+
+    compare_kwargs = {"name": name,
+                      "file_type": file_type,
+                      "parent": parent,
+                      "rel_path": rel_path,
+                      "ctime": ctime,
+                      "mtime": mtime,
+                      "skip_checksum": skip_checksum,
+                      "result_handler": result_handler,
+                      "retain_results": False}
+    if self_compare:
+        counts = session_obj.do_self_compare(keeper_rule=keeper_rule, **compare_kwargs)
+    else:
+        counts = session_obj.do_compare(**compare_kwargs)
+
+    try:
+        for _ in counts:
+            while pending:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+    finally:
+        counts.close()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def records_from_log(log_p,
+                     record_types=None):
+    """
+    Reads the records of a result log (in either format) one at a time.
+
+    :param log_p: The path to the log file.
+    :param record_types: An optional set of record types ("D", "U", "SE", "PME") to return. If None, all records are
+           returned. A PossibleMatchError only knows its query file if the record of that query file is returned too.
+
+    :return: A generator that yields a Duplicate, Unique, SourceError, or PossibleMatchError for each record.
+    """
+
+    query_types = {"D", "U", "SE"}
+    if record_types is not None and "PME" in record_types:
+        read_types = set(record_types) | query_types
+    else:
+        read_types = record_types
+
+    query_p = None
+    for record in resultlog.iter_records(log_p, read_types):
+        if record[0] == "PME":
+            output = PossibleMatchError(record[1], query_p)
+        else:
+            query_p = record[1]
+            if record[0] == "D":
+                output = Duplicate(query_p, record[2:])
+            elif record[0] == "U":
+                output = Unique(query_p)
+            else:
+                output = SourceError(query_p)
+
+        if record_types is None or record[0] in record_types:
+            yield output
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def verifier_options(options) -> dict:
+    """
+    :param options: A string of the comparison options (any of "nptrcm") the compare was run with, as recorded in the
+           header of a result log.
+
+    :return: The options as the dictionary used by Verifier. Raises a ValueError if an option is unknown.
+    """
+
+    for char in options:
+        if char not in "ntprcm":
+            raise ValueError(f"Illegal comparison option: {char}")
+
+    return {"match_on_name": "n" in options,
+            "match_on_parent": "p" in options,
+            "match_on_type": "t" in options,
+            "match_on_relpath": "r" in options,
+            "match_on_ctime": "c" in options,
+            "match_on_mtime": "m" in options}
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def apply_deletions(records,
+                    options="",
+                    action="delete",
+                    skip_checksum=False,
+                    trial=False,
+                    checksum_cache=None,
+                    jobs=1,
+                    hash_algorithm=checksum.DEFAULT_ALGORITHM,
+                    byte_compare=True):
+    """
+    Verifies each duplicate and then deletes, renames, or replaces with a hard link its query file, in the same way as
+    deleteFiles but without prompts, screen output, or a journal. Records other than duplicates are skipped. Records
+    are consumed lazily (and verified on a pool of worker threads if jobs is greater than 1), so they may come straight
+    from compare() or records_from_log().
+
+    :param records: An iterable of records. Only the Duplicate records are acted on, each verified against its first
+           match.
+    :param options: A string of the comparison options (any of "nptrcm") the compare was run with. The query and
+           canonical files must still agree on each of them. Defaults to "" (contents only).
+    :param action: One of ACTIONS: "delete", "rename" (adds the "compareFoldersPendingDelete" prefix), or "hardlink".
+           Defaults to "delete".
+    :param skip_checksum: If True, the contents of the files are not compared before the action is taken. Defaults to
+           False.
+    :param trial: If True, verify the duplicates but do not touch any files. Defaults to False.
+    :param checksum_cache: An optional ChecksumCache object to read checksums from (and write them to).
+    :param jobs: The number of worker threads used to verify duplicates. Defaults to 1.
+    :param hash_algorithm: The name of the hash algorithm used to verify duplicates. Defaults to
+           checksum.DEFAULT_ALGORITHM.
+    :param byte_compare: If True, duplicates whose canonical file's checksum is not known yet are verified byte by byte
+           rather than by checksum. Defaults to True.
+
+    :return: A generator that yields an ActionResult for each duplicate, in order. Raises a ValueError if the action or
+             an option is unknown.
+    """
+
+    if action not in ACTIONS:
+        raise ValueError(f"Unknown action: {action}. Must be one of: {', '.join(ACTIONS)}")
+
+    verifier = Verifier(options=verifier_options(options),
+                        skip_checksum=skip_checksum,
+                        checksum_cache=checksum_cache,
+                        hash_algorithm=hash_algorithm,
+                        byte_compare=byte_compare)
+
+    duplicates = (record.log_record() for record in records if isinstance(record, Duplicate))
+    yield from act_on_duplicates(verifier, duplicates, action=action, trial=trial, jobs=jobs)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def act_on_duplicates(verifier,
+                      duplicates,
+                      action="delete",
+                      trial=False,
+                      jobs=1,
+                      quiet_trial=True):
+    """
+    Verifies each duplicate record and then deletes, renames, or replaces with a hard link its query file. This is the
+    engine behind both apply_deletions and deleteFiles. The duplicates are verified on a pool of worker threads if jobs
+    is greater than 1, but the actions themselves are taken on the calling thread, one at a time and in order.
+
+    Each canonical file is checked again just before its query file is acted on, so a verdict reached ahead of time
+    is never acted on once the canonical file has changed or gone (for example, because it was the query file of an
+    earlier record), and a query file already acted on by an earlier record of the same pair is reported as missing.
+    Nothing is touched in a trial, so the query files that would have been are remembered instead, and a later record
+    of one of them (as its query or its canonical file) is reported as it would be in a real run.
+
+    :param verifier: The Verifier object used to verify the duplicates.
+    :param duplicates: An iterable of duplicate log records (tuples of "D", the query file, and the canonical files),
+           each verified against its first canonical file. It is consumed one record at a time.
+    :param action: One of ACTIONS. Defaults to "delete".
+    :param trial: If True, verify the duplicates but do not touch any files. Defaults to False.
+    :param jobs: The number of worker threads used to verify duplicates. Defaults to 1.
+    :param quiet_trial: If False, a trial prints the action it would have taken. Defaults to True.
+
+    :return: A generator that yields an ActionResult for each record, in order.
+    """
+
+    verified_duplicates = verifier.verify_records(duplicates, jobs)
+
+    trial_acted_on = set()
+
+    try:
+        for log_record, verified, error in verified_duplicates:
+            query_p = log_record[1] if len(log_record) > 1 else None
+            canonical_p = log_record[2] if len(log_record) > 2 else None
+
+            if error is not None:
+                yield ActionResult(query_p, canonical_p, "error", error)
+                continue
+
+            if not verified:
+                yield ActionResult(query_p, canonical_p, "missing")
+                continue
+
+            try:
+                confirmed = verifier.confirm(query_p, canonical_p) and query_p not in trial_acted_on
+                if confirmed:
+                    if canonical_p in trial_acted_on:
+                        raise ValueError("Canonical file is missing")
+                    with metrics.registry.phase("action"):
+                        actions.delete_or_rename_file(query_p=query_p,
+                                                      do_rename=action == "rename",
+                                                      trial=trial,
+                                                      quiet_trial=quiet_trial,
+                                                      do_hardlink=action == "hardlink",
+                                                      canonical_p=canonical_p)
+            except (ValueError, OSError) as e:
+                yield ActionResult(query_p, canonical_p, "error", str(e))
+                continue
+
+            if not confirmed:
+                yield ActionResult(query_p, canonical_p, "missing")
+                continue
+
+            if trial:
+                trial_acted_on.add(query_p)
+            yield ActionResult(query_p, canonical_p, ACTION_OUTCOMES[action])
+    finally:
+        verified_duplicates.close()
@@ -0,0 +1,113 @@
+#! /usr/bin/env python3
+"""
+A module to compare a file to a few candidate files byte by byte, without hashing the candidates.
+
+When a file has only one or two candidates left, checksumming all of them reads every file to the end even if they
+differ in the first block. Reading the files side by side instead lets each candidate be dropped at its first chunk
+that differs, and stops as soon as none are left. The query file is hashed as it is read, so when the candidates do
+match to the end, the full checksum of every one of them (they are identical) is known for free.
+"""
+import threading
+
+from src import checksum
+from src.metrics import registry
+
+DEFAULT_CHUNK_SIZE = 256 * 1024
+
+# The largest number of candidates a file is compared to byte by byte. Above this, checksums are used instead: each
+# candidate's checksum is read once and then reused for every other file that has it as a candidate.
+DEFAULT_MAX_CANDIDATES = 2
+
+# Each thread reads into its own pair of buffers, which are allocated once and reused for every comparison it makes.
+_buffers = threading.local()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _buffers_for(chunk_size) -> tuple:
+    """
+    Returns this thread's two read buffers, allocating them the first time (or if larger ones are needed).
+
+    :param chunk_size: The size of each buffer in bytes.
+
+    :return: A tuple of two memoryviews of chunk_size bytes.
+    """
+
+    buffers = getattr(_buffers, "buffers", None)
+    if buffers is None or len(buffers[0]) < chunk_size:
+        buffers = (memoryview(bytearray(chunk_size)), memoryview(bytearray(chunk_size)))
+        _buffers.buffers = buffers
+    return buffers[0][:chunk_size], buffers[1][:chunk_size]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def compare_files(query_p,
+                  candidate_paths,
+                  algorithm=checksum.DEFAULT_ALGORITHM,
+                  chunk_size=DEFAULT_CHUNK_SIZE) -> tuple:
+    """
+    Reads a query file and its candidates side by side, one chunk at a time, dropping each candidate at the first
+    chunk that differs from the query file (or that cannot be read).
+
+    :param query_p: The path to the query file.
+    :param candidate_paths: A list of the paths of the candidate files.
+    :param algorithm: The name of the hash algorithm used for the checksum of the query file. Defaults to
+           checksum.DEFAULT_ALGORITHM.
+    :param chunk_size: The number of bytes read from each file at a time. Defaults to DEFAULT_CHUNK_SIZE.
+
+    :return: A tuple of (the list of paths of the candidates identical to the query file, the list of paths of the
+             candidates that could not be read, the full checksum of the query file or None if no candidate was
+             identical and the query file was not read to the end). Raises an OSError if the query file cannot be read.
+    """
+
+    query_buffer, candidate_buffer = _buffers_for(chunk_size)
+    hash_obj = checksum.new_hash(algorithm)
+    errors = list()
+    candidates = list()
+    num_bytes = 0
+
+    try:
+        for candidate_p in candidate_paths:
+            try:
+                candidates.append((candidate_p, open(candidate_p, "rb", buffering=0)))
+            except OSError:
+                errors.append(candidate_p)
+
+        with open(query_p, "rb", buffering=0) as query_f:
+            while candidates:
+                num_read = checksum.read_fully(query_f, query_buffer)
+                num_bytes += num_read
+                chunk = query_buffer[:num_read]
+
+                remaining = list()
+                for candidate_p, candidate_f in candidates:
+                    try:
+                        if num_read:
+                            candidate_read = checksum.read_fully(candidate_f, candidate_buffer[:num_read])
+                            num_bytes += candidate_read
+                            same = candidate_read == num_read and candidate_buffer[:num_read] == chunk
+                        else:
+                            same = not candidate_f.read(1)
+                    except OSError:
+                        errors.append(candidate_p)
+                        same = False
+                    if same:
+                        remaining.append((candidate_p, candidate_f))
+                    else:
+                        candidate_f.close()
+                candidates = remaining
+
+                if not num_read:
+                    break
+                hash_obj.update(chunk)
+    finally:
+        for candidate_p, candidate_f in candidates:
+            candidate_f.close()
+
+    if registry.enabled:
+        registry.update({"byte_compare_groups": 1,
+                         "byte_compare_bytes": num_bytes,
+                         "byte_compare_early_exits": not candidates})
+
+    if not candidates:
+        return list(), errors, None
+    return [candidate_p for candidate_p, candidate_f in candidates], errors, hash_obj.hexdigest()
@@ -0,0 +1,215 @@
+#! /usr/bin/env python3
+"""
+A module to save and load an index of a canonical directory scan, so that later scans only need to re-enumerate the
+directories that have changed.
+"""
+import json
+import os
+import sqlite3
+import time
+
+from src.filetable import FileStat, FileTable
+
+INDEX_VERSION = 3
+
+# A directory modified this close to (or after) the start of the scan that recorded it may have been modified again
+# within the resolution of its timestamp, so its entry is never reused.
+RACY_WINDOW_NS = 2 * 1000 * 1000 * 1000
+
+
+class DirRecord(object):
+    """
+    A class to hold what a scan found in a single directory.
+    """
+
+    __slots__ = ("mtime_ns", "sub_dirs", "files", "tallies")
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self,
+                 mtime_ns,
+                 sub_dirs,
+                 files,
+                 tallies):
+        """
+        :param mtime_ns: The modification time of the directory in nanoseconds at the time it was enumerated.
+        :param sub_dirs: A list of the paths of the sub-directories that passed the filters.
+        :param files: A list of the ids (in the FileTable that holds them) of the files that passed the filters.
+        :param tallies: A dictionary of the skip counters incurred while enumerating the directory.
+
+        :return: Nothing.
+        """
+
+        self.mtime_ns = mtime_ns
+        self.sub_dirs = sub_dirs
+        self.files = files
+        self.tallies = tallies
+
+
+class CanonicalIndex(object):
+    """
+    A class to save and load a canonical scan (paths, sizes, modification times, inodes, and checksums) in an SQLite
+    database.
+
+    Every directory is stored with its modification time. When the index is loaded for a later scan, directories whose
+    modification time has not changed are not re-enumerated: their files (and skip counters) are taken from the index,
+    without being stat'ed. Note that modifying a file in place does not change the modification time of its directory,
+    so its new size is only picked up once the directory itself changes (or the index is deleted). Its stored checksum
+    is never used once it has changed, though: a session stats each such file the first time it is compared (see
+    Session._check_index_stat).
+
+    An index may also be used as a shard of the canonical files: each shard is built independently (for example, one
+    per file system or per host, at the same time), and a compare merges any number of shards into a single set of
+    canonical files (see FileTable.merged).
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self,
+                 index_path):
+        """
+        :param index_path: The path to the index file. It does not have to exist.
+
+        :return: Nothing.
+        """
+
+        self.index_path = index_path
+
+        self.dirs = dict()
+        self.files = FileTable()
+        self.checksum_algorithm = None
+        self.settings = None
+        self.roots = list()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def load(self,
+             settings,
+             checksum_algorithm="md5") -> bool:
+        """
+        Loads the index from disk. The index is only loaded if it was saved by a scan that used the same settings.
+
+        :param settings: A dictionary of the scan settings (skip flags and regexes) of the scan that will use the index.
+               If None, the index is loaded whatever settings it was saved with (for example, to use it as a shard of
+               the canonical files rather than to speed up a scan).
+        :param checksum_algorithm: The name of the hash algorithm the checksums will be compared with. The checksums
+               stored in the index are dropped if they were computed with a different algorithm. Defaults to "md5".
+
+        :return: True if the index was loaded, False if it does not exist, cannot be read, or was built with
+                 different settings.
+        """
+
+        if not os.path.exists(self.index_path):
+            return False
+
+        try:
+            connection = sqlite3.connect(self.index_path)
+            try:
+                meta = dict(connection.execute("SELECT key, value FROM meta").fetchall())
+                if int(meta.get("version", 0)) != INDEX_VERSION:
+                    return False
+                if settings is not None and json.loads(meta["settings"]) != settings:
+                    return False
+
+                scan_started_ns = int(meta["scan_started_ns"])
+                same_algorithm = meta.get("checksum_algorithm") == checksum_algorithm
+
+                files = FileTable()
+                dir_files = dict()
+                for (dir_d, name, device, inode, size, mtime_ns, ctime_ns, birthtime_ns,
+                     checksum_str) in connection.execute("SELECT dir, name, device, inode, size, mtime_ns, ctime_ns, "
+                                                         "birthtime_ns, checksum FROM files"):
+                    if not same_algorithm or mtime_ns >= scan_started_ns - RACY_WINDOW_NS:
+                        checksum_str = None
+                    file_stat = FileStat(device, inode, size, mtime_ns, ctime_ns, birthtime_ns)
+                    file_id = files.add(dir_d, name, file_stat, checksum_str)
+                    dir_files.setdefault(dir_d, list()).append(file_id)
+
+                dirs = dict()
+                for path, mtime_ns, sub_dirs, tallies in connection.execute("SELECT path, mtime_ns, sub_dirs, tallies "
+                                                                            "FROM dirs"):
+                    if mtime_ns >= scan_started_ns - RACY_WINDOW_NS:
+                        continue
+                    dirs[path] = DirRecord(mtime_ns, json.loads(sub_dirs), dir_files.get(path, list()),
+                                           json.loads(tallies))
+            finally:
+                connection.close()
+        except (sqlite3.Error, KeyError, ValueError):
+            return False
+
+        self.dirs = dirs
+        self.files = files
+        self.checksum_algorithm = meta.get("checksum_algorithm")
+        self.settings = json.loads(meta["settings"])
+        self.roots = json.loads(meta.get("roots", "[]"))
+
+        return True
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def save(self,
+             scan_obj,
+             settings,
+             scan_started_ns,
+             checksums,
+             checksum_algorithm="md5"):
+        """
+        Saves a scan to disk, replacing any existing index. The index is written to a temporary file first and then
+        moved into place, so an interrupted save never leaves a damaged index behind.
+
+        :param scan_obj: The Scanner object that holds the results of the scan. It must have been run with record_dirs
+               enabled.
+        :param settings: A dictionary of the scan settings (skip flags and regexes).
+        :param scan_started_ns: The time (from time.time_ns()) at which the scan started.
+        :param checksums: A dictionary of full checksums keyed on file path. Checksums for files that are not part of
+               the scan are ignored. Files without an entry keep any checksum the scan carried over from the previous
+               index.
+        :param checksum_algorithm: The name of the algorithm used for the checksums. Defaults to "md5".
+
+        :return: Nothing.
+        """
+
+        temp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+        connection = sqlite3.connect(temp_path)
+        try:
+            connection.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+            connection.execute("CREATE TABLE dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER, sub_dirs TEXT, "
+                               "tallies TEXT)")
+            connection.execute("CREATE TABLE files (dir TEXT, name TEXT, device INTEGER, inode INTEGER, "
+                               "size INTEGER, mtime_ns INTEGER, ctime_ns INTEGER, birthtime_ns INTEGER, "
+                               "checksum TEXT, "
+                               "PRIMARY KEY (dir, name))")
+
+            connection.executemany("INSERT INTO meta VALUES (?, ?)",
+                                   (("version", str(INDEX_VERSION)),
+                                    ("settings", json.dumps(settings)),
+                                    ("scan_started_ns", str(scan_started_ns)),
+                                    ("saved", str(int(time.time()))),
+                                    ("roots", json.dumps(scan_obj.items)),
+                                    ("checksum_algorithm", checksum_algorithm)))
+
+            connection.executemany("INSERT INTO dirs VALUES (?, ?, ?, ?)",
+                                   ((path, record.mtime_ns, json.dumps(record.sub_dirs), json.dumps(record.tallies))
+                                    for path, record in scan_obj.dir_records.items()))
+
+            files = scan_obj.files
+            rows = list()
+            for dir_d, record in scan_obj.dir_records.items():
+                for file_id in record.files:
+                    checksum_str = checksums.get(files.path(file_id))
+                    if checksum_str is None:
+                        checksum_str = files.checksums.get(file_id)
+                    rows.append((dir_d,
+                                 files.names[file_id],
+                                 files.devices[file_id],
+                                 files.inodes[file_id],
+                                 files.sizes[file_id],
+                                 files.mtimes[file_id],
+                                 files.ctimes[file_id],
+                                 files.birthtimes[file_id],
+                                 checksum_str))
+            connection.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            connection.commit()
+        finally:
+            connection.close()
+
+        os.replace(temp_path, self.index_path)
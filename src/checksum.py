@@ -0,0 +1,192 @@
+#! /usr/bin/env python3
+"""
+A module to compute checksums of files on disk.
+"""
+import hashlib
+import threading
+import time
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+from src.metrics import registry
+
+BLOCK_SIZE = 1024 * 1024
+
+DEFAULT_ALGORITHM = "md5"
+
+# The algorithms that are always available, from hashlib. Most of the time spent on a checksum of a cached file is
+# hashing, so the faster algorithms (blake2b on 64 bit machines, and xxhash when it is installed) speed up the compare.
+HASHLIB_ALGORITHMS = ["md5", "sha1", "sha256", "blake2b", "blake2s"]
+
+# The non-cryptographic algorithms provided by the optional xxhash package.
+XXHASH_ALGORITHMS = ["xxh64", "xxh3_64", "xxh3_128"]
+
+HASH_ALGORITHMS = HASHLIB_ALGORITHMS + (XXHASH_ALGORITHMS if xxhash is not None else list())
+
+# Each thread reads into its own buffer, which is allocated once and reused for every file it checksums.
+_buffers = threading.local()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def new_hash(algorithm=DEFAULT_ALGORITHM):
+    """
+    Creates a new hash object.
+
+    :param algorithm: The name of the algorithm, one of HASH_ALGORITHMS. Defaults to DEFAULT_ALGORITHM.
+
+    :return: An object with the update and hexdigest methods of a hashlib hash object. Raises a ValueError if the
+             algorithm is not available.
+    """
+
+    if algorithm in HASHLIB_ALGORITHMS:
+        return hashlib.new(algorithm)
+    if algorithm in XXHASH_ALGORITHMS and xxhash is not None:
+        return getattr(xxhash, algorithm)()
+    raise ValueError(f"Unknown or unavailable hash algorithm: {algorithm}")
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _buffer(block_size) -> memoryview:
+    """
+    Returns this thread's read buffer, allocating it the first time (or if a larger one is needed).
+
+    :param block_size: The size of the buffer in bytes.
+
+    :return: A memoryview of the buffer.
+    """
+
+    buffer = getattr(_buffers, "buffer", None)
+    if buffer is None or len(buffer) < block_size:
+        buffer = memoryview(bytearray(block_size))
+        _buffers.buffer = buffer
+    return buffer[:block_size]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def read_fully(f,
+                buffer) -> int:
+    """
+    Fills a buffer from a file, reading again after a short read, until the buffer is full or the end of the file is
+    reached.
+
+    :param f: The file object, opened for reading in binary mode.
+    :param buffer: The memoryview to read into.
+
+    :return: The number of bytes read.
+    """
+
+    num_read = 0
+    while num_read < len(buffer):
+        chunk_size = f.readinto(buffer[num_read:])
+        if not chunk_size:
+            break
+        num_read += chunk_size
+    return num_read
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def checksum_for_file(file_p,
+                      algorithm=DEFAULT_ALGORITHM,
+                      block_size=BLOCK_SIZE) -> str:
+    """
+    Computes the checksum of a file on disk. The file is read straight into a reused buffer (with readinto), so no
+    memory is allocated per block.
+
+    :param file_p: The path to the file being checksummed.
+    :param algorithm: The name of the hash algorithm, one of HASH_ALGORITHMS. Defaults to DEFAULT_ALGORITHM.
+    :param block_size: The number of bytes to read from the file at a time. Defaults to BLOCK_SIZE.
+
+    :return: The checksum of the file as a hex string.
+    """
+
+    if registry.enabled:
+        return _timed_checksum_for_file(file_p, algorithm, block_size)
+
+    hash_obj = new_hash(algorithm)
+    buffer = _buffer(block_size)
+    with open(file_p, "rb", buffering=0) as f:
+        while True:
+            num_read = f.readinto(buffer)
+            if not num_read:
+                break
+            hash_obj.update(buffer[:num_read])
+    return hash_obj.hexdigest()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _timed_checksum_for_file(file_p,
+                             algorithm=DEFAULT_ALGORITHM,
+                             block_size=BLOCK_SIZE) -> str:
+    """
+    The same as checksum_for_file, but also records the number of bytes hashed, the total time taken, and the time
+    spent waiting on reads in the metrics registry.
+
+    :param file_p: The path to the file being checksummed.
+    :param algorithm: The name of the hash algorithm, one of HASH_ALGORITHMS. Defaults to DEFAULT_ALGORITHM.
+    :param block_size: The number of bytes to read from the file at a time. Defaults to BLOCK_SIZE.
+
+    :return: The checksum of the file as a hex string.
+    """
+
+    start = time.perf_counter()
+    read_seconds = 0.0
+    num_bytes = 0
+
+    hash_obj = new_hash(algorithm)
+    buffer = _buffer(block_size)
+    with open(file_p, "rb", buffering=0) as f:
+        while True:
+            read_start = time.perf_counter()
+            num_read = f.readinto(buffer)
+            read_seconds += time.perf_counter() - read_start
+            if not num_read:
+                break
+            num_bytes += num_read
+            hash_obj.update(buffer[:num_read])
+
+    registry.update({"hash_files": 1,
+                     "hash_bytes": num_bytes,
+                     "hash_seconds": time.perf_counter() - start,
+                     "hash_io_wait_seconds": read_seconds})
+    return hash_obj.hexdigest()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def partial_checksum_for_file(file_p,
+                              size,
+                              sample_size,
+                              algorithm=DEFAULT_ALGORITHM) -> str:
+    """
+    Computes a checksum of a sample of a file: the first, middle, and last sample_size bytes. This is much cheaper than
+    a full checksum on large files and is used to eliminate candidates before a full checksum is run. Two files with
+    different partial checksums cannot be identical, but two files with the same partial checksum are not necessarily
+    identical.
+
+    :param file_p: The path to the file being checksummed.
+    :param size: The size of the file in bytes.
+    :param sample_size: The number of bytes to read from each of the three sample locations.
+    :param algorithm: The name of the hash algorithm, one of HASH_ALGORITHMS. Defaults to DEFAULT_ALGORITHM.
+
+    :return: The checksum of the sampled bytes as a hex string.
+    """
+
+    start = time.perf_counter()
+    num_bytes = 0
+
+    hash_obj = new_hash(algorithm)
+    buffer = _buffer(sample_size)
+    with open(file_p, "rb", buffering=0) as f:
+        for offset in (0, max((size - sample_size) // 2, 0), max(size - sample_size, 0)):
+            f.seek(offset)
+            num_read = read_fully(f, buffer)
+            num_bytes += num_read
+            hash_obj.update(buffer[:num_read])
+
+    if registry.enabled:
+        registry.update({"partial_hash_files": 1,
+                         "partial_hash_bytes": num_bytes,
+                         "partial_hash_seconds": time.perf_counter() - start})
+    return hash_obj.hexdigest()
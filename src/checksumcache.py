@@ -0,0 +1,235 @@
+#! /usr/bin/env python3
+"""
+A module to manage a persistent, on-disk cache of file checksums that is shared between the compareFolders and
+deleteFiles apps.
+"""
+import os.path
+import sqlite3
+import threading
+import time
+
+from src import checksum
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "compareFolders", "checksums.sqlite")
+DEFAULT_MAX_ENTRIES = 20_000_000
+DEFAULT_MAX_AGE_DAYS = 90
+COMMIT_FREQUENCY = 1000
+
+
+class ChecksumCache(object):
+    """
+    A class to store and retrieve file checksums in an SQLite database. Entries are keyed on the device, inode, size,
+    modification time, and status change time (both in nanoseconds) of the file, so any change to the file on disk
+    invalidates its entry. The modification time alone is not enough: tools like cp -p, rsync, and tar set it back after
+    writing a file, but nothing short of changing the system clock can set the status change time.
+
+    The cache may be shared between threads. Database access is serialized, but checksums are computed outside of the
+    lock so several files can be read at the same time.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self,
+                 cache_path=DEFAULT_CACHE_PATH,
+                 max_entries=DEFAULT_MAX_ENTRIES,
+                 max_age_days=DEFAULT_MAX_AGE_DAYS):
+        """
+        Opens (or creates) the cache database.
+
+        :param cache_path: The path to the SQLite database. If the parent directory does not exist it will be created.
+               Use ":memory:" for a cache that only lives as long as this object. Defaults to DEFAULT_CACHE_PATH.
+        :param max_entries: The maximum number of entries to keep in the cache. The least recently used entries are
+               evicted when the cache is closed. Defaults to DEFAULT_MAX_ENTRIES.
+        :param max_age_days: Entries that have not been used in this many days are evicted when the cache is closed.
+               Defaults to DEFAULT_MAX_AGE_DAYS.
+
+        :return: Nothing.
+        """
+
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+        self._pending_writes = 0
+        self._lock = threading.Lock()
+
+        if cache_path != ":memory:":
+            os.makedirs(os.path.split(cache_path)[0], exist_ok=True)
+
+        self.connection = sqlite3.connect(cache_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+
+        # Caches written before the status change time was recorded cannot be trusted, so they are started over.
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(checksums)")]
+        if columns and "ctime_ns" not in columns:
+            self.connection.execute("DROP TABLE checksums")
+
+        self.connection.execute("CREATE TABLE IF NOT EXISTS checksums ("
+                                "device INTEGER NOT NULL, "
+                                "inode INTEGER NOT NULL, "
+                                "algorithm TEXT NOT NULL, "
+                                "size INTEGER NOT NULL, "
+                                "mtime_ns INTEGER NOT NULL, "
+                                "ctime_ns INTEGER NOT NULL, "
+                                "checksum TEXT NOT NULL, "
+                                "last_used INTEGER NOT NULL, "
+                                "PRIMARY KEY (device, inode, algorithm))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS checksums_last_used ON checksums (last_used)")
+        self.connection.commit()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def get(self,
+            stat_result,
+            algorithm="md5"):
+        """
+        Looks up the checksum for a file.
+
+        :param stat_result: The os.stat_result of the file.
+        :param algorithm: The name of the checksum algorithm. Defaults to "md5".
+
+        :return: The checksum as a string, or None if there is no valid entry for this file.
+        """
+
+        with self._lock:
+            row = self.connection.execute("SELECT size, mtime_ns, ctime_ns, checksum FROM checksums "
+                                          "WHERE device=? AND inode=? AND algorithm=?",
+                                          (stat_result.st_dev, stat_result.st_ino, algorithm)).fetchone()
+
+            if row is None or row[:3] != (stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ctime_ns):
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.connection.execute("UPDATE checksums SET last_used=? WHERE device=? AND inode=? AND algorithm=?",
+                                    (int(time.time()), stat_result.st_dev, stat_result.st_ino, algorithm))
+            self._count_write()
+            return row[3]
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def put(self,
+            stat_result,
+            checksum_str,
+            algorithm="md5"):
+        """
+        Stores the checksum for a file, replacing any previous entry for the same device and inode.
+
+        :param stat_result: The os.stat_result of the file, taken BEFORE the checksum was computed.
+        :param checksum_str: The checksum to store.
+        :param algorithm: The name of the checksum algorithm. Defaults to "md5".
+
+        :return: Nothing.
+        """
+
+        with self._lock:
+            self.connection.execute("INSERT OR REPLACE INTO checksums "
+                                    "(device, inode, algorithm, size, mtime_ns, ctime_ns, checksum, last_used) "
+                                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (stat_result.st_dev,
+                                     stat_result.st_ino,
+                                     algorithm,
+                                     stat_result.st_size,
+                                     stat_result.st_mtime_ns,
+                                     stat_result.st_ctime_ns,
+                                     checksum_str,
+                                     int(time.time())))
+            self._count_write()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def checksum(self,
+                 file_p,
+                 stat_result=None,
+                 sample_size=None,
+                 algorithm=checksum.DEFAULT_ALGORITHM) -> str:
+        """
+        Returns the checksum of a file, reading it from the cache if possible and computing (and storing) it otherwise.
+
+        :param file_p: The path to the file.
+        :param stat_result: An optional os.stat_result for the file, if the caller has already stat'ed it.
+        :param sample_size: If given, a partial checksum of the first, middle, and last sample_size bytes is returned
+               instead of a checksum of the whole file. Partial checksums are stored separately from full ones.
+        :param algorithm: The name of the hash algorithm. Checksums of each algorithm are stored separately. Defaults
+               to checksum.DEFAULT_ALGORITHM.
+
+        :return: The checksum as a string.
+        """
+
+        if stat_result is None:
+            stat_result = os.stat(file_p)
+
+        if sample_size is None:
+            key = algorithm
+        else:
+            key = f"{algorithm}:partial:{sample_size}"
+
+        checksum_str = self.get(stat_result, key)
+        if checksum_str is None:
+            if sample_size is None:
+                checksum_str = checksum.checksum_for_file(file_p, algorithm)
+            else:
+                checksum_str = checksum.partial_checksum_for_file(file_p, stat_result.st_size, sample_size, algorithm)
+            self.put(stat_result, checksum_str, key)
+
+        return checksum_str
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _count_write(self):
+        """
+        Counts a write to the database and commits once enough writes have accumulated. Must be called with the lock
+        held.
+
+        :return: Nothing.
+        """
+
+        self._pending_writes += 1
+        if self._pending_writes >= COMMIT_FREQUENCY:
+            self.connection.commit()
+            self._pending_writes = 0
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def evict(self):
+        """
+        Removes entries that are older than max_age_days, then removes the least recently used entries until no more
+        than max_entries remain.
+
+        :return: Nothing.
+        """
+
+        cutoff = int(time.time()) - int(self.max_age_days * 24 * 60 * 60)
+        with self._lock:
+            cursor = self.connection.execute("DELETE FROM checksums WHERE last_used < ?", (cutoff,))
+            self.evicted += max(cursor.rowcount, 0)
+
+            count = self.connection.execute("SELECT COUNT(*) FROM checksums").fetchone()[0]
+            if count > self.max_entries:
+                cursor = self.connection.execute("DELETE FROM checksums WHERE rowid IN "
+                                                 "(SELECT rowid FROM checksums ORDER BY last_used LIMIT ?)",
+                                                 (count - self.max_entries,))
+                self.evicted += max(cursor.rowcount, 0)
+
+            self.connection.commit()
+            self._pending_writes = 0
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def close(self):
+        """
+        Evicts stale entries, commits any outstanding writes, and closes the database.
+
+        :return: Nothing.
+        """
+
+        self.evict()
+        self.connection.close()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def stats_str(self) -> str:
+        """
+        Returns a short, human readable summary of the cache activity.
+
+        :return: A string describing the number of hits, misses, and evicted entries.
+        """
+
+        return f"{self.hits} hits, {self.misses} misses, {self.evicted} evicted"
@@ -0,0 +1,255 @@
+#! /usr/bin/env python3
+"""
+A module to sort more scan records than fit in memory, by spilling sorted runs to temporary files and merging them.
+
+A scan record is a tuple of (size, directory, name, device, inode, modification time, inode change time, creation time,
+checksum), so sorting records sorts them by size first. Records are collected in memory until their estimated size
+reaches the memory ceiling; the collected records are then sorted and written to a run file, and the next run is
+started. Reading the records back merges the runs, holding only one small block of records from each run in memory at a
+time.
+
+The query and canonical records, each sorted by size, are then merge-joined (see merge_join) so that each group of
+query files is only ever compared to the canonical files of the same size, and no lookup table of every canonical file
+is ever built.
+"""
+import heapq
+import itertools
+import os.path
+import pickle
+import tempfile
+
+from src.filetable import FileStat
+from src.metrics import registry
+
+DEFAULT_MAX_MEMORY = 1024 * 1024 * 1024
+
+# The number of records written (and later read back) at a time. Merging the runs holds one block from each of them in
+# memory at once.
+RUN_BLOCK_RECORDS = 1024
+
+# A rough estimate of the memory used by a record held in memory, not counting its directory and file name: the tuple,
+# its integers, and its slot in the list of records.
+RECORD_OVERHEAD = 240
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def scan_record(dir_d,
+                name,
+                stat_result,
+                checksum_str=None) -> tuple:
+    """
+    :param dir_d: The directory the file lives in.
+    :param name: The name of the file.
+    :param stat_result: An os.stat_result or a FileStat for the file.
+    :param checksum_str: An optional, already known, full checksum of the file.
+
+    :return: The scan record of the file.
+    """
+
+    if not isinstance(stat_result, FileStat):
+        stat_result = FileStat.from_stat(stat_result)
+
+    return (stat_result.st_size,
+            dir_d,
+            name,
+            stat_result.st_dev,
+            stat_result.st_ino,
+            stat_result.st_mtime_ns,
+            stat_result.st_ctime_ns,
+            stat_result.st_birthtime_ns,
+            checksum_str or "")
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def record_path(record) -> str:
+    """
+    :param record: A scan record.
+
+    :return: The full path of the file.
+    """
+
+    return os.path.join(record[1], record[2])
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def record_stat(record) -> FileStat:
+    """
+    :param record: A scan record.
+
+    :return: A FileStat for the file.
+    """
+
+    return FileStat(record[3], record[4], record[0], record[5], record[6], record[7])
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def record_checksum(record):
+    """
+    :param record: A scan record.
+
+    :return: The full checksum recorded for the file, or None if there is none.
+    """
+
+    return record[8] or None
+
+
+class ExternalSorter(object):
+    """
+    A class to sort any number of scan records within a memory ceiling.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self,
+                 max_memory=DEFAULT_MAX_MEMORY,
+                 temp_dir=None,
+                 name="extsort"):
+        """
+        :param max_memory: The most memory, in bytes, that the records held in memory may use before they are spilled
+               to a run file. Defaults to DEFAULT_MAX_MEMORY.
+        :param temp_dir: The directory the run files are written to. Defaults to the system's temporary directory.
+        :param name: The name used as a prefix for this sorter's metrics. Defaults to "extsort".
+
+        :return: Nothing.
+        """
+
+        self.max_memory = max_memory
+        self.temp_dir = temp_dir
+        self.name = name
+
+        self.count = 0
+        self.runs_written = 0
+        self.bytes_spilled = 0
+
+        self._records = list()
+        self._memory = 0
+        self._runs = list()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __len__(self) -> int:
+        """
+        :return: The number of records added so far.
+        """
+
+        return self.count
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def add(self,
+            record):
+        """
+        Adds a record, spilling the records held in memory to a new run file if they have reached the memory ceiling.
+
+        :param record: A scan record.
+
+        :return: Nothing. Raises an OSError if a run file cannot be written.
+        """
+
+        self._records.append(record)
+        self._memory += RECORD_OVERHEAD + len(record[1]) + len(record[2])
+        self.count += 1
+        if self._memory >= self.max_memory:
+            self._spill()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _spill(self):
+        """
+        Sorts the records held in memory and writes them to a new run file, one block at a time.
+
+        :return: Nothing. Raises an OSError if the run file cannot be written.
+        """
+
+        self._records.sort()
+        run_f = tempfile.TemporaryFile(dir=self.temp_dir, prefix="compareFolders_run_")
+        try:
+            for start in range(0, len(self._records), RUN_BLOCK_RECORDS):
+                pickle.dump(self._records[start:start + RUN_BLOCK_RECORDS], run_f, pickle.HIGHEST_PROTOCOL)
+            run_f.flush()
+        except OSError:
+            run_f.close()
+            raise
+
+        self.runs_written += 1
+        self.bytes_spilled += run_f.tell()
+        if registry.enabled:
+            registry.update({f"{self.name}_runs": 1,
+                             f"{self.name}_bytes_spilled": run_f.tell()})
+
+        self._runs.append(run_f)
+        self._records = list()
+        self._memory = 0
+
+    # ------------------------------------------------------------------------------------------------------------------
+    @staticmethod
+    def _read_run(run_f):
+        """
+        Reads the records of a run file back, one block at a time.
+
+        :param run_f: The run file object.
+
+        :return: A generator that yields the records of the run in sorted order.
+        """
+
+        run_f.seek(0)
+        while True:
+            try:
+                block = pickle.load(run_f)
+            except EOFError:
+                return
+            yield from block
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def sorted(self):
+        """
+        Returns every record added, in sorted order. If nothing has been spilled, the records are sorted in memory.
+        Otherwise the records still in memory are spilled as a last run, and the runs are merged.
+
+        :return: A generator that yields the records in sorted order.
+        """
+
+        if not self._runs:
+            self._records.sort()
+            return iter(self._records)
+
+        if self._records:
+            self._spill()
+        return heapq.merge(*[self._read_run(run_f) for run_f in self._runs])
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def close(self):
+        """
+        Closes (and so deletes) the run files, and drops the records held in memory.
+
+        :return: Nothing.
+        """
+
+        for run_f in self._runs:
+            run_f.close()
+        self._runs = list()
+        self._records = list()
+        self._memory = 0
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def merge_join(query_records,
+               canonical_records):
+    """
+    Walks two streams of scan records, both sorted by size, side by side, and pairs each size of query file with the
+    canonical files of the same size. Canonical files whose size no query file has are skipped without being kept.
+
+    :param query_records: An iterable of the query scan records, sorted.
+    :param canonical_records: An iterable of the canonical scan records, sorted.
+
+    :return: A generator that yields a tuple of (size, an iterator over the query records of that size, a list of the
+             canonical records of that size) for each size of query file. The canonical list is empty if no canonical
+             file has that size. Each iterator of query records must be used up before the next tuple is taken.
+    """
+
+    canonical_groups = itertools.groupby(canonical_records, key=lambda record: record[0])
+    canonical_size, canonical_group = next(canonical_groups, (None, None))
+
+    for size, query_group in itertools.groupby(query_records, key=lambda record: record[0]):
+        while canonical_size is not None and canonical_size < size:
+            canonical_size, canonical_group = next(canonical_groups, (None, None))
+        if canonical_size == size:
+            yield size, query_group, list(canonical_group)
+        else:
+            yield size, query_group, list()
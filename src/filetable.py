@@ -0,0 +1,334 @@
+#! /usr/bin/env python3
+"""
+A module to hold the files found by a scan in a compact, column oriented table.
+"""
+from array import array
+import os.path
+
+
+class FileStat(object):
+    """
+    A class that holds the subset of os.stat_result fields used when comparing files. It has the same attribute names
+    as os.stat_result, so it may be used anywhere a stat result is read (for example, by the checksum cache).
+    """
+
+    __slots__ = ("st_dev", "st_ino", "st_size", "st_mtime_ns", "st_ctime_ns", "st_birthtime_ns")
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self,
+                 st_dev,
+                 st_ino,
+                 st_size,
+                 st_mtime_ns,
+                 st_ctime_ns,
+                 st_birthtime_ns=None):
+        """
+        :param st_dev: The device the file lives on.
+        :param st_ino: The inode of the file.
+        :param st_size: The size of the file in bytes.
+        :param st_mtime_ns: The modification time of the file in nanoseconds.
+        :param st_ctime_ns: The inode change time of the file in nanoseconds.
+        :param st_birthtime_ns: The creation time of the file in nanoseconds: the birth time where the file system
+               provides one. If None, the inode change time is used instead.
+
+        :return: Nothing.
+        """
+
+        self.st_dev = st_dev
+        self.st_ino = st_ino
+        self.st_size = st_size
+        self.st_mtime_ns = st_mtime_ns
+        self.st_ctime_ns = st_ctime_ns
+        self.st_birthtime_ns = st_ctime_ns if st_birthtime_ns is None else st_birthtime_ns
+
+    # ------------------------------------------------------------------------------------------------------------------
+    @classmethod
+    def from_stat(cls,
+                  stat_result):
+        """
+        Builds a FileStat from an os.stat_result.
+
+        :param stat_result: The os.stat_result.
+
+        :return: A FileStat object.
+        """
+
+        birthtime_ns = getattr(stat_result, "st_birthtime_ns", None)
+        if birthtime_ns is None:
+            birthtime = getattr(stat_result, "st_birthtime", None)
+            if birthtime is not None:
+                birthtime_ns = int(birthtime * 1e9)
+
+        return cls(stat_result.st_dev,
+                   stat_result.st_ino,
+                   stat_result.st_size,
+                   stat_result.st_mtime_ns,
+                   stat_result.st_ctime_ns,
+                   birthtime_ns)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    @property
+    def st_mtime(self) -> float:
+        """
+        :return: The modification time in seconds.
+        """
+
+        return self.st_mtime_ns / 1e9
+
+    # ------------------------------------------------------------------------------------------------------------------
+    @property
+    def st_ctime(self) -> float:
+        """
+        :return: The inode change time in seconds.
+        """
+
+        return self.st_ctime_ns / 1e9
+
+    # ------------------------------------------------------------------------------------------------------------------
+    @property
+    def creation_time(self) -> float:
+        """
+        :return: The creation time in seconds (the birth time where the file system provides one, otherwise the inode
+                 change time). Only used to match files on their creation times: anything that needs to know whether a
+                 file has changed uses st_ctime_ns.
+        """
+
+        return self.st_birthtime_ns / 1e9
+
+
+class FileTable(object):
+    """
+    A class to store a large number of files compactly. Each file is identified by an integer file id. Directory paths
+    are stored once and shared by every file in the directory, and the numeric metadata is kept in typed arrays rather
+    than in one Python object per file. For trees with tens of millions of files this uses a small fraction of the
+    memory of a dictionary of paths to stat results.
+    """
+
+    __slots__ = ("dirs", "_dir_ids", "dir_ids", "names", "sizes", "mtimes", "ctimes", "birthtimes", "inodes",
+                 "devices", "from_index", "checksums")
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self):
+        """
+        Creates an empty table.
+
+        :return: Nothing.
+        """
+
+        self.dirs = list()
+        self._dir_ids = dict()
+
+        self.dir_ids = array("L")
+        self.names = list()
+        self.sizes = array("q")
+        self.mtimes = array("q")
+        self.ctimes = array("q")
+        self.birthtimes = array("q")
+        self.inodes = array("Q")
+        self.devices = array("Q")
+
+        # 1 for a file whose stat (and checksum) was taken from a canonical index without the file being stat'ed again.
+        self.from_index = bytearray()
+
+        self.checksums = dict()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __len__(self) -> int:
+        """
+        :return: The number of files in the table.
+        """
+
+        return len(self.names)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __iter__(self):
+        """
+        :return: A generator that yields the full path of every file in the table.
+        """
+
+        for file_id in range(len(self.names)):
+            yield self.path(file_id)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _intern_dir(self,
+                    dir_d) -> int:
+        """
+        Returns the id of a directory path, adding it to the table if it is not already there.
+
+        :param dir_d: The directory path.
+
+        :return: The directory id.
+        """
+
+        dir_id = self._dir_ids.get(dir_d)
+        if dir_id is None:
+            dir_id = len(self.dirs)
+            self.dirs.append(dir_d)
+            self._dir_ids[dir_d] = dir_id
+        return dir_id
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def add(self,
+            dir_d,
+            name,
+            file_stat,
+            checksum_str=None,
+            from_index=False) -> int:
+        """
+        Adds a file to the table.
+
+        :param dir_d: The directory the file lives in.
+        :param name: The name of the file.
+        :param file_stat: An os.stat_result or a FileStat for the file.
+        :param checksum_str: An optional, already known, full checksum of the file.
+        :param from_index: If True, file_stat (and checksum_str) were taken from a canonical index without the file
+               being stat'ed again, so they may be out of date. Defaults to False.
+
+        :return: The file id.
+        """
+
+        if not isinstance(file_stat, FileStat):
+            file_stat = FileStat.from_stat(file_stat)
+
+        file_id = len(self.names)
+        self.dir_ids.append(self._intern_dir(dir_d))
+        self.names.append(name)
+        self.sizes.append(file_stat.st_size)
+        self.mtimes.append(file_stat.st_mtime_ns)
+        self.ctimes.append(file_stat.st_ctime_ns)
+        self.birthtimes.append(file_stat.st_birthtime_ns)
+        self.inodes.append(file_stat.st_ino)
+        self.devices.append(file_stat.st_dev)
+        self.from_index.append(1 if from_index else 0)
+        if checksum_str is not None:
+            self.checksums[file_id] = checksum_str
+        return file_id
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def path(self,
+             file_id) -> str:
+        """
+        :param file_id: The file id.
+
+        :return: The full path of the file.
+        """
+
+        return os.path.join(self.dirs[self.dir_ids[file_id]], self.names[file_id])
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def dir(self,
+            file_id) -> str:
+        """
+        :param file_id: The file id.
+
+        :return: The directory the file lives in.
+        """
+
+        return self.dirs[self.dir_ids[file_id]]
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def stat(self,
+             file_id) -> FileStat:
+        """
+        :param file_id: The file id.
+
+        :return: A FileStat for the file.
+        """
+
+        return FileStat(self.devices[file_id],
+                        self.inodes[file_id],
+                        self.sizes[file_id],
+                        self.mtimes[file_id],
+                        self.ctimes[file_id],
+                        self.birthtimes[file_id])
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def set_stat(self,
+                 file_id,
+                 file_stat):
+        """
+        Replaces the stat of a file, for example once a file taken from a canonical index has been stat'ed again.
+
+        :param file_id: The file id.
+        :param file_stat: An os.stat_result or a FileStat for the file.
+
+        :return: Nothing.
+        """
+
+        if not isinstance(file_stat, FileStat):
+            file_stat = FileStat.from_stat(file_stat)
+
+        self.sizes[file_id] = file_stat.st_size
+        self.mtimes[file_id] = file_stat.st_mtime_ns
+        self.ctimes[file_id] = file_stat.st_ctime_ns
+        self.birthtimes[file_id] = file_stat.st_birthtime_ns
+        self.inodes[file_id] = file_stat.st_ino
+        self.devices[file_id] = file_stat.st_dev
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def sort(self):
+        """
+        Reorders the table by directory path and then by file name, so that the order of the files does not depend on
+        the order in which they were added. Any file ids handed out before the sort are no longer valid.
+
+        :return: An array that maps each old file id to its new file id.
+        """
+
+        dir_rank = [0] * len(self.dirs)
+        for rank, dir_id in enumerate(sorted(range(len(self.dirs)), key=self.dirs.__getitem__)):
+            dir_rank[dir_id] = rank
+
+        order = sorted(range(len(self.names)), key=lambda file_id: (dir_rank[self.dir_ids[file_id]],
+                                                                    self.names[file_id]))
+
+        self.dir_ids = array("L", (self.dir_ids[file_id] for file_id in order))
+        self.names = [self.names[file_id] for file_id in order]
+        self.sizes = array("q", (self.sizes[file_id] for file_id in order))
+        self.mtimes = array("q", (self.mtimes[file_id] for file_id in order))
+        self.ctimes = array("q", (self.ctimes[file_id] for file_id in order))
+        self.birthtimes = array("q", (self.birthtimes[file_id] for file_id in order))
+        self.inodes = array("Q", (self.inodes[file_id] for file_id in order))
+        self.devices = array("Q", (self.devices[file_id] for file_id in order))
+        self.from_index = bytearray(self.from_index[file_id] for file_id in order)
+
+        new_ids = array("L", bytes(len(order) * array("L").itemsize))
+        for new_id, old_id in enumerate(order):
+            new_ids[old_id] = new_id
+
+        self.checksums = {new_ids[old_id]: checksum_str for old_id, checksum_str in self.checksums.items()}
+
+        return new_ids
+
+    # ------------------------------------------------------------------------------------------------------------------
+    @classmethod
+    def merged(cls,
+               tables):
+        """
+        Builds a new table holding the files of several tables (for example, the shards of a canonical index). The
+        result does not depend on the order of the tables: files are sorted by directory path and then by file name, and
+        if the same path is in more than one table, the entry with the latest modification time is kept (ties are
+        broken by size, inode, device, and checksum).
+
+        :param tables: A list of FileTable objects.
+
+        :return: A new FileTable object.
+        """
+
+        entries = dict()
+        for table in tables:
+            for file_id in range(len(table.names)):
+                key = (table.dir(file_id), table.names[file_id])
+                rank = (table.mtimes[file_id],
+                        table.sizes[file_id],
+                        table.inodes[file_id],
+                        table.devices[file_id],
+                        table.checksums.get(file_id, ""))
+                entry = entries.get(key)
+                if entry is None or rank > entry[0]:
+                    entries[key] = (rank, table, file_id)
+
+        merged = cls()
+        for key in sorted(entries):
+            rank, table, file_id = entries[key]
+            merged.add(key[0], key[1], table.stat(file_id), table.checksums.get(file_id), table.from_index[file_id])
+        return merged
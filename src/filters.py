@@ -0,0 +1,211 @@
+#! /usr/bin/env python3
+"""
+A module to compile the include and exclude regex lists used by the scans into matchers that test a name in a single
+call, however many patterns were given.
+
+Patterns are matched the way re.match matches them: from the start of the name, but not necessarily to its end. Two
+common kinds of pattern are matched without a regex at all:
+
+    literal prefixes      "backup_", "^tmp", "Thumbs\\.db"       matched with str.startswith
+    extension lists       ".*\\.jpg$", "^.*\\.(jpg|png|gif)$"      matched with str.endswith
+
+Every other pattern is joined into a single alternation that is compiled once, so a name is tested against all of
+them by the regex engine in one pass rather than by one Python call per pattern.
+"""
+import re
+
+# A run of characters that match themselves: anything but a regex metacharacter, or a backslash followed by a character
+# that is not a letter or digit (and so is an escaped literal).
+_LITERAL = r"(?:[^.^$*+?{}\[\]\\|()]|\\[^A-Za-z0-9])*"
+
+_PREFIX_PATTERN = re.compile(rf"\^?({_LITERAL})")
+_SUFFIX_PATTERN = re.compile(rf"\^?\.\*({_LITERAL})\$")
+_SUFFIX_LIST_PATTERN = re.compile(rf"\^?\.\*({_LITERAL})\((?:\?:)?({_LITERAL}(?:\|{_LITERAL})*)\)\$")
+
+_ESCAPE = re.compile(r"\\(.)")
+
+# A pattern that refers back to one of its own groups cannot be joined with others, because its group numbers would
+# change.
+_BACK_REFERENCE = re.compile(r"\\[1-9]|\(\?P=|\(\?\(")
+
+# Global flags at the start of a pattern are rewritten as flags scoped to that pattern before it is joined with others.
+# Only the flags that keep their meaning when scoped can be rewritten (the trailing comment of a verbose pattern, for
+# example, would swallow the closing parenthesis).
+_GLOBAL_FLAGS = re.compile(r"\(\?([aiLmsux]+)\)")
+_SCOPABLE_FLAGS = set("ims")
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _unescape(literal) -> str:
+    """
+    :param literal: A regex made only of characters that match themselves (see _LITERAL).
+
+    :return: The string the regex matches.
+    """
+
+    return _ESCAPE.sub(r"\1", literal)
+
+
+class NameMatcher(object):
+    """
+    A class to test names against a list of regex patterns at once. A name matches if any of the patterns matches it.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self,
+                 patterns):
+        """
+        Compiles the patterns.
+
+        :param patterns: A list of regex patterns, or None.
+
+        :return: Nothing. Raises a re.error if any of the patterns is not a valid regex.
+        """
+
+        self.patterns = list(patterns or list())
+
+        # Every pattern is compiled on its own as well, so that an invalid one is reported just as it would be if it
+        # were used on its own, and so that names the fast paths cannot answer for still get the right answer.
+        self._regexes = [re.compile(pattern) for pattern in self.patterns]
+
+        prefixes = list()
+        suffixes = list()
+        joinable = list()
+        self._unjoinable = list()
+
+        for pattern, regex in zip(self.patterns, self._regexes):
+            if _PREFIX_PATTERN.fullmatch(pattern):
+                prefixes.append(_unescape(_PREFIX_PATTERN.fullmatch(pattern).group(1)))
+            elif _SUFFIX_PATTERN.fullmatch(pattern):
+                suffixes.append(_unescape(_SUFFIX_PATTERN.fullmatch(pattern).group(1)))
+            elif _SUFFIX_LIST_PATTERN.fullmatch(pattern):
+                stem, alternatives = _SUFFIX_LIST_PATTERN.fullmatch(pattern).groups()
+                suffixes.extend(_unescape(stem + alternative) for alternative in alternatives.split("|"))
+            elif (regex.groups and _BACK_REFERENCE.search(pattern)) or not self._can_scope_flags(pattern):
+                self._unjoinable.append(regex)
+            else:
+                joinable.append(pattern)
+
+        self._prefixes = tuple(prefixes)
+        self._suffixes = tuple(suffixes)
+        self._joined = None
+        if joinable:
+            try:
+                self._joined = re.compile("|".join(f"(?:{self._scope_flags(pattern)})" for pattern in joinable))
+            except re.error:
+                self._unjoinable.extend(re.compile(pattern) for pattern in joinable)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __bool__(self) -> bool:
+        """
+        :return: True if there is at least one pattern to match.
+        """
+
+        return bool(self.patterns)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    @staticmethod
+    def _can_scope_flags(pattern) -> bool:
+        """
+        :param pattern: The regex pattern.
+
+        :return: True if the pattern has no global flags at its start, or only flags that _scope_flags can rewrite.
+        """
+
+        flags = _GLOBAL_FLAGS.match(pattern)
+        return flags is None or set(flags.group(1)) <= _SCOPABLE_FLAGS
+
+    # ------------------------------------------------------------------------------------------------------------------
+    @staticmethod
+    def _scope_flags(pattern) -> str:
+        """
+        Rewrites the global flags at the start of a pattern (for example "(?i)") as flags that apply to the pattern
+        only (for example "(?i:...)"), since global flags are only allowed at the very start of a regex.
+
+        :param pattern: The regex pattern.
+
+        :return: The rewritten pattern, or the pattern itself if it does not start with global flags.
+        """
+
+        flags = _GLOBAL_FLAGS.match(pattern)
+        if flags is None:
+            return pattern
+        return f"(?{flags.group(1)}:{pattern[flags.end():]})"
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def matches(self,
+                name) -> bool:
+        """
+        Tests a name against the patterns.
+
+        :param name: The file or directory name.
+
+        :return: True if any of the patterns matches the start of the name.
+        """
+
+        if "\n" in name:
+            # ".*" and "$" treat a newline specially, so the suffix fast path does not apply.
+            return any(regex.match(name) for regex in self._regexes)
+
+        if self._prefixes and name.startswith(self._prefixes):
+            return True
+        if self._suffixes and name.endswith(self._suffixes):
+            return True
+        if self._joined is not None and self._joined.match(name):
+            return True
+        return any(regex.match(name) for regex in self._unjoinable)
+
+
+class NameFilter(object):
+    """
+    A class to apply the hidden, include, and exclude filters of one kind of entry (files or directories) to a name, in
+    that order, and report which filter (if any) skipped it.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self,
+                 kind,
+                 skip_hidden=False,
+                 incl_regexes=None,
+                 excl_regexes=None):
+        """
+        Compiles the filters.
+
+        :param kind: Either "files" or "dirs". Used to name the skip counters.
+        :param skip_hidden: If True, names that start with a "." are skipped.
+        :param incl_regexes: A list of regex patterns. If given, only names that match at least one of them pass.
+        :param excl_regexes: A list of regex patterns. Names that match any of them are skipped.
+
+        :return: Nothing. Raises a re.error if any of the patterns is not a valid regex.
+        """
+
+        self.skip_hidden = skip_hidden
+        self.incl = NameMatcher(incl_regexes)
+        self.excl = NameMatcher(excl_regexes)
+
+        self.hidden_key = f"skipped_hidden_{kind}"
+        self.include_key = f"skipped_include_{kind}"
+        self.exclude_key = f"skipped_exclude_{kind}"
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def skip_reason(self,
+                    name):
+        """
+        Checks a name against the filters.
+
+        :param name: The file or directory name.
+
+        :return: None if the name passes every filter. Otherwise the name of the skip counter of the first filter that
+                 skipped it.
+        """
+
+        if self.skip_hidden and name.startswith("."):
+            return self.hidden_key
+
+        if self.incl and not self.incl.matches(name):
+            return self.include_key
+
+        if self.excl and self.excl.matches(name):
+            return self.exclude_key
+
+        return None
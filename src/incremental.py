@@ -0,0 +1,142 @@
+#! /usr/bin/env python3
+"""
+A module to reuse the results of a previous compare (read from its result log) for the files that have not changed
+since, so that a compare run again and again over the same directories only has to read the files that have changed.
+
+A file counts as changed if its modification time or its status change time is later than the start of the previous
+compare's scans, less RACY_WINDOW_NS to allow for coarse timestamps. On Linux the status change time also moves when a
+file is renamed, moved, or hard linked into a directory, so a file that appeared in a tree without being modified still
+counts as changed. A previous result is reused for a query file only if the query file has not changed:
+
+    - a canonical file that matched it before, and has not changed, still matches it without being read again
+    - a canonical file that did not match it before, and has not changed, still does not match it
+    - a canonical file that has changed (or is new) is compared to it as usual
+
+Query files that are new, have changed, could not be read, or had a canonical candidate that could not be read are
+compared as usual. The previous compare must have used the same query and canonical directories, comparison options,
+hash algorithm, checksum setting, and scan settings (skip flags and regexes), or its results are not used at all.
+"""
+import os.path
+
+from src import resultlog
+from src.canonicalindex import RACY_WINDOW_NS
+
+_NO_MATCHES = frozenset()
+
+
+class PreviousResults(object):
+    """
+    A class to hold the results of a previous compare in memory, keyed on query file path.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self,
+                 log_p):
+        """
+        Reads the header and the records of the previous result log. Records are read before anything else is done, so
+        the log may be overwritten by the new compare.
+
+        :param log_p: The path to the result log of the previous compare (in either format).
+
+        :return: Nothing. Raises a ValueError if the log cannot be used, and an OSError if it cannot be read.
+        """
+
+        self.log_p = log_p
+        self.header = resultlog.read_header(log_p)
+        if self.header.get("started_ns") is None:
+            raise ValueError(f"The log file does not record when its compare started (it was written by an older "
+                             f"version of compareFolders, or by a self compare): {log_p}")
+
+        self.cutoff_ns = self.header["started_ns"] - RACY_WINDOW_NS
+        self.results = dict()
+
+        query_p = None
+        for record in resultlog.iter_records(log_p):
+            if record[0] == "D":
+                query_p = record[1]
+                self.results[query_p] = frozenset(record[2:])
+            elif record[0] == "U":
+                query_p = record[1]
+                self.results[query_p] = _NO_MATCHES
+            elif record[0] == "SE":
+                query_p = None
+            elif query_p is not None:
+                # A canonical file could not be read while this query file was being compared, so the query file may
+                # have been missing a match.
+                self.results.pop(query_p, None)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def check_settings(self,
+                       options,
+                       hash_algorithm,
+                       query_items,
+                       canonical_roots,
+                       skip_checksum,
+                       scan_settings):
+        """
+        Checks that the previous compare was run with the same settings as the new one.
+
+        :param options: The string of comparison options (any of "nptrcm") of the new compare.
+        :param hash_algorithm: The name of the hash algorithm of the new compare.
+        :param query_items: The list of query items of the new compare.
+        :param canonical_roots: The list of canonical directories (and shard roots) of the new compare.
+        :param skip_checksum: Whether the new compare skips checksums.
+        :param scan_settings: A dictionary of the query and canonical scan settings (skip flags and regexes) of the new
+               compare, keyed on "query" and "canonical". A file skipped by one compare and not the other would
+               otherwise be reported wrongly (for example, as unique because its only match was skipped before).
+
+        :return: Nothing. Raises a ValueError naming the first setting that differs.
+        """
+
+        query_dirs = [os.path.abspath(item) for item in query_items if os.path.isdir(item)]
+        for label, previous, current in (("comparison options", sorted(self.header["options"]), sorted(options)),
+                                         ("hash algorithm", self.header["hash"], hash_algorithm),
+                                         ("query directories", self.header["query_dirs"], query_dirs),
+                                         ("canonical directories", self.header.get("canonical_roots"),
+                                          [os.path.abspath(root) for root in canonical_roots]),
+                                         ("checksum setting", self.header.get("skip_checksum"), skip_checksum),
+                                         ("scan settings", self.header.get("scan_settings"), scan_settings)):
+            if previous != current:
+                raise ValueError(f"The previous compare used different {label} than this one: {self.log_p}")
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def changed(self,
+                stat_result) -> bool:
+        """
+        :param stat_result: The FileStat (or os.stat_result) of a file.
+
+        :return: True if the file may have changed since the previous compare scanned it.
+        """
+
+        return stat_result.st_mtime_ns >= self.cutoff_ns or stat_result.st_ctime_ns >= self.cutoff_ns
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def split_candidates(self,
+                         query_p,
+                         query_stat,
+                         candidates):
+        """
+        Splits the candidates of a query file into those whose previous result still holds and those that need to be
+        compared again.
+
+        :param query_p: The path to the query file.
+        :param query_stat: The FileStat of the query file.
+        :param candidates: A list of (path, metadata) tuples of canonical files.
+
+        :return: A tuple of (the set of paths of the candidates that still match the query file, the list of (path,
+                 metadata) tuples of the candidates that need to be compared), or None if the query file has no
+                 previous result that can be used.
+        """
+
+        previous_matches = self.results.get(query_p)
+        if previous_matches is None or self.changed(query_stat):
+            return None
+
+        matched = set()
+        unknown = list()
+        for canonical_p, canonical_metadata in candidates:
+            if self.changed(canonical_metadata["stat"]):
+                unknown.append((canonical_p, canonical_metadata))
+            elif canonical_p in previous_matches:
+                matched.add(canonical_p)
+        return matched, unknown
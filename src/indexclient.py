@@ -0,0 +1,111 @@
+#! /usr/bin/env python3
+"""
+A module to send queries to a resident compareFolders server (compareFolders --serve) over its Unix domain socket.
+"""
+import json
+import socket
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+class IndexClient(object):
+    """
+    A class to hold a connection to a resident compareFolders server. The connection stays open between requests, so
+    a client that asks many questions only pays for the connection once.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self,
+                 socket_path,
+                 timeout=None):
+        """
+        Connects to the server.
+
+        :param socket_path: The path of the server's Unix domain socket.
+        :param timeout: An optional number of seconds to wait for each response before giving up.
+
+        :return: Nothing. Raises an OSError if the server cannot be reached.
+        """
+
+        self.socket_path = socket_path
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout)
+        self._socket.connect(socket_path)
+        self._file = self._socket.makefile("rwb")
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def request(self,
+                request) -> dict:
+        """
+        Sends a single request and waits for its response.
+
+        :param request: The request dictionary.
+
+        :return: The response dictionary. Raises a ConnectionError if the server closes the connection, and a
+                 ValueError if the server answers with an error.
+        """
+
+        self._file.write(json.dumps(request).encode("utf-8") + b"\n")
+        self._file.flush()
+
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError(f"The server closed the connection: {self.socket_path}")
+
+        response = json.loads(line)
+        if "error" in response:
+            raise ValueError(response["error"])
+        return response
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def query(self,
+              paths,
+              batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Asks whether each file is a duplicate of a file in the canonical directory.
+
+        :param paths: An iterable of paths. Relative paths are resolved by the server against its own working
+               directory, so absolute paths should be used.
+        :param batch_size: The number of paths to send in each request. Defaults to DEFAULT_BATCH_SIZE.
+
+        :return: A generator that yields one {"path", "status", "matches"} dictionary per path, in order.
+        """
+
+        batch = list()
+        for path in paths:
+            batch.append(path)
+            if len(batch) >= batch_size:
+                yield from self.request({"command": "query", "paths": batch})["results"]
+                batch = list()
+        if batch:
+            yield from self.request({"command": "query", "paths": batch})["results"]
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def status(self) -> dict:
+        """
+        :return: The server's status dictionary.
+        """
+
+        return self.request({"command": "status"})
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def refresh(self) -> dict:
+        """
+        Asks the server to rescan the canonical directory now, and waits for it to finish.
+
+        :return: The server's status dictionary after the refresh.
+        """
+
+        return self.request({"command": "refresh"})
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def close(self):
+        """
+        Closes the connection.
+
+        :return: Nothing.
+        """
+
+        self._file.close()
+        self._socket.close()
@@ -0,0 +1,189 @@
+#! /usr/bin/env python3
+"""
+A module to keep an append-only journal of the actions taken by deleteFiles, so that an interrupted run can be resumed
+without re-verifying the files it already dealt with.
+"""
+import json
+import os
+import time
+
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_VERSION = 1
+
+FSYNC_RECORD_FREQUENCY = 1000
+FSYNC_SECONDS = 5.0
+
+# Actions after which a record never needs to be looked at again. Errors are journaled too, but are retried on resume.
+COMPLETED_ACTIONS = {"deleted", "renamed", "linked", "missing"}
+
+
+class DeletionJournal(object):
+    """
+    A class to record, one line per record, what deleteFiles did with each duplicate record of a log file. Records are
+    identified by their position in the log, so the journal is only valid for the exact log file it was written for:
+    the size and modification time of the log are stored in the first line of the journal and checked on load.
+
+    Lines are written as soon as each action completes and the file is fsync'ed periodically (and when the journal is
+    closed). If the process dies between an action and its journal line, the record is simply verified again on resume,
+    which finds the query file already gone and skips it.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self,
+                 log_p,
+                 fsync_record_frequency=FSYNC_RECORD_FREQUENCY,
+                 fsync_seconds=FSYNC_SECONDS):
+        """
+        :param log_p: The path to the compareFolders log file. The journal is stored next to it, with JOURNAL_SUFFIX
+               appended to its name.
+        :param fsync_record_frequency: The number of lines to write between fsyncs. Defaults to FSYNC_RECORD_FREQUENCY.
+        :param fsync_seconds: The maximum number of seconds between fsyncs. Defaults to FSYNC_SECONDS.
+
+        :return: Nothing.
+        """
+
+        self.log_p = log_p
+        self.journal_p = f"{log_p}{JOURNAL_SUFFIX}"
+        self.fsync_record_frequency = fsync_record_frequency
+        self.fsync_seconds = fsync_seconds
+
+        self._journal_f = None
+        self._unsynced_records = 0
+        self._last_sync = time.monotonic()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _log_identity(self) -> dict:
+        """
+        :return: A dictionary that identifies the current contents of the log file.
+        """
+
+        stat_result = os.stat(self.log_p)
+        return {"version": JOURNAL_VERSION,
+                "log_size": stat_result.st_size,
+                "log_mtime_ns": stat_result.st_mtime_ns}
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def load(self) -> set:
+        """
+        Reads an existing journal.
+
+        :return: The set of the positions (in the log) of the records that were completed. Empty if there is no
+                 journal, or if it was written for a different version of the log file. A damaged last line (from a
+                 crash in the middle of a write) is ignored.
+        """
+
+        completed = set()
+        if not os.path.exists(self.journal_p):
+            return completed
+
+        with open(self.journal_p, "r", encoding="utf-8", errors="surrogateescape") as journal_f:
+            try:
+                if json.loads(journal_f.readline()) != self._log_identity():
+                    return completed
+            except ValueError:
+                return completed
+
+            for line in journal_f:
+                if not line.endswith("\n"):
+                    break
+                try:
+                    index, action, query_p = line.split("\t", 2)
+                    if action in COMPLETED_ACTIONS:
+                        completed.add(int(index))
+                except ValueError:
+                    continue
+
+        return completed
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def open(self,
+             resume=False):
+        """
+        Opens the journal for writing.
+
+        :param resume: If True, and the existing journal was written for the same log file, new lines are appended to
+               it. Otherwise any existing journal is replaced.
+
+        :return: Nothing.
+        """
+
+        identity = self._log_identity()
+
+        if resume and os.path.exists(self.journal_p):
+            with open(self.journal_p, "r", encoding="utf-8", errors="surrogateescape") as journal_f:
+                try:
+                    resume = json.loads(journal_f.readline()) == identity
+                except ValueError:
+                    resume = False
+
+        if resume and os.path.exists(self.journal_p):
+            self._journal_f = open(self.journal_p, "a", encoding="utf-8", errors="surrogateescape")
+            self._truncate_partial_line()
+        else:
+            self._journal_f = open(self.journal_p, "w", encoding="utf-8", errors="surrogateescape")
+            self._journal_f.write(f"{json.dumps(identity)}\n")
+        self.sync()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _truncate_partial_line(self):
+        """
+        Ends a damaged last line (from a crash in the middle of a write) so new lines start cleanly. The damaged line
+        itself is ignored by load because it does not parse as a complete entry.
+
+        :return: Nothing.
+        """
+
+        if self._journal_f.tell() == 0:
+            return
+        with open(self.journal_p, "rb") as journal_f:
+            journal_f.seek(-1, os.SEEK_END)
+            if journal_f.read(1) != b"\n":
+                self._journal_f.write("\tdamaged\t\n")
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def record(self,
+               index,
+               action,
+               query_p):
+        """
+        Appends a line to the journal.
+
+        :param index: The position of the record in the log file.
+        :param action: What was done: "deleted", "renamed", "linked", "missing" (the query file was already gone), or
+               "error".
+        :param query_p: The path to the query file.
+
+        :return: Nothing.
+        """
+
+        self._journal_f.write(f"{index}\t{action}\t{query_p}\n")
+        self._unsynced_records += 1
+        if (self._unsynced_records >= self.fsync_record_frequency or
+                time.monotonic() - self._last_sync >= self.fsync_seconds):
+            self.sync()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def sync(self):
+        """
+        Flushes the journal and forces it to disk.
+
+        :return: Nothing.
+        """
+
+        self._journal_f.flush()
+        os.fsync(self._journal_f.fileno())
+        self._unsynced_records = 0
+        self._last_sync = time.monotonic()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def close(self):
+        """
+        Flushes and closes the journal.
+
+        :return: Nothing.
+        """
+
+        if self._journal_f is None or self._journal_f.closed:
+            return
+        self.sync()
+        self._journal_f.close()
@@ -0,0 +1,178 @@
+#! /usr/bin/env python3
+"""
+A module to collect performance metrics (counters and timings) from the hot paths of the compareFolders and deleteFiles
+apps, and to write them out as JSON.
+"""
+import collections
+import contextlib
+import datetime
+import json
+import os.path
+import resource
+import socket
+import sys
+import threading
+import time
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def peak_rss_bytes() -> int:
+    """
+    Returns the peak resident memory used by this process so far.
+
+    :return: The peak memory in bytes.
+    """
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        max_rss *= 1024
+    return max_rss
+
+
+class Metrics(object):
+    """
+    A class to accumulate named counters. Counters whose names end in "_seconds" hold accumulated times. All methods
+    may be called from any thread, and do nothing at all until the metrics are enabled, so the instrumentation costs
+    nothing when no metrics were asked for.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self):
+        """
+        :return: Nothing.
+        """
+
+        self.enabled = False
+        self.counters = collections.Counter()
+        self._lock = threading.Lock()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def add(self,
+            name,
+            value=1):
+        """
+        Adds a value to a counter.
+
+        :param name: The name of the counter.
+        :param value: The value to add. Defaults to 1.
+
+        :return: Nothing.
+        """
+
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] += value
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def update(self,
+               values):
+        """
+        Adds several values to their counters at once.
+
+        :param values: A dictionary of values keyed on counter name.
+
+        :return: Nothing.
+        """
+
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters.update(values)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def maximum(self,
+                name,
+                value):
+        """
+        Raises a counter to a value, if the value is larger than the counter.
+
+        :param name: The name of the counter.
+        :param value: The value.
+
+        :return: Nothing.
+        """
+
+        if not self.enabled:
+            return
+        with self._lock:
+            if value > self.counters[name]:
+                self.counters[name] = value
+
+    # ------------------------------------------------------------------------------------------------------------------
+    @contextlib.contextmanager
+    def phase(self,
+              name):
+        """
+        A context manager that adds the wall clock time spent inside it to the "<name>_seconds" counter.
+
+        :param name: The name of the phase.
+
+        :return: Nothing.
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(f"{name}_seconds", time.perf_counter() - start)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def report(self,
+               app_name,
+               extra=None) -> dict:
+        """
+        Builds a report of every counter, along with the rates derived from them.
+
+        :param app_name: The name of the app the metrics were collected by.
+        :param extra: An optional dictionary of additional values to include in the report.
+
+        :return: A dictionary that can be serialized as JSON.
+        """
+
+        with self._lock:
+            counters = dict(self.counters)
+
+        derived = dict()
+        for prefix in ("hash", "partial_hash"):
+            hash_bytes = counters.get(f"{prefix}_bytes", 0)
+            hash_seconds = counters.get(f"{prefix}_seconds", 0)
+            if hash_seconds:
+                derived[f"{prefix}_mb_per_second"] = hash_bytes / hash_seconds / (1024 * 1024)
+
+        report = {"app": app_name,
+                  "host": socket.gethostname(),
+                  "time": datetime.datetime.now().isoformat(timespec="seconds"),
+                  "argv": sys.argv[1:],
+                  "peak_rss_bytes": peak_rss_bytes(),
+                  "counters": counters,
+                  "derived": derived}
+        if extra:
+            report.update(extra)
+        return report
+
+    # ------------------------------------------------------------------------------------------------------------------
+    @staticmethod
+    def write(metrics_p,
+              report):
+        """
+        Writes a report to disk. If the path ends in ".jsonl" the report is appended to the file as a single line, so
+        one file can collect the reports of many runs. Otherwise the file is replaced with the report as indented JSON.
+
+        :param metrics_p: The path to the metrics file.
+        :param report: The report dictionary, as returned by the report method.
+
+        :return: Nothing.
+        """
+
+        if os.path.splitext(metrics_p)[1].lower() == ".jsonl":
+            with open(metrics_p, "a") as metrics_f:
+                metrics_f.write(f"{json.dumps(report, sort_keys=True)}\n")
+        else:
+            with open(metrics_p, "w") as metrics_f:
+                json.dump(report, metrics_f, indent=4, sort_keys=True)
+                metrics_f.write("\n")
+
+
+# The metrics shared by every module of the running app. Disabled until an app enables it.
+registry = Metrics()
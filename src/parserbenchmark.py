@@ -0,0 +1,227 @@
+#! /usr/bin/env python3
+"""
+A module to manage command line parsing for the benchmarkDeDupe command.
+"""
+from argparse import ArgumentParser
+import os.path
+
+from src import checksum
+from src import resultlog
+from src import synthtree
+
+help_msg = f"""
+A program to measure the throughput of the compareFolders and deleteFiles apps reproducibly. It builds a synthetic query
+tree and canonical tree with a controlled shape (file counts, sizes, duplicates, same-size files with different
+contents, nesting, and hidden files), then scans both trees, compares them, and verifies and deletes the duplicates in
+the query tree the same way deleteFiles does. The time, files per second, MB per second, and peak memory of each phase
+are written out as JSON, along with the performance counters collected by the apps.
+
+The trees are read back straight after they are written, so the numbers are for a warm file system cache. Run with a
+--root on the disk you care about, and with the same options and seed, to compare one version of the apps against
+another.
+"""
+
+
+class Parser(object):
+    """
+    A class to manage a single argparse object.
+    """
+
+    # ----------------------------------------------------------------------------------------------------------------------
+    def __init__(self,
+                 commandline_args):
+        """
+        Creates and initializes the parser object for the benchmarkDeDupe command.
+
+        :param commandline_args: The arguments passed on the command line.
+
+        :return: Nothing.
+        """
+
+        self.parser = ArgumentParser(description=help_msg)
+
+        help_str = "The directory to build the synthetic trees in (as \"query\" and \"canonical\" sub-directories, " \
+                   "which must not already exist). The trees are left in place afterwards. If not given, the trees " \
+                   "are built in a temporary directory that is removed when the benchmark ends."
+        self.parser.add_argument("--root",
+                                 dest="root_dir",
+                                 type=str,
+                                 action="store",
+                                 default=None,
+                                 help=help_str)
+
+        help_str = "Keep the temporary directory instead of removing it. Ignored if --root is given."
+        self.parser.add_argument("--keep",
+                                 dest="keep",
+                                 action="store_true",
+                                 help=help_str)
+
+        help_str = "The number of files in the query tree. Defaults to 1000."
+        self.parser.add_argument("--files",
+                                 dest="file_count",
+                                 type=int,
+                                 action="store",
+                                 default=1000,
+                                 help=help_str)
+
+        help_str = "The number of files in the canonical tree. Defaults to the number of query files."
+        self.parser.add_argument("--canonical-files",
+                                 dest="canonical_file_count",
+                                 type=int,
+                                 action="store",
+                                 default=None,
+                                 help=help_str)
+
+        help_str = "The smallest file size, in KiB. Defaults to 1."
+        self.parser.add_argument("--min-size",
+                                 dest="min_size",
+                                 type=int,
+                                 action="store",
+                                 default=1,
+                                 help=help_str)
+
+        help_str = "The largest file size, in KiB. Defaults to 1024."
+        self.parser.add_argument("--max-size",
+                                 dest="max_size",
+                                 type=int,
+                                 action="store",
+                                 default=1024,
+                                 help=help_str)
+
+        help_str = "How file sizes are picked between the smallest and largest size. \"fixed\" makes every file " \
+                   "the largest size (so every file is a size candidate for every other), \"uniform\" picks sizes " \
+                   "evenly, and \"lognormal\" gives mostly small files with a long tail of large ones. Defaults to " \
+                   "lognormal."
+        self.parser.add_argument("--size-distribution",
+                                 dest="size_distribution",
+                                 type=str,
+                                 action="store",
+                                 choices=synthtree.SIZE_DISTRIBUTIONS,
+                                 default="lognormal",
+                                 help=help_str)
+
+        help_str = "The fraction of query files that are exact copies of canonical files. Defaults to 0.5."
+        self.parser.add_argument("--duplicate-ratio",
+                                 dest="duplicate_ratio",
+                                 type=float,
+                                 action="store",
+                                 default=0.5,
+                                 help=help_str)
+
+        help_str = "The fraction of query files that are the same size as a canonical file but have different " \
+                   "contents (a copy with one byte changed at a random offset). Defaults to 0.1."
+        self.parser.add_argument("--same-size-ratio",
+                                 dest="same_size_ratio",
+                                 type=float,
+                                 action="store",
+                                 default=0.1,
+                                 help=help_str)
+
+        help_str = "How many levels of sub-directories each tree has. Defaults to 3."
+        self.parser.add_argument("--depth",
+                                 dest="depth",
+                                 type=int,
+                                 action="store",
+                                 default=3,
+                                 help=help_str)
+
+        help_str = "How many sub-directories each directory has, above the last level. Defaults to 4."
+        self.parser.add_argument("--fan-out",
+                                 dest="fan_out",
+                                 type=int,
+                                 action="store",
+                                 default=4,
+                                 help=help_str)
+
+        help_str = "The fraction of files that are hidden (their names start with a \".\"). Hidden files are " \
+                   "included in the scans. Defaults to 0.05."
+        self.parser.add_argument("--hidden-ratio",
+                                 dest="hidden_ratio",
+                                 type=float,
+                                 action="store",
+                                 default=0.05,
+                                 help=help_str)
+
+        help_str = "The seed for the random number generator. The same seed and options always build the same " \
+                   "trees. Defaults to 0."
+        self.parser.add_argument("--seed",
+                                 dest="seed",
+                                 type=int,
+                                 action="store",
+                                 default=0,
+                                 help=help_str)
+
+        help_str = "The number of worker threads used to compare files and to verify duplicates. Defaults to 1."
+        self.parser.add_argument("-j",
+                                 "--jobs",
+                                 dest="jobs",
+                                 type=int,
+                                 action="store",
+                                 default=1,
+                                 help=help_str)
+
+        help_str = "The number of worker threads used by each of the query and canonical scans. Defaults to 1."
+        self.parser.add_argument("--scan-workers",
+                                 dest="scan_workers",
+                                 type=int,
+                                 action="store",
+                                 default=1,
+                                 help=help_str)
+
+        help_str = "The hash algorithm used for checksums: " + ", ".join(checksum.HASH_ALGORITHMS) + ". Defaults " \
+                   "to md5."
+        self.parser.add_argument("--hash",
+                                 dest="hash_algorithm",
+                                 type=str,
+                                 action="store",
+                                 choices=checksum.HASH_ALGORITHMS,
+                                 default=checksum.DEFAULT_ALGORITHM,
+                                 help=help_str)
+
+        help_str = "The format of the result log written by the compare and read by the delete phase. Defaults to " \
+                   "text."
+        self.parser.add_argument("--log-format",
+                                 dest="log_format",
+                                 type=str,
+                                 action="store",
+                                 choices=resultlog.LOG_FORMATS,
+                                 default="text",
+                                 help=help_str)
+
+        help_str = "Skip the verify and delete phase."
+        self.parser.add_argument("--skip-delete",
+                                 dest="skip_delete",
+                                 action="store_true",
+                                 help=help_str)
+
+        help_str = "Write the results to this file instead of to stdout. If the file name ends in \".jsonl\" the " \
+                   "results are appended as a single line (so one file can collect many runs), otherwise the file " \
+                   "is replaced with indented JSON."
+        self.parser.add_argument("-o",
+                                 "--output",
+                                 dest="output_path",
+                                 type=str,
+                                 action="store",
+                                 default=None,
+                                 help=help_str)
+
+        self.args = self.parser.parse_args(commandline_args)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def validate(self):
+        """
+        Validates that the command line arguments are valid. Raises an appropriate error if any of the checks fail
+        validation.
+
+        :return: Nothing.
+        """
+
+        if self.args.root_dir is not None and os.path.exists(self.args.root_dir):
+            if not os.path.isdir(self.args.root_dir):
+                raise NotADirectoryError(f"Root path is not a directory: {self.args.root_dir}")
+
+        if self.args.file_count < 0:
+            raise ValueError("The number of files may not be negative")
+
+        if self.args.jobs < 1 or self.args.scan_workers < 1:
+            raise ValueError("The number of jobs and scan workers must be at least 1")
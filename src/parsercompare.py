@@ -8,6 +8,12 @@ import sys
 
 from bvzdisplaylib import displaylib as displaylib
 
+from src import checksum
+from src import checksumcache
+from src import resultlog
+from src import server
+from src import session
+
 help_msg = f"""
 A program to compare all of the files in a query directory to the files in a
 canonical directory and list any which are duplicates. The query directory is
@@ -26,6 +32,18 @@ The possible characteristics are listed below. If you do not indicate any
 characteristics using the options provided, then the only thing that is considered
 is whether the contents of the files are identical, regardless of the file name,
 date, or location in the directory structure.
+
+With --self, there is no canonical directory. Instead, the directories given are
+searched for files that are duplicates of each other, and all but one file of
+each set of duplicates are listed.
+
+With --serve, only the canonical directory is given. It is scanned once and
+kept in memory, and other processes send batches of files to compare to it
+over a Unix domain socket.
+
+A large canonical store may be split into shards: --build-shard scans part of
+it (one file system, sub-tree, or host) into an index file, and --shard adds
+any number of those files to the canonical files of a later compare.
 """
 
 
@@ -49,16 +67,14 @@ class Parser(object):
 
         self.parser = ArgumentParser(description=help_msg)
 
-        help_str = "The query directories. You may supply as many directories here as needed."
-        self.parser.add_argument('query_dir',
-                                 metavar='query directories',
-                                 nargs="+",
-                                 type=str,
-                                 help=help_str)
-
-        help_str = "The canonical directory."
-        self.parser.add_argument('canonical_dir',
-                                 metavar='canonical directory',
+        help_str = "The query directories followed by the canonical directory. You may supply as many query " \
+                   "directories as needed. If any --canonical directories or --shard indexes are given, every " \
+                   "directory here is a query directory. With --self, every directory given here is searched for " \
+                   "duplicates of files in any of them, and there is no canonical directory. With --serve and " \
+                   "--build-shard, only canonical directories are given."
+        self.parser.add_argument('dirs',
+                                 metavar='directories',
+                                 nargs="*",
                                  type=str,
                                  help=help_str)
 
@@ -301,8 +317,356 @@ class Parser(object):
                                  action="store_true",
                                  help=help_str)
 
+        help_str = "Run without any prompts or screen output, for use in scripts and pipelines. Every question is " \
+                   "answered yes: an existing output log (or config file) is overwritten, the compare is run, and " \
+                   "scan errors are ignored. Nothing is printed except errors and warnings, which go to stderr, and " \
+                   "the duplicate and unique files are not displayed at the end, so an output log (-o) is required " \
+                   "unless --serve or --build-shard is used."
+        self.parser.add_argument("--yes", "--batch",
+                                 dest="batch",
+                                 action="store_true",
+                                 help=help_str)
+
+        help_str = "The number of KiB read from the start, middle, and end of each candidate file to build a " \
+                   "partial checksum before any full checksum is run. Candidates whose partial checksums differ " \
+                   "from the query file's are eliminated without reading the rest of the file. Files no larger than " \
+                   "three times this size go straight to a full checksum. Set to 0 to disable the partial checksum " \
+                   "stage. Defaults to 64."
+        self.parser.add_argument("--partial-checksum-size",
+                                 dest="partial_checksum_size",
+                                 type=int,
+                                 action="store",
+                                 default=64,
+                                 help=help_str)
+
+        help_str = "The hash algorithm used for checksums: " + ", ".join(checksum.HASH_ALGORITHMS) + ". On fast " \
+                   "storage checksums are limited by how fast the data can be hashed rather than read, and blake2b " \
+                   "(or, if the xxhash package is installed, the much faster non-cryptographic xxh3_64 and " \
+                   "xxh3_128) can be considerably faster than md5. The algorithm is recorded in the output log so " \
+                   "that deleteFiles verifies with the same one. Checksums in the checksum cache and canonical " \
+                   "index are kept per algorithm. Defaults to md5."
+        self.parser.add_argument("--hash",
+                                 dest="hash_algorithm",
+                                 type=str,
+                                 action="store",
+                                 choices=checksum.HASH_ALGORITHMS,
+                                 default=checksum.DEFAULT_ALGORITHM,
+                                 help=help_str)
+
+        help_str = "The number of worker threads used to compare files. Checksums of several files are computed " \
+                   "at the same time, which can be much faster on fast storage (SSD, NVMe, or RAID arrays) and on " \
+                   "machines with many cores. Results are identical regardless of the number of workers. Defaults " \
+                   "to 1."
+        self.parser.add_argument("-j",
+                                 "--jobs",
+                                 dest="jobs",
+                                 type=int,
+                                 action="store",
+                                 default=1,
+                                 help=help_str)
+
+        help_str = "The number of worker threads used to enumerate directories in each of the query and canonical " \
+                   "scans. On network mounts and trees with many small directories, the scan is dominated by the " \
+                   "latency of each directory listing and stat call, and several workers can hide that latency. " \
+                   "Defaults to 1."
+        self.parser.add_argument("--scan-workers",
+                                 dest="scan_workers",
+                                 type=int,
+                                 action="store",
+                                 default=1,
+                                 help=help_str)
+
+        help_str = "Read the files that need checksums in the order they are laid out on disk (by device, then by " \
+                   "physical offset where the file system reports it, then by inode) instead of in scan order. The " \
+                   "checksums needed by each batch of query files are worked out from sizes and metadata first, " \
+                   "then read device by device. On spinning disks this turns seek-bound reads into near-sequential " \
+                   "ones. Results are identical either way. -j is not used for the compare with this option; see " \
+                   "--device-workers."
+        self.parser.add_argument("--io-schedule",
+                                 dest="io_schedule",
+                                 action="store_true",
+                                 help=help_str)
+
+        help_str = "With --io-schedule, the number of worker threads that read from each device at the same time. " \
+                   "Different devices are always read in parallel. Keep this at 1 for spinning disks; solid state " \
+                   "devices and RAID arrays may be faster with more. Defaults to 1."
+        self.parser.add_argument("--device-workers",
+                                 dest="device_workers",
+                                 type=int,
+                                 action="store",
+                                 default=1,
+                                 help=help_str)
+
+        help_str = "The largest number of candidates a file is compared to byte by byte rather than by checksum. " \
+                   "A byte by byte compare stops reading at the first difference, so it is faster for a small group " \
+                   "of candidates whose checksums are not known yet. Larger groups are checksummed, since each " \
+                   "candidate's checksum is then reused for every other file it is a candidate for. Set to 0 to " \
+                   "always use checksums. Defaults to 2."
+        self.parser.add_argument("--byte-compare-max",
+                                 dest="byte_compare_max",
+                                 type=int,
+                                 action="store",
+                                 default=2,
+                                 help=help_str)
+
+        help_str = "Scan the query directories and the canonical directory at the same time instead of one after " \
+                   "the other."
+        self.parser.add_argument("--concurrent-scan",
+                                 dest="concurrent_scan",
+                                 action="store_true",
+                                 help=help_str)
+
+        help_str = "Save the canonical scan (paths, sizes, modification times, inodes, and checksums) to this " \
+                   "index file. If the index already exists and was built with the same canonical scan settings, " \
+                   "only the canonical directories whose modification times have changed since the index was saved " \
+                   "are scanned again, and the stored checksums are reused. Note that a file that is modified in " \
+                   "place does not change the modification time of its directory, so it keeps the size stored in " \
+                   "the index until its directory changes: it may be missed as a candidate for a query file of its " \
+                   "new size. Files in unchanged directories are only stat'ed once they are compared, and a file " \
+                   "whose size, modification time, or status change time no longer match the index is read again " \
+                   "rather than matched on its stored checksum. Delete the index to force a full rescan."
+        self.parser.add_argument("--canonical-index",
+                                 dest="canonical_index_path",
+                                 type=str,
+                                 action="store",
+                                 default=None,
+                                 help=help_str)
+
+        help_str = "A canonical directory. May be given more than once to compare against several canonical " \
+                   "directories (on different file systems, for example) at the same time. When used, every " \
+                   "directory given without an option is a query directory."
+        self.parser.add_argument("--canonical",
+                                 dest="canonical_dirs",
+                                 type=str,
+                                 action="append",
+                                 default=None,
+                                 help=help_str)
+
+        help_str = "A canonical index shard, built by --build-shard, whose files are added to the canonical files. " \
+                   "May be given more than once. The shards (and any canonical directories) are merged into a " \
+                   "single set of canonical files, and the result does not depend on the order they are given in. " \
+                   "A shard is a snapshot of its directories when it was built. Any checksums it holds are reused " \
+                   "(if they were made with the same hash algorithm) so its files need not be read at all, which " \
+                   "also makes it possible to compare against shards built on other hosts. deleteFiles always " \
+                   "checks the files again before deleting anything."
+        self.parser.add_argument("--shard",
+                                 dest="shard_paths",
+                                 type=str,
+                                 action="append",
+                                 default=None,
+                                 help=help_str)
+
+        help_str = "Do not compare anything. Instead, scan the given canonical directories and save them as a " \
+                   "canonical index shard in this file, to be used later with --shard. Build one shard per file " \
+                   "system, sub-tree, or host, in parallel on as many machines as needed. The canonical scan " \
+                   "options apply. If the shard already exists and was built with the same options, only the " \
+                   "directories that have changed since are scanned again. See also --shard-checksums."
+        self.parser.add_argument("--build-shard",
+                                 dest="build_shard_path",
+                                 type=str,
+                                 action="store",
+                                 default=None,
+                                 help=help_str)
+
+        help_str = "With --build-shard, compute and store the full checksum of every file in the shard (on -j " \
+                   "worker threads). This reads every file once, but a compare against the shard then never reads " \
+                   "its files."
+        self.parser.add_argument("--shard-checksums",
+                                 dest="shard_checksums",
+                                 action="store_true",
+                                 help=help_str)
+
+        help_str = "The format of the output log (-o). \"text\" writes one line per record. \"binary\" writes " \
+                   "length-prefixed, compressed blocks of records that are much smaller on disk and faster for " \
+                   "deleteFiles to read. deleteFiles reads either format. Defaults to text."
+        self.parser.add_argument("--log-format",
+                                 dest="log_format",
+                                 type=str,
+                                 action="store",
+                                 choices=resultlog.LOG_FORMATS,
+                                 default="text",
+                                 help=help_str)
+
+        help_str = "Only compare what has changed since a previous compare, given its output log (-o). Query files " \
+                   "that have not been modified, moved, or renamed since the previous compare started keep their " \
+                   "previous results, and are only compared to the canonical files that have changed since. Every " \
+                   "other query file is compared as usual. The new output log is complete, so it can be given to " \
+                   "--since on the next run (it may be the same file). The previous compare must have used the same " \
+                   "directories, comparison options, and hash algorithm, and should have used the same scan options."
+        self.parser.add_argument("--since",
+                                 dest="since_log_path",
+                                 type=str,
+                                 action="store",
+                                 default=None,
+                                 help=help_str)
+
+        help_str = "Keep the memory used by the scans and the compare under about this many megabytes, for trees " \
+                   "with more files than fit in memory. The query and canonical scans each write their files to " \
+                   "sorted run files on disk (see --spill-dir) whenever they reach half of this, and the compare " \
+                   "reads both back in order of file size, holding only the canonical files of one size in memory " \
+                   "at a time. Results are written to the output log in order of file size. Needs -o, and may not " \
+                   "be used with --self, --serve, --build-shard, --shard, --canonical-index, --since, or " \
+                   "--io-schedule."
+        self.parser.add_argument("--max-memory",
+                                 dest="max_memory",
+                                 type=int,
+                                 action="store",
+                                 default=None,
+                                 help=help_str)
+
+        help_str = "With --max-memory, the directory the sorted run files are written to. It needs room for about " \
+                   "one hundred bytes plus the length of the path for every file scanned. The run files are deleted " \
+                   "when the compare ends. Defaults to the system's temporary directory."
+        self.parser.add_argument("--spill-dir",
+                                 dest="spill_dir",
+                                 type=str,
+                                 action="store",
+                                 default=None,
+                                 help=help_str)
+
+        help_str = "Write performance metrics for this run to this file: time spent enumerating directories, " \
+                   "stat'ing and filtering files, bytes hashed and hash throughput, time spent waiting on reads, " \
+                   "candidate counts per query file, and the wall clock time of each phase. If the file name ends in " \
+                   "\".jsonl\" the metrics are appended as a single line (so one file can collect many runs), " \
+                   "otherwise the file is replaced with indented JSON."
+        self.parser.add_argument("--metrics",
+                                 dest="metrics_path",
+                                 type=str,
+                                 action="store",
+                                 default=None,
+                                 help=help_str)
+
+        help_str = "Profile the run with cProfile and write one .pstats file per phase (query scan, canonical " \
+                   "scan, compare, log write, and canonical index save) to this directory, then print the functions " \
+                   "that took the most time in each phase. Work done on worker threads is included."
+        self.parser.add_argument("--profile",
+                                 dest="profile_dir",
+                                 type=str,
+                                 action="store",
+                                 default=None,
+                                 help=help_str)
+
+        help_str = "The path to the persistent checksum cache. Checksums of files that have not changed (same " \
+                   "device, inode, size, and modification time) since they were last checksummed are read from this " \
+                   "cache instead of from the files themselves. The cache is shared with the deleteFiles app. " \
+                   f"Defaults to {checksumcache.DEFAULT_CACHE_PATH}"
+        self.parser.add_argument("--checksum-cache",
+                                 dest="checksum_cache_path",
+                                 type=str,
+                                 action="store",
+                                 default=checksumcache.DEFAULT_CACHE_PATH,
+                                 help=help_str)
+
+        help_str = "Do not read from or write to the persistent checksum cache."
+        self.parser.add_argument("--no-checksum-cache",
+                                 dest="no_checksum_cache",
+                                 action="store_true",
+                                 help=help_str)
+
+        help_str = "Find the duplicates within the given directories instead of comparing query directories to a " \
+                   "canonical directory. Files are grouped by size, then by the metadata checks requested, then by " \
+                   "partial checksum, and then by full checksum, so each file is read at most once per stage no " \
+                   "matter how many other files it is the same size as. Each group of identical files left at the " \
+                   "end is a cluster: one file of each cluster is kept (see --keep) and the others are listed as " \
+                   "duplicates of it, in the same log format as a normal compare, so that the log can be passed " \
+                   "straight to deleteFiles. The canonical scan options and --canonical-index are ignored."
+        self.parser.add_argument("--self",
+                                 dest="self_compare",
+                                 action="store_true",
+                                 help=help_str)
+
+        help_str = "With --self, how the file to keep is picked from each cluster of identical files. \"first\" " \
+                   "keeps the file under the earliest directory given on the command line, \"oldest\" and " \
+                   "\"newest\" go by modification time, and \"shortest\" and \"longest\" by the length of the " \
+                   "path. Ties are broken by path. Defaults to first."
+        self.parser.add_argument("--keep",
+                                 dest="keeper_rule",
+                                 type=str,
+                                 action="store",
+                                 choices=session.KEEPER_RULES,
+                                 default="first",
+                                 help=help_str)
+
+        help_str = "Do not compare any query directories. Instead, scan the canonical directory (the only " \
+                   "directory given) once, keep it in memory, and answer queries from other processes on this Unix " \
+                   "domain socket until interrupted. Each query is a batch of file paths, and each file is compared " \
+                   "to the canonical files with the comparison options given here, so a lookup takes milliseconds " \
+                   "instead of a full scan. The queryIndex app is a small client. See also --refresh-seconds."
+        self.parser.add_argument("--serve",
+                                 dest="serve_socket",
+                                 type=str,
+                                 action="store",
+                                 default=None,
+                                 help=help_str)
+
+        help_str = "With --serve, how many seconds to wait between rescans of the canonical directory. Only the " \
+                   "directories whose modification times have changed are enumerated again, and checksums of files " \
+                   "that have not changed are kept. Note that a file that is modified in place does not change the " \
+                   "modification time of its directory. Set to 0 to only rescan when a client asks for it. " \
+                   f"Defaults to {server.DEFAULT_REFRESH_SECONDS}."
+        self.parser.add_argument("--refresh-seconds",
+                                 dest="refresh_seconds",
+                                 type=int,
+                                 action="store",
+                                 default=server.DEFAULT_REFRESH_SECONDS,
+                                 help=help_str)
+
         self.args = self.parser.parse_args(commandline_args)
 
+        self.args.shard_paths = self.args.shard_paths or list()
+        canonical_dirs = self.args.canonical_dirs or list()
+
+        if self.args.since_log_path is not None:
+            if self.args.self_compare or self.args.serve_socket is not None or self.args.build_shard_path is not None:
+                self.parser.error("--since may not be used with --self, --serve, or --build-shard")
+
+        if self.args.batch and self.args.output_file is None:
+            if self.args.serve_socket is None and self.args.build_shard_path is None:
+                self.parser.error("--batch needs an output log (-o)")
+
+        if self.args.max_memory is not None:
+            if (self.args.self_compare or self.args.serve_socket is not None or self.args.build_shard_path is not None
+                    or self.args.shard_paths or self.args.canonical_index_path is not None
+                    or self.args.since_log_path is not None or self.args.io_schedule):
+                self.parser.error("--max-memory may not be used with --self, --serve, --build-shard, --shard, "
+                                  "--canonical-index, --since, or --io-schedule")
+            if self.args.max_memory <= 0:
+                self.parser.error("--max-memory must be a positive number of megabytes")
+            if self.args.output_file is None:
+                self.parser.error("--max-memory needs an output log (-o)")
+
+        if self.args.build_shard_path is not None:
+            if self.args.self_compare or self.args.serve_socket is not None or self.args.shard_paths:
+                self.parser.error("--build-shard may not be used with --self, --serve, or --shard")
+            self.args.query_dir = list()
+            self.args.canonical_dirs = self.args.dirs + canonical_dirs
+            if not self.args.canonical_dirs:
+                self.parser.error("--build-shard needs at least one canonical directory")
+        elif self.args.serve_socket is not None:
+            if self.args.self_compare:
+                self.parser.error("--serve may not be used with --self")
+            self.args.query_dir = list()
+            self.args.canonical_dirs = self.args.dirs + canonical_dirs
+            if not self.args.canonical_dirs and not self.args.shard_paths:
+                self.parser.error("--serve needs a canonical directory or a shard")
+        elif self.args.self_compare:
+            if canonical_dirs or self.args.shard_paths:
+                self.parser.error("--self may not be used with --canonical or --shard")
+            if not self.args.dirs:
+                self.parser.error("--self needs at least one directory")
+            self.args.query_dir = self.args.dirs
+            self.args.canonical_dirs = list()
+        elif canonical_dirs or self.args.shard_paths:
+            if not self.args.dirs:
+                self.parser.error("at least one query directory is required")
+            self.args.query_dir = self.args.dirs
+            self.args.canonical_dirs = canonical_dirs
+        elif len(self.args.dirs) < 2:
+            self.parser.error("at least one query directory and a canonical directory are required (or use --self)")
+        else:
+            self.args.query_dir = self.args.dirs[:-1]
+            self.args.canonical_dirs = self.args.dirs[-1:]
+
     # ------------------------------------------------------------------------------------------------------------------
     def validate(self):
         """
@@ -343,7 +707,7 @@ class Parser(object):
 
         if self.args.output_file is not None:
 
-            if os.path.exists(self.args.output_file):
+            if os.path.exists(self.args.output_file) and not self.args.batch:
                 yes = "{{BRIGHT_YELLOW}}Y{{COLOR_NONE}}es"
                 no = "{{BRIGHT_YELLOW}}N{{COLOR_NONE}}o"
                 quitapp = "{{BRIGHT_YELLOW}}Q{{COLOR_NONE}}uit"
@@ -5,6 +5,9 @@ A module to manage command line parsing for the deleteDuplicates command.
 from argparse import ArgumentParser
 import os.path
 
+from src import checksum
+from src import checksumcache
+
 help_msg = f"""
 CA program to delete files that were identified as duplicates by the compareFolders app. The deleteFiles app requires
 that the compareFolders app be run first using the -o (output file) option. That output file (which lists
@@ -53,6 +56,23 @@ class Parser(object):
                                  action="store_true",
                                  help=help_str)
 
+        help_str = "Always verify duplicates by checksum. By default, a duplicate whose canonical file's checksum " \
+                   "is not known yet (from an earlier duplicate of the same file, or from the checksum cache) is " \
+                   "compared to it byte by byte instead, which stops reading both files at the first difference."
+        self.parser.add_argument("--no-byte-compare",
+                                 dest="no_byte_compare",
+                                 action="store_true",
+                                 help=help_str)
+
+        help_str = "Run without any prompts or screen output, for use in scripts and pipelines. The files are " \
+                   "deleted (or renamed, or linked) without asking first, and no progress, summary, or trial " \
+                   "commands are printed. Errors and warnings are written to stderr. Files that could not be dealt " \
+                   "with are listed in the error file as usual, and its path is written to stderr."
+        self.parser.add_argument("--yes", "--batch",
+                                 dest="batch",
+                                 action="store_true",
+                                 help=help_str)
+
         help_str = "Rename files instead of deleting them. A prefix of \"compareFoldersPendingDelete_\" will be " \
                    "added to the beginning of each file that would otherwise be deleted."
         self.parser.add_argument("-R",
@@ -60,6 +80,27 @@ class Parser(object):
                                  action="store_true",
                                  help=help_str)
 
+        help_str = "Replace files with hard links to their canonical files instead of deleting them. This reclaims " \
+                   "the same space as deleting, but every query path keeps working. The query and canonical files " \
+                   "must be on the same file system. Each link is created under a temporary name and renamed over " \
+                   "the query file, so the query path never goes missing. Note that the linked path takes on the " \
+                   "permissions, owner, and modification time of the canonical file. Files that are already hard " \
+                   "links to their canonical file are left alone. May not be combined with -R."
+        self.parser.add_argument("--hardlink",
+                                 dest="hardlink",
+                                 action="store_true",
+                                 help=help_str)
+
+        help_str = "The hash algorithm used to verify duplicates: " + ", ".join(checksum.HASH_ALGORITHMS) + ". " \
+                   "Defaults to the algorithm recorded in the log file (md5 for logs that do not record one)."
+        self.parser.add_argument("--hash",
+                                 dest="hash_algorithm",
+                                 type=str,
+                                 action="store",
+                                 choices=checksum.HASH_ALGORITHMS,
+                                 default=None,
+                                 help=help_str)
+
         help_str = "Trial run. This will print out any actions that would have been taken (deleting or renaming) " \
                    "instead of actually renaming or deleting any files. Use the -q option to force the trial to run " \
                    "without printing out any commands."
@@ -75,6 +116,67 @@ class Parser(object):
                                  action="store_true",
                                  help=help_str)
 
+        help_str = "The number of worker threads used to verify duplicates (metadata checks and checksums) before " \
+                   "they are deleted or renamed. The checksum of each canonical file is only computed once, however " \
+                   "many query files it matches. Files are still deleted or renamed one at a time, in log order. " \
+                   "Defaults to 1."
+        self.parser.add_argument("-j",
+                                 "--jobs",
+                                 dest="jobs",
+                                 type=int,
+                                 action="store",
+                                 default=1,
+                                 help=help_str)
+
+        help_str = "Resume an interrupted run. Every delete or rename is recorded in a journal next to the log file " \
+                   "(the log file name with \".journal\" appended). With this option, duplicates that the journal " \
+                   "lists as already deleted, renamed, linked, or missing are skipped without being checked again. " \
+                   "Duplicates that failed with an error are retried. The journal is ignored if the log file has " \
+                   "changed since it was written."
+        self.parser.add_argument("--resume",
+                                 dest="resume",
+                                 action="store_true",
+                                 help=help_str)
+
+        help_str = "Write performance metrics for this run to this file: time spent verifying duplicates, bytes " \
+                   "hashed and hash throughput, time spent waiting on reads, time spent deleting or renaming, and " \
+                   "the wall clock time of each phase. If the file name ends in " \
+                   "\".jsonl\" the metrics are appended as a single line (so one file can collect many runs), " \
+                   "otherwise the file is replaced with indented JSON."
+        self.parser.add_argument("--metrics",
+                                 dest="metrics_path",
+                                 type=str,
+                                 action="store",
+                                 default=None,
+                                 help=help_str)
+
+        help_str = "Profile the run with cProfile and write one .pstats file per phase (reading the log, and " \
+                   "verifying and deleting or renaming the duplicates) to this directory, then print the functions " \
+                   "that took the most time in each phase. Work done on worker threads is included."
+        self.parser.add_argument("--profile",
+                                 dest="profile_dir",
+                                 type=str,
+                                 action="store",
+                                 default=None,
+                                 help=help_str)
+
+        help_str = "The path to the persistent checksum cache. Checksums of files that have not changed (same " \
+                   "device, inode, size, and modification time) since they were last checksummed are read from this " \
+                   "cache instead of from the files themselves. The cache is shared with the compareFolders app. " \
+                   f"Defaults to {checksumcache.DEFAULT_CACHE_PATH}"
+        self.parser.add_argument("--checksum-cache",
+                                 dest="checksum_cache_path",
+                                 type=str,
+                                 action="store",
+                                 default=checksumcache.DEFAULT_CACHE_PATH,
+                                 help=help_str)
+
+        help_str = "Do not read from or write to the persistent checksum cache."
+        self.parser.add_argument("--no-checksum-cache",
+                                 dest="no_checksum_cache",
+                                 action="store_true",
+                                 help=help_str)
+
         self.args = self.parser.parse_args(commandline_args)
 
     # ------------------------------------------------------------------------------------------------------------------
@@ -94,3 +196,6 @@ class Parser(object):
 
         if os.path.islink(self.args.log_file):
             raise FileNotFoundError(f"Log file path is actually a symlink: {self.args.log_file}")
+
+        if self.args.hardlink and self.args.rename:
+            raise ValueError("The --hardlink and -R options may not be used together")
@@ -0,0 +1,95 @@
+#! /usr/bin/env python3
+"""
+A module to manage command line parsing for the queryIndex command.
+"""
+from argparse import ArgumentParser
+
+from src import indexclient
+
+help_msg = f"""
+A small client for a resident compareFolders server (started with compareFolders --serve). Sends a batch of files to
+the server and prints, for each file, whether it is a duplicate of a file in the server's canonical directory. Each
+result is printed on its own line as the status (D for a duplicate, U for unique, or SE if the file could not be read),
+the path, and the paths of any canonical files it duplicates, separated by tabs.
+"""
+
+
+class Parser(object):
+    """
+    A class to manage a single argparse object.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self,
+                 commandline_args):
+        """
+        Creates and initializes the parser object for the queryIndex command.
+
+        :param commandline_args: The arguments passed on the command line.
+
+        :return: Nothing.
+        """
+
+        self.parser = ArgumentParser(description=help_msg)
+
+        help_str = "The path of the server's Unix domain socket."
+        self.parser.add_argument("socket_path",
+                                 metavar="socket",
+                                 type=str,
+                                 help=help_str)
+
+        help_str = "The files to look up. If none are given, one path per line is read from stdin."
+        self.parser.add_argument("paths",
+                                 metavar="files",
+                                 nargs="*",
+                                 type=str,
+                                 help=help_str)
+
+        help_str = "Print the server's status instead of looking up any files."
+        self.parser.add_argument("--status",
+                                 dest="status",
+                                 action="store_true",
+                                 help=help_str)
+
+        help_str = "Ask the server to rescan its canonical directory before looking up any files."
+        self.parser.add_argument("--refresh",
+                                 dest="refresh",
+                                 action="store_true",
+                                 help=help_str)
+
+        help_str = "Print each result as a line of JSON instead of tab separated text."
+        self.parser.add_argument("--json",
+                                 dest="json",
+                                 action="store_true",
+                                 help=help_str)
+
+        help_str = f"The number of files to send to the server in each request. Defaults to " \
+                   f"{indexclient.DEFAULT_BATCH_SIZE}."
+        self.parser.add_argument("--batch-size",
+                                 dest="batch_size",
+                                 type=int,
+                                 action="store",
+                                 default=indexclient.DEFAULT_BATCH_SIZE,
+                                 help=help_str)
+
+        help_str = "The number of seconds to wait for each response before giving up. Defaults to waiting forever."
+        self.parser.add_argument("--timeout",
+                                 dest="timeout",
+                                 type=float,
+                                 action="store",
+                                 default=None,
+                                 help=help_str)
+
+        self.args = self.parser.parse_intermixed_args(commandline_args)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def validate(self):
+        """
+        Validates that the command line arguments are valid. Raises an appropriate error if any of the checks fail
+        validation.
+
+        :return: Nothing.
+        """
+
+        if self.args.batch_size < 1:
+            raise ValueError("The batch size must be at least 1")
@@ -0,0 +1,165 @@
+#! /usr/bin/env python3
+"""
+A module to profile the phases of the compareFolders and deleteFiles apps with cProfile, writing one .pstats file per
+phase and summarizing the hottest functions of each.
+"""
+import contextlib
+import cProfile
+import functools
+import os
+import pstats
+import sys
+import threading
+
+TOP_N = 15
+
+# From Python 3.12, cProfile hooks into sys.monitoring, which sees every thread in the process, and only one profiler
+# may be active at a time. Work on worker threads is then already in the stats of the phase.
+PROFILES_ALL_THREADS = sys.version_info >= (3, 12)
+
+
+class Profiler(object):
+    """
+    A class to run each phase of an app under its own cProfile profiler. Each phase is written to "<name>.pstats" in the
+    profile directory as soon as it ends (even if it ends with an error or an interrupt), so the files can be loaded
+    into pstats, snakeviz, etc. Phases must not be nested.
+
+    Before Python 3.12, cProfile only sees the thread it was started on, so work handed to worker threads (the scan
+    workers, and the compare and verification jobs) must be wrapped with the wrap method. Each wrapped call is profiled
+    on its own thread and merged into the stats of the phase it was wrapped in. From Python 3.12 the phase's profiler
+    sees every thread, so wrap leaves the callable as it is.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self):
+        """
+        :return: Nothing.
+        """
+
+        self.profile_d = None
+        self.stats_paths = list()
+
+        self._thread_profiles = None
+        self._lock = threading.Lock()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    @property
+    def enabled(self) -> bool:
+        """
+        :return: True if a profile directory has been set.
+        """
+
+        return self.profile_d is not None
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def start(self,
+              profile_d):
+        """
+        Turns profiling on, creating the profile directory if needed.
+
+        :param profile_d: The directory to write the .pstats files to. If None, profiling stays off.
+
+        :return: Nothing.
+        """
+
+        if profile_d is None:
+            return
+        os.makedirs(profile_d, exist_ok=True)
+        self.profile_d = profile_d
+
+    # ------------------------------------------------------------------------------------------------------------------
+    @contextlib.contextmanager
+    def phase(self,
+              name):
+        """
+        A context manager that profiles the code run inside it, if profiling is on.
+
+        :param name: The name of the phase. Used as the name of the .pstats file.
+
+        :return: Nothing.
+        """
+
+        if not self.enabled:
+            yield
+            return
+
+        thread_profiles = list()
+        self._thread_profiles = thread_profiles
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self._thread_profiles = None
+
+            stats = pstats.Stats(profiler)
+            with self._lock:
+                for thread_profile in thread_profiles:
+                    stats.add(thread_profile)
+            stats_p = os.path.join(self.profile_d, f"{name}.pstats")
+            stats.dump_stats(stats_p)
+            self.stats_paths.append((name, stats_p))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def wrap(self,
+             target):
+        """
+        Wraps a callable that will be run on another thread, so that the time spent in it is profiled as part of the
+        current phase. If no phase is being profiled, or the phase's profiler already sees every thread, the callable is
+        returned as is.
+
+        :param target: The callable.
+
+        :return: The wrapped callable.
+        """
+
+        thread_profiles = self._thread_profiles
+        if thread_profiles is None or PROFILES_ALL_THREADS:
+            return target
+
+        @functools.wraps(target)
+        def profiled(*args, **kwargs):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiler is already active, and failing here would lose the work itself, not just its stats.
+                return target(*args, **kwargs)
+            try:
+                return target(*args, **kwargs)
+            finally:
+                profiler.disable()
+                with self._lock:
+                    thread_profiles.append(profiler)
+
+        return profiled
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def summary(self,
+                top_n=TOP_N) -> list:
+        """
+        Builds a short summary of the functions that took the most time in each profiled phase.
+
+        :param top_n: The number of functions to list for each phase. Defaults to TOP_N.
+
+        :return: A list of lines of text.
+        """
+
+        lines = list()
+        for name, stats_p in self.stats_paths:
+            stats = pstats.Stats(stats_p)
+            lines.append(f"{name}: {stats.total_tt:.3f} seconds ({stats_p})")
+            lines.append(f"    {'own secs':>10} {'cum secs':>10} {'calls':>10}  function")
+
+            entries = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)
+            for func, (primitive_calls, calls, own_time, cumulative_time, callers) in entries[:top_n]:
+                lines.append(f"    {own_time:10.3f} {cumulative_time:10.3f} {calls:10}  {pstats.func_std_string(func)}")
+            lines.append("")
+
+        return lines
+
+
+# The profiler shared by every module of the running app. Off until an app starts it.
+profiler = Profiler()
@@ -0,0 +1,175 @@
+#! /usr/bin/env python3
+"""
+A module to track the progress of a long running operation (a scan, a compare, or a delete) in files and bytes, estimate
+how long is left from the recent throughput, and decide when a progress message is worth drawing.
+
+Progress is updated as often as the operation likes, but only reports that it is due to be drawn once every interval
+seconds, so the cost of formatting and drawing a message does not grow with the number of files.
+"""
+import datetime
+import time
+
+DEFAULT_INTERVAL = 0.25
+
+# How much weight the throughput measured since the last render gets against the running estimate. Lower values give a
+# steadier estimate that is slower to follow a change in speed (for example, from many small files to a few huge ones).
+RATE_SMOOTHING = 0.3
+
+_BYTE_UNITS = ["B", "KB", "MB", "GB", "TB", "PB"]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def format_bytes(num_bytes) -> str:
+    """
+    :param num_bytes: A number of bytes.
+
+    :return: The number of bytes as a short, human readable string (for example "1.5 GB").
+    """
+
+    value = float(num_bytes)
+    for unit in _BYTE_UNITS[:-1]:
+        if abs(value) < 1024:
+            return f"{value:.0f} {unit}" if unit == "B" else f"{value:.1f} {unit}"
+        value /= 1024
+    return f"{value:.1f} {_BYTE_UNITS[-1]}"
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def format_duration(seconds) -> str:
+    """
+    :param seconds: A number of seconds.
+
+    :return: The duration as hours, minutes, and seconds (for example "1:02:03").
+    """
+
+    return str(datetime.timedelta(seconds=int(round(seconds))))
+
+
+class Progress(object):
+    """
+    A class to track how many files and bytes of an operation have been done, out of an optional total of each.
+
+    The ETA is based on bytes whenever a total number of bytes is known (a few huge files dominate the time of most
+    compares far more than the number of files does), and on files otherwise. The throughput is a moving average of the
+    rate measured between renders, so the estimate follows changes in speed without jumping around on every render.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self,
+                 total_files=None,
+                 total_bytes=None,
+                 interval=DEFAULT_INTERVAL):
+        """
+        :param total_files: The total number of files the operation will process, if known.
+        :param total_bytes: The total number of bytes the operation will process, if known.
+        :param interval: The minimum number of seconds between renders. Defaults to DEFAULT_INTERVAL.
+
+        :return: Nothing.
+        """
+
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.interval = interval
+
+        self.files = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+
+        self.files_per_second = None
+        self.bytes_per_second = None
+
+        self._last_render = None
+        self._last_time = self.started
+        self._last_files = 0
+        self._last_bytes = 0
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def update(self,
+               files,
+               num_bytes=None) -> bool:
+        """
+        Records how much of the operation has been done so far. Cheap enough to call for every file.
+
+        :param files: The number of files done so far.
+        :param num_bytes: The number of bytes done so far, if known.
+
+        :return: True if a progress message is due to be drawn (the first update, and then at most one every interval
+                 seconds). False otherwise.
+        """
+
+        self.files = files
+        if num_bytes is not None:
+            self.bytes = num_bytes
+
+        now = time.monotonic()
+        if self._last_render is not None and now - self._last_render < self.interval:
+            return False
+
+        self._update_rates(now)
+        self._last_render = now
+        return True
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _update_rates(self,
+                      now):
+        """
+        Folds the throughput measured since the last render into the moving averages.
+
+        :param now: The current time, from time.monotonic.
+
+        :return: Nothing.
+        """
+
+        elapsed = now - self._last_time
+        if elapsed <= 0:
+            return
+
+        files_rate = (self.files - self._last_files) / elapsed
+        bytes_rate = (self.bytes - self._last_bytes) / elapsed
+        if self.files_per_second is None:
+            self.files_per_second = files_rate
+            self.bytes_per_second = bytes_rate
+        else:
+            self.files_per_second += RATE_SMOOTHING * (files_rate - self.files_per_second)
+            self.bytes_per_second += RATE_SMOOTHING * (bytes_rate - self.bytes_per_second)
+
+        self._last_time = now
+        self._last_files = self.files
+        self._last_bytes = self.bytes
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def eta_seconds(self):
+        """
+        :return: The estimated number of seconds left, or None if there is no total to measure against or no throughput
+                 measured yet.
+        """
+
+        if self.total_bytes and self.bytes_per_second:
+            return max(self.total_bytes - self.bytes, 0) / self.bytes_per_second
+        if self.total_files and self.files_per_second:
+            return max(self.total_files - self.files, 0) / self.files_per_second
+        return None
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def status_str(self) -> str:
+        """
+        :return: A short description of the progress: the bytes done (out of the total, if known), the throughput (in
+                 the same units as the ETA), and the ETA, leaving out whatever is not known.
+        """
+
+        parts = list()
+        if self.total_bytes:
+            parts.append(f"{format_bytes(self.bytes)} of {format_bytes(self.total_bytes)}")
+        elif self.bytes:
+            parts.append(format_bytes(self.bytes))
+
+        if self.total_bytes and self.bytes_per_second:
+            parts.append(f"{format_bytes(self.bytes_per_second)}/s")
+        elif self.files_per_second:
+            parts.append(f"{self.files_per_second:.0f} files/s")
+
+        eta = self.eta_seconds()
+        if eta is not None:
+            parts.append(f"ETA {format_duration(eta)}")
+
+        return ", ".join(parts)
@@ -0,0 +1,90 @@
+#! /usr/bin/env python3
+"""
+A module to stand in for displaylib when an app runs in batch mode (--batch), so nothing is drawn to the screen.
+
+Progress messages are dropped without being formatted, and other messages are dropped too, unless they start with an
+error or warning label: those are still written, without colors, to stderr, so a pipeline can log why an app failed
+(along with its exit code). Apps skip their prompts in batch mode, so asking a question is a bug and raises an error
+rather than waiting for an answer that will never come.
+"""
+import sys
+
+_LABELS = ("error:", "warning:")
+
+
+class QuietDisplay(object):
+    """
+    A class with the same display functions as displaylib, that draws nothing but errors and warnings.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self,
+                 display_module):
+        """
+        :param display_module: The displaylib module, used to strip the color codes from errors and warnings.
+
+        :return: Nothing.
+        """
+
+        self.display_module = display_module
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def format_string(self,
+                      msg) -> str:
+        return self.display_module.format_string(msg)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def format_boolean(self,
+                       value) -> str:
+        return self.display_module.format_boolean(value)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def print_msg(self,
+                  msg="",
+                  *args,
+                  **kwargs):
+        """
+        Writes the message to stderr if it is an error or a warning, and drops it otherwise.
+
+        :param msg: The message, which may contain color codes.
+
+        :return: Nothing.
+        """
+
+        text = self.display_module.format_string(msg).strip()
+        if text.lower().startswith(_LABELS):
+            sys.stderr.write(f"{text}\n")
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def print_refreshable_msg(self,
+                              *args,
+                              **kwargs):
+        pass
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def flush_refreshable_msg(self,
+                              *args,
+                              **kwargs):
+        pass
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def finish_refreshable_message(self,
+                                   *args,
+                                   **kwargs):
+        pass
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def display_progress(self,
+                         count,
+                         total,
+                         old_percent,
+                         *args,
+                         **kwargs) -> int:
+        return old_percent
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def mult_choice_input(self,
+                          msg,
+                          *args,
+                          **kwargs):
+        raise RuntimeError(f"A prompt was reached in batch mode: {self.display_module.format_string(msg).strip()}")
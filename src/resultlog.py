@@ -0,0 +1,615 @@
+#! /usr/bin/env python3
+"""
+A module to write and read the result log of a compareFolders run.
+
+Two formats are supported. The text format is one line per record with the fields joined by DELIMITER. The binary
+format starts with BINARY_MAGIC and a length-prefixed JSON header block, followed by length-prefixed, zlib compressed
+blocks of records, and ends with a JSON trailer (the final counts and the offset of every block) that can be found by
+reading the last few bytes of the file. Both formats can be read one record at a time, so a log never needs to be held
+in memory in full.
+"""
+import json
+import os
+import struct
+import time
+import zlib
+
+DELIMITER = "@COMPAREFOLDERS@"
+
+FSYNC_RECORD_FREQUENCY = 1000
+FSYNC_SECONDS = 5.0
+
+LOG_FORMATS = ["text", "binary"]
+
+# The hash algorithm assumed for logs written before the algorithm was recorded in the header.
+DEFAULT_HASH = "md5"
+
+BINARY_MAGIC = b"CMPFLDRS\x00\x01\r\n"
+RECORD_TYPES = ["D", "U", "SE", "PME"]
+
+# The number of bytes at the end of a text log searched for the trailer.
+TEXT_TRAILER_SIZE = 64 * 1024
+
+_FRAME = struct.Struct(">I")
+_FOOTER = struct.Struct(">Q")
+_RECORD = struct.Struct(">BH")
+_FIELD = struct.Struct(">I")
+
+
+class ResultLogWriter(object):
+    """
+    A class to write the results of a compare to a log file as they are produced, rather than all at once at the end.
+
+    The log starts with a header (options, query directories, and canonical directory), followed by one line per
+    record, and ends with a trailer holding the final counts. The file is flushed and fsync'ed periodically, so if the
+    compare is interrupted or crashes, every record written up to that point is still on disk and usable by deleteFiles.
+    A log without a "complete=True" trailer line was interrupted before the compare finished.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self,
+                 log_p,
+                 options,
+                 query_dirs,
+                 canonical_dir,
+                 hash_algorithm=DEFAULT_HASH,
+                 fsync_record_frequency=FSYNC_RECORD_FREQUENCY,
+                 fsync_seconds=FSYNC_SECONDS,
+                 started_ns=None,
+                 canonical_roots=None,
+                 skip_checksum=False,
+                 scan_settings=None):
+        """
+        Opens the log file and writes the header.
+
+        :param log_p: The path to the log file. Any existing file is overwritten.
+        :param options: The string of comparison options (any of "nptrcm").
+        :param query_dirs: The list of query items. Only directories are written to the header.
+        :param canonical_dir: The canonical directory.
+        :param hash_algorithm: The name of the hash algorithm the compare used, so that deleteFiles can verify with
+               the same one. Defaults to DEFAULT_HASH.
+        :param fsync_record_frequency: The number of records to write between fsyncs. Defaults to
+               FSYNC_RECORD_FREQUENCY.
+        :param fsync_seconds: The maximum number of seconds between fsyncs. Defaults to FSYNC_SECONDS.
+        :param started_ns: The time (from time.time_ns()) at which the compare's scans started, so that a later compare
+               can tell which files have changed since (see PreviousResults). If None, it is not recorded.
+        :param canonical_roots: The list of every canonical directory (and shard root) the compare used. If None, only
+               canonical_dir is recorded.
+        :param skip_checksum: Whether the compare skipped checksums. Defaults to False.
+        :param scan_settings: An optional dictionary of the query and canonical scan settings (skip flags and regexes)
+               keyed on "query" and "canonical", so that a later compare can tell whether it scans the same files. If
+               None, they are not recorded.
+
+        :return: Nothing.
+        """
+
+        self.log_p = log_p
+        self.fsync_record_frequency = fsync_record_frequency
+        self.fsync_seconds = fsync_seconds
+
+        self.num_matches = 0
+        self.num_unique = 0
+        self.num_source_errors = 0
+        self.num_possible_match_errors = 0
+
+        self._unsynced_records = 0
+        self._last_sync = time.monotonic()
+
+        header = {"options": options,
+                  "hash": hash_algorithm,
+                  "query_dirs": [os.path.abspath(item) for item in query_dirs if os.path.isdir(item)],
+                  "canonical_dir": os.path.abspath(canonical_dir),
+                  "canonical_roots": [os.path.abspath(root) for root in canonical_roots or [canonical_dir]],
+                  "skip_checksum": skip_checksum}
+        if started_ns is not None:
+            header["started_ns"] = started_ns
+        if scan_settings is not None:
+            header["scan_settings"] = scan_settings
+
+        self._log_f = None
+        self._write_header(header)
+        self._sync()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _write_header(self,
+                      header):
+        """
+        Opens the log file and writes the header.
+
+        :param header: A dictionary with the options, hash, query_dirs, canonical_dir, canonical_roots, and
+               skip_checksum keys, and optionally the started_ns and scan_settings keys.
+
+        :return: Nothing.
+        """
+
+        self._log_f = open(self.log_p, "w", encoding="utf-8", errors="surrogateescape")
+        self._log_f.write(f"options={header['options']}\n")
+        self._log_f.write(f"hash={header['hash']}\n")
+        for i, query_d in enumerate(header["query_dirs"]):
+            self._log_f.write(f"querydir{i}={query_d}\n")
+        self._log_f.write(f"canonicaldir={header['canonical_dir']}\n")
+        for i, canonical_d in enumerate(header["canonical_roots"]):
+            self._log_f.write(f"canonicalroot{i}={canonical_d}\n")
+        self._log_f.write(f"skip_checksum={header['skip_checksum']}\n")
+        if "started_ns" in header:
+            self._log_f.write(f"started_ns={header['started_ns']}\n")
+        if "scan_settings" in header:
+            self._log_f.write(f"scan_settings={json.dumps(header['scan_settings'])}\n")
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _sync(self):
+        """
+        Flushes the log file and forces it to disk.
+
+        :return: Nothing.
+        """
+
+        self._log_f.flush()
+        os.fsync(self._log_f.fileno())
+        self._unsynced_records = 0
+        self._last_sync = time.monotonic()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _write_record(self,
+                      record):
+        """
+        Writes a single record, syncing the file if enough records or time have accumulated since the last sync.
+
+        :param record: A list of strings: the record type followed by one or more paths.
+
+        :return: Nothing.
+        """
+
+        self._log_f.write(f"{DELIMITER.join(record)}\n")
+        self._unsynced_records += 1
+        if (self._unsynced_records >= self.fsync_record_frequency or
+                time.monotonic() - self._last_sync >= self.fsync_seconds):
+            self._sync()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def write_result(self,
+                     result):
+        """
+        Writes the result of comparing a single query file.
+
+        :param result: A result dictionary as produced by Session (with "status", "query_p", "matches", and
+               "possible_match_errors" keys).
+
+        :return: Nothing.
+        """
+
+        if result["status"] == "D":
+            self._write_record(["D", result["query_p"]] + result["matches"])
+            self.num_matches += 1
+        elif result["status"] == "U":
+            self._write_record(["U", os.path.abspath(result["query_p"])])
+            self.num_unique += 1
+        else:
+            self._write_record(["SE", result["query_p"]])
+            self.num_source_errors += 1
+
+        for file_p in result["possible_match_errors"]:
+            self._write_record(["PME", file_p])
+            self.num_possible_match_errors += 1
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def close(self,
+              complete=True):
+        """
+        Writes the trailer and closes the log file.
+
+        :param complete: Whether the compare ran to its end. Defaults to True.
+
+        :return: Nothing.
+        """
+
+        if self._log_f.closed:
+            return
+
+        self._write_trailer(self._trailer(complete))
+        self._sync()
+        self._log_f.close()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _trailer(self,
+                 complete) -> dict:
+        """
+        :param complete: Whether the compare ran to its end.
+
+        :return: A dictionary of the final counts and the complete flag.
+        """
+
+        return {"num_matches": self.num_matches,
+                "num_unique": self.num_unique,
+                "num_source_errors": self.num_source_errors,
+                "num_possible_match_errors": self.num_possible_match_errors,
+                "complete": complete}
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _write_trailer(self,
+                       trailer):
+        """
+        Writes the trailer.
+
+        :param trailer: A dictionary of the final counts and the complete flag.
+
+        :return: Nothing.
+        """
+
+        for key, value in trailer.items():
+            self._log_f.write(f"{key}={value}\n")
+
+
+class BinaryResultLogWriter(ResultLogWriter):
+    """
+    A class to write the results of a compare to a log file in the compact binary format.
+
+    Records are collected into blocks that are compressed and written (and fsync'ed) as a whole, once
+    fsync_record_frequency records have accumulated or fsync_seconds have passed. Each block is preceded by its length,
+    so a reader can stop cleanly at the last complete block of a log that was interrupted. An empty frame marks the end
+    of the records and is followed by the trailer and, in the last bytes of the file, the offset of the trailer.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self,
+                 log_p,
+                 options,
+                 query_dirs,
+                 canonical_dir,
+                 hash_algorithm=DEFAULT_HASH,
+                 fsync_record_frequency=FSYNC_RECORD_FREQUENCY,
+                 fsync_seconds=FSYNC_SECONDS,
+                 started_ns=None,
+                 canonical_roots=None,
+                 skip_checksum=False,
+                 scan_settings=None):
+        """
+        Opens the log file and writes the header.
+
+        :param log_p: The path to the log file. Any existing file is overwritten.
+        :param options: The string of comparison options (any of "nptrcm").
+        :param query_dirs: The list of query items. Only directories are written to the header.
+        :param canonical_dir: The canonical directory.
+        :param hash_algorithm: The name of the hash algorithm the compare used, so that deleteFiles can verify with
+               the same one. Defaults to DEFAULT_HASH.
+        :param fsync_record_frequency: The number of records in each block. Defaults to FSYNC_RECORD_FREQUENCY.
+        :param fsync_seconds: The maximum number of seconds before a partial block is written. Defaults to
+               FSYNC_SECONDS.
+        :param started_ns: The time (from time.time_ns()) at which the compare's scans started. If None, it is not
+               recorded.
+        :param canonical_roots: The list of every canonical directory (and shard root) the compare used. If None, only
+               canonical_dir is recorded.
+        :param skip_checksum: Whether the compare skipped checksums. Defaults to False.
+        :param scan_settings: An optional dictionary of the query and canonical scan settings (skip flags and regexes)
+               keyed on "query" and "canonical", so that a later compare can tell whether it scans the same files. If
+               None, they are not recorded.
+
+        :return: Nothing.
+        """
+
+        self._block = bytearray()
+        self._blocks = list()
+
+        super().__init__(log_p=log_p,
+                         options=options,
+                         query_dirs=query_dirs,
+                         canonical_dir=canonical_dir,
+                         hash_algorithm=hash_algorithm,
+                         fsync_record_frequency=fsync_record_frequency,
+                         fsync_seconds=fsync_seconds,
+                         started_ns=started_ns,
+                         canonical_roots=canonical_roots,
+                         skip_checksum=skip_checksum,
+                         scan_settings=scan_settings)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _write_frame(self,
+                     data):
+        """
+        Writes a length-prefixed frame.
+
+        :param data: The bytes of the frame.
+
+        :return: Nothing.
+        """
+
+        self._log_f.write(_FRAME.pack(len(data)))
+        self._log_f.write(data)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _write_header(self,
+                      header):
+        """
+        Opens the log file and writes the magic bytes and the header block.
+
+        :param header: A dictionary with the options, hash, query_dirs, canonical_dir, canonical_roots, and
+               skip_checksum keys, and optionally the started_ns and scan_settings keys.
+
+        :return: Nothing.
+        """
+
+        self._log_f = open(self.log_p, "wb")
+        self._log_f.write(BINARY_MAGIC)
+        self._write_frame(json.dumps(header).encode("utf-8"))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _sync(self):
+        """
+        Writes the current block of records (if there is one), then flushes the log file and forces it to disk.
+
+        :return: Nothing.
+        """
+
+        if self._block:
+            self._blocks.append((self._log_f.tell(), self._unsynced_records))
+            self._write_frame(zlib.compress(bytes(self._block)))
+            self._block = bytearray()
+
+        super()._sync()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _write_record(self,
+                      record):
+        """
+        Adds a single record to the current block, writing the block out if enough records or time have accumulated.
+
+        :param record: A list of strings: the record type followed by one or more paths.
+
+        :return: Nothing.
+        """
+
+        self._block += _RECORD.pack(RECORD_TYPES.index(record[0]), len(record) - 1)
+        for field in record[1:]:
+            data = field.encode("utf-8", "surrogateescape")
+            self._block += _FIELD.pack(len(data))
+            self._block += data
+
+        self._unsynced_records += 1
+        if (self._unsynced_records >= self.fsync_record_frequency or
+                time.monotonic() - self._last_sync >= self.fsync_seconds):
+            self._sync()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _write_trailer(self,
+                       trailer):
+        """
+        Writes any outstanding records, the end-of-records marker, the trailer, and the footer.
+
+        :param trailer: A dictionary of the final counts and the complete flag.
+
+        :return: Nothing.
+        """
+
+        self._sync()
+        self._log_f.write(_FRAME.pack(0))
+
+        trailer = dict(trailer)
+        trailer["blocks"] = self._blocks
+        trailer_offset = self._log_f.tell()
+        self._write_frame(json.dumps(trailer).encode("utf-8"))
+        self._log_f.write(_FOOTER.pack(trailer_offset))
+        self._log_f.write(BINARY_MAGIC)
+
+
+WRITER_CLASSES = {"text": ResultLogWriter,
+                  "binary": BinaryResultLogWriter}
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def get_log_format(log_p) -> str:
+    """
+    Works out which format a log file was written in.
+
+    :param log_p: The path to the log file.
+
+    :return: Either "text" or "binary".
+    """
+
+    with open(log_p, "rb") as log_f:
+        if log_f.read(len(BINARY_MAGIC)) == BINARY_MAGIC:
+            return "binary"
+    return "text"
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _read_frame(log_f):
+    """
+    Reads a length-prefixed frame.
+
+    :param log_f: The binary log file object, positioned at the start of a frame.
+
+    :return: The bytes of the frame, b"" for the end-of-records marker, or None if the file ends before the frame is
+             complete.
+    """
+
+    prefix = log_f.read(_FRAME.size)
+    if len(prefix) < _FRAME.size:
+        return None
+    length = _FRAME.unpack(prefix)[0]
+    data = log_f.read(length)
+    if len(data) < length:
+        return None
+    return data
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def read_header(log_p) -> dict:
+    """
+    Reads the header of a result log in either format.
+
+    :param log_p: The path to the log file.
+
+    :return: A dictionary with the options (as a string), hash (the name of the hash algorithm), query_dirs (as a
+             list), and canonical_dir keys. Logs that record them also carry the canonical_roots (as a list),
+             skip_checksum, started_ns, and scan_settings (as a dictionary) keys. Logs written by older versions of
+             compareFolders also carry num_matches and num_unique keys, and have no hash line (DEFAULT_HASH is returned
+             for them). Raises a ValueError if the header cannot be read.
+    """
+
+    if get_log_format(log_p) == "binary":
+        with open(log_p, "rb") as log_f:
+            log_f.seek(len(BINARY_MAGIC))
+            data = _read_frame(log_f)
+            if not data:
+                raise ValueError(f"Malformed header in log file: {log_p}")
+            try:
+                header = json.loads(data.decode("utf-8"))
+            except ValueError:
+                raise ValueError(f"Malformed header in log file: {log_p}")
+            header.setdefault("hash", DEFAULT_HASH)
+            return header
+
+    header = {"options": "", "hash": DEFAULT_HASH, "query_dirs": list(), "canonical_dir": ""}
+    with open(log_p, "r", encoding="utf-8", errors="surrogateescape") as log_f:
+        for line in log_f:
+            if DELIMITER in line:
+                break
+            line = line.rstrip("\n")
+            if line.startswith("options="):
+                header["options"] = line.split("=", 1)[1]
+            elif line.startswith("hash="):
+                header["hash"] = line.split("=", 1)[1]
+            elif line.startswith("querydir"):
+                header["query_dirs"].append(line.split("=", 1)[1])
+            elif line.startswith("canonicaldir="):
+                header["canonical_dir"] = line.split("=", 1)[1]
+            elif line.startswith("canonicalroot"):
+                header.setdefault("canonical_roots", list()).append(line.split("=", 1)[1])
+            elif line.startswith("skip_checksum="):
+                header["skip_checksum"] = line.split("=", 1)[1] == "True"
+            elif line.startswith("started_ns="):
+                try:
+                    header["started_ns"] = int(line.split("=", 1)[1])
+                except ValueError:
+                    raise ValueError(f"Malformed header in log file: {log_p}")
+            elif line.startswith("scan_settings="):
+                try:
+                    header["scan_settings"] = json.loads(line.split("=", 1)[1])
+                except ValueError:
+                    raise ValueError(f"Malformed header in log file: {log_p}")
+            elif line.startswith("num_matches="):
+                header["num_matches"] = int(line.split("=", 1)[1])
+            elif line.startswith("num_unique="):
+                header["num_unique"] = int(line.split("=", 1)[1])
+                break
+    return header
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def read_trailer(log_p):
+    """
+    Reads the trailer of a result log in either format, without reading the records.
+
+    :param log_p: The path to the log file.
+
+    :return: A dictionary of the final counts (num_matches, num_unique, num_source_errors, num_possible_match_errors)
+             and the complete flag, or None if the log has no trailer (it was written by an older version of
+             compareFolders, or the compare was killed before the log was closed).
+    """
+
+    if get_log_format(log_p) == "binary":
+        with open(log_p, "rb") as log_f:
+            log_f.seek(0, os.SEEK_END)
+            if log_f.tell() < len(BINARY_MAGIC) * 2 + _FOOTER.size:
+                return None
+            log_f.seek(-(_FOOTER.size + len(BINARY_MAGIC)), os.SEEK_END)
+            footer = log_f.read(_FOOTER.size + len(BINARY_MAGIC))
+            if footer[_FOOTER.size:] != BINARY_MAGIC:
+                return None
+            log_f.seek(_FOOTER.unpack(footer[:_FOOTER.size])[0])
+            data = _read_frame(log_f)
+            if not data:
+                return None
+            try:
+                return json.loads(data.decode("utf-8"))
+            except ValueError:
+                return None
+
+    with open(log_p, "rb") as log_f:
+        log_f.seek(0, os.SEEK_END)
+        log_f.seek(max(log_f.tell() - TEXT_TRAILER_SIZE, 0))
+        lines = log_f.read().decode("utf-8", "surrogateescape").splitlines()
+
+    if not lines or not lines[-1].startswith("complete="):
+        return None
+
+    trailer = dict()
+    for line in reversed(lines):
+        key, sep, value = line.partition("=")
+        if DELIMITER in line or not sep or key not in ("num_matches", "num_unique", "num_source_errors",
+                                                       "num_possible_match_errors", "complete"):
+            break
+        if key == "complete":
+            trailer[key] = value == "True"
+        else:
+            trailer[key] = int(value)
+    return trailer
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def iter_records(log_p,
+                 record_types=None):
+    """
+    Reads the records of a result log (in either format) one at a time, skipping the header and trailer. Records are
+    read and decoded as a stream, so the whole log is never held in memory. If the log was cut short, every complete
+    record before the damage is returned.
+
+    :param log_p: The path to the log file.
+    :param record_types: An optional set of record types ("D", "U", "SE", "PME") to return. If None, all records are
+           returned.
+
+    :return: A generator that yields each record as a tuple of strings: the record type followed by one or more paths.
+    """
+
+    if get_log_format(log_p) == "binary":
+        yield from _iter_binary_records(log_p, record_types)
+        return
+
+    with open(log_p, "r", encoding="utf-8", errors="surrogateescape") as log_f:
+        for line in log_f:
+            if DELIMITER not in line:
+                continue
+            record = tuple(line.rstrip("\n").split(DELIMITER))
+            if record_types is None or record[0] in record_types:
+                yield record
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _iter_binary_records(log_p,
+                         record_types=None):
+    """
+    Reads the records of a binary result log one block at a time.
+
+    :param log_p: The path to the log file.
+    :param record_types: An optional set of record types ("D", "U", "SE", "PME") to return. If None, all records are
+           returned.
+
+    :return: A generator that yields each record as a tuple of strings: the record type followed by one or more paths.
+    """
+
+    with open(log_p, "rb") as log_f:
+        log_f.seek(len(BINARY_MAGIC))
+        if not _read_frame(log_f):
+            return
+
+        while True:
+            data = _read_frame(log_f)
+            if not data:
+                return
+            try:
+                block = zlib.decompress(data)
+            except zlib.error:
+                return
+
+            offset = 0
+            while offset < len(block):
+                type_index, field_count = _RECORD.unpack_from(block, offset)
+                offset += _RECORD.size
+                record = [RECORD_TYPES[type_index]]
+                for _ in range(field_count):
+                    length = _FIELD.unpack_from(block, offset)[0]
+                    offset += _FIELD.size
+                    record.append(block[offset:offset + length].decode("utf-8", "surrogateescape"))
+                    offset += length
+                if record_types is None or record[0] in record_types:
+                    yield tuple(record)
@@ -0,0 +1,593 @@
+#! /usr/bin/env python3
+"""
+A module to scan one or more directories for files, using a pool of worker threads.
+"""
+import collections
+import os.path
+import threading
+import time
+
+from src import extsort
+from src.canonicalindex import DirRecord
+from src.filetable import FileTable
+from src.filters import NameFilter
+from src.metrics import registry
+from src.profiling import profiler
+
+POLL_INTERVAL = 0.1
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _zero_clock() -> float:
+    """
+    Stands in for time.perf_counter when metrics are disabled, so the timing code in the scan loop costs next to
+    nothing.
+
+    :return: 0.0
+    """
+
+    return 0.0
+
+
+class Scanner(object):
+    """
+    A class to scan a list of directories (and/or individual files) and accumulate the files that pass the skip and
+    regex filters.
+
+    Directories are enumerated with os.scandir by a pool of worker threads. Each worker has its own queue of
+    directories to enumerate: it pushes the sub-directories it finds onto its own queue and takes new work from the end
+    of that queue (so each worker stays local to one part of the tree), and only when its own queue is empty does it
+    steal work from the front of another worker's queue. On network mounts and trees with many small directories this
+    keeps many stat calls in flight at once.
+
+    If a previously saved CanonicalIndex is given, directories whose modification time matches the index are not
+    enumerated again; their files and skip counters are taken from the index instead.
+
+    The files found are accumulated in a FileTable (self.files) rather than in a dictionary of stat results, which keeps
+    the memory used per file small enough for trees of tens of millions of files. For larger trees, the files may be
+    handed to an ExternalSorter (spill) instead, which writes them to sorted run files on disk once they reach its
+    memory ceiling.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self,
+                 items,
+                 skip_sub_dir=False,
+                 skip_hidden_files=False,
+                 skip_hidden_dirs=False,
+                 skip_zero_len=True,
+                 incl_dir_regexes=None,
+                 excl_dir_regexes=None,
+                 incl_file_regexes=None,
+                 excl_file_regexes=None,
+                 workers=1,
+                 index=None,
+                 record_dirs=False,
+                 spill=None,
+                 name="scan"):
+        """
+        Sets up the scanner.
+
+        :param items: A list of directories and/or files to scan.
+        :param skip_sub_dir: If True, only the files directly inside the directories in items are scanned.
+        :param skip_hidden_files: If True, files whose names start with a "." are skipped.
+        :param skip_hidden_dirs: If True, directories whose names start with a "." are skipped.
+        :param skip_zero_len: If True, zero length files are skipped.
+        :param incl_dir_regexes: A list of regex patterns. If given, only sub-directories whose names match at least
+               one of these patterns are scanned.
+        :param excl_dir_regexes: A list of regex patterns. Sub-directories whose names match any of these patterns are
+               not scanned.
+        :param incl_file_regexes: A list of regex patterns. If given, only files whose names match at least one of
+               these patterns are accumulated.
+        :param excl_file_regexes: A list of regex patterns. Files whose names match any of these patterns are not
+               accumulated.
+        :param workers: The number of worker threads used to enumerate directories. Defaults to 1.
+        :param index: An optional, loaded CanonicalIndex object whose directory records may be reused.
+        :param record_dirs: If True, a DirRecord is kept for every directory enumerated (or reused) so the scan can be
+               saved as a CanonicalIndex. Defaults to False.
+        :param spill: An optional ExternalSorter. If given, the files found are added to it as scan records instead of
+               being accumulated in self.files, so self.files stays empty. May not be used with index or record_dirs.
+        :param name: The name used as a prefix for this scanner's metrics. Defaults to "scan".
+
+        :return: Nothing.
+        """
+
+        self.items = items
+        self.skip_sub_dir = skip_sub_dir
+        self.skip_hidden_files = skip_hidden_files
+        self.skip_hidden_dirs = skip_hidden_dirs
+        self.skip_zero_len = skip_zero_len
+        self.file_filter = NameFilter("files", skip_hidden_files, incl_file_regexes, excl_file_regexes)
+        self.dir_filter = NameFilter("dirs", skip_hidden_dirs, incl_dir_regexes, excl_dir_regexes)
+        self.workers = max(workers, 1)
+        self.index = index
+        self.record_dirs = record_dirs
+        self.spill = spill
+        self.name = name
+
+        self.started_ns = None
+        self.files = FileTable()
+        self.bytes_found = 0
+        self.dir_records = dict()
+        self.dirs_reused = 0
+        self.dirs_rescanned = 0
+        self.spill_error = None
+        self.worker_error = None
+
+        self.checked_count = 0
+        self.skipped_links = 0
+        self.skipped_zero_len = 0
+        self.skipped_hidden_files = 0
+        self.skipped_hidden_dirs = 0
+        self.skipped_include_dirs = 0
+        self.skipped_exclude_dirs = 0
+        self.skipped_include_files = 0
+        self.skipped_exclude_files = 0
+
+        self.dir_permission_err_dirs = list()
+        self.dir_not_found_err_dirs = list()
+        self.dir_generic_err_dirs = list()
+        self.file_permission_err_files = list()
+        self.file_not_found_err_files = list()
+        self.file_generic_err_files = list()
+
+        self._queues = [collections.deque() for _ in range(self.workers)]
+        self._pending = 0
+        self._condition = threading.Condition()
+        self._threads = list()
+        self._stop = False
+
+    # ------------------------------------------------------------------------------------------------------------------
+    @property
+    def error_count(self) -> int:
+        """
+        Returns the total number of errors encountered during the scan.
+
+        :return: The number of errors as an integer.
+        """
+
+        return (len(self.dir_permission_err_dirs) +
+                len(self.dir_not_found_err_dirs) +
+                len(self.dir_generic_err_dirs) +
+                len(self.file_permission_err_files) +
+                len(self.file_not_found_err_files) +
+                len(self.file_generic_err_files))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    @property
+    def initial_count(self) -> int:
+        """
+        Returns the number of files accumulated by the scan.
+
+        :return: The number of files as an integer.
+        """
+
+        if self.spill is not None:
+            return len(self.spill)
+        return len(self.files)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    @property
+    def expected_files(self):
+        """
+        Returns an estimate of how many files the scan will accumulate: the number of files in the index it reuses
+        directories from, if it has one.
+
+        :return: The estimated number of files, or None if there is no index to estimate from.
+        """
+
+        if self.index is None:
+            return None
+        return len(self.index.files)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    @staticmethod
+    def _record_error(error,
+                      path,
+                      permission_list,
+                      not_found_list,
+                      generic_list):
+        """
+        Appends a path to the list that matches the type of error.
+
+        :param error: The OSError that was raised.
+        :param path: The path that caused the error.
+        :param permission_list: The list to append to if this is a permission error.
+        :param not_found_list: The list to append to if this is a file not found error.
+        :param generic_list: The list to append to for any other error.
+
+        :return: Nothing.
+        """
+
+        if isinstance(error, PermissionError):
+            permission_list.append(path)
+        elif isinstance(error, FileNotFoundError):
+            not_found_list.append(path)
+        else:
+            generic_list.append(path)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _file_passes_filters(self,
+                             name,
+                             tallies) -> bool:
+        """
+        Checks a file name against the hidden file and regex filters.
+
+        :param name: The name of the file.
+        :param tallies: A dictionary of skip counters to increment if the file is skipped.
+
+        :return: True if the file should be accumulated, False otherwise.
+        """
+
+        skip_reason = self.file_filter.skip_reason(name)
+        if skip_reason is not None:
+            tallies[skip_reason] += 1
+            return False
+        return True
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _scan_dir(self,
+                  dir_d,
+                  depth):
+        """
+        Enumerates a single directory.
+
+        :param dir_d: The directory to enumerate.
+        :param depth: How many levels below the original scan item this directory is.
+
+        :return: A tuple of (sub-directories to scan as a list of (path, depth) tuples, files found as a list of
+                 (name, stat result, checksum or None) tuples, skip tallies as a dictionary, errors as a list of (error,
+                 path, is_dir) tuples, the modification time of the directory if a DirRecord should be kept for it (None
+                 otherwise), and whether the directory was reused from the index).
+        """
+
+        sub_dirs = list()
+        files = list()
+        errors = list()
+        tallies = collections.Counter()
+
+        mtime_ns = None
+        if self.index is not None or self.record_dirs:
+            try:
+                mtime_ns = os.stat(dir_d).st_mtime_ns
+            except OSError as e:
+                errors.append((e, dir_d, True))
+                return sub_dirs, files, tallies, errors, None, False
+
+        if self.index is not None:
+            index_files = self.index.files
+            record = self.index.dirs.get(dir_d)
+            if record is not None and record.mtime_ns == mtime_ns:
+                sub_dirs = [(sub_dir_d, depth + 1) for sub_dir_d in record.sub_dirs]
+                files = [(index_files.names[file_id], index_files.stat(file_id), index_files.checksums.get(file_id))
+                         for file_id in record.files]
+                tallies.update(record.tallies)
+                registry.add(f"{self.name}_dirs_reused")
+                return sub_dirs, files, tallies, errors, mtime_ns, True
+
+        clock = time.perf_counter if registry.enabled else _zero_clock
+        filter_seconds = 0.0
+        stat_seconds = 0.0
+        stat_calls = 0
+
+        start = clock()
+        try:
+            with os.scandir(dir_d) as entries:
+                entries = list(entries)
+        except OSError as e:
+            errors.append((e, dir_d, True))
+            return sub_dirs, files, tallies, errors, None, False
+        enumerate_seconds = clock() - start
+
+        # Files in a changed directory that are themselves unchanged keep the checksum stored in the index.
+        indexed_files = dict()
+        if self.index is not None and record is not None:
+            indexed_files = {index_files.names[file_id]: file_id for file_id in record.files}
+
+        file_filter = self.file_filter
+        dir_filter = self.dir_filter
+
+        for entry in entries:
+            try:
+                if entry.is_symlink():
+                    tallies["skipped_links"] += 1
+                    continue
+
+                if entry.is_dir(follow_symlinks=False):
+                    if self.skip_sub_dir:
+                        continue
+                    # A skipped directory is never queued, so nothing below it is enumerated.
+                    start = clock()
+                    skip_reason = dir_filter.skip_reason(entry.name)
+                    filter_seconds += clock() - start
+                    if skip_reason is None:
+                        sub_dirs.append((entry.path, depth + 1))
+                    else:
+                        tallies[skip_reason] += 1
+                    continue
+
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+
+                tallies["checked_count"] += 1
+
+                start = clock()
+                skip_reason = file_filter.skip_reason(entry.name)
+                filter_seconds += clock() - start
+                if skip_reason is not None:
+                    tallies[skip_reason] += 1
+                    continue
+
+                start = clock()
+                stat_calls += 1
+                stat_result = entry.stat(follow_symlinks=False)
+                stat_seconds += clock() - start
+                if self.skip_zero_len and stat_result.st_size == 0:
+                    tallies["skipped_zero_len"] += 1
+                    continue
+
+                checksum_str = None
+                file_id = indexed_files.get(entry.name)
+                if (file_id is not None and
+                        index_files.sizes[file_id] == stat_result.st_size and
+                        index_files.mtimes[file_id] == stat_result.st_mtime_ns):
+                    checksum_str = index_files.checksums.get(file_id)
+
+                files.append((entry.name, stat_result, checksum_str))
+
+            except OSError as e:
+                errors.append((e, entry.path, False))
+
+        if registry.enabled:
+            registry.update({f"{self.name}_dirs_enumerated": 1,
+                             f"{self.name}_entries": len(entries),
+                             f"{self.name}_enumerate_seconds": enumerate_seconds,
+                             f"{self.name}_filter_seconds": filter_seconds,
+                             f"{self.name}_stat_calls": stat_calls,
+                             f"{self.name}_stat_seconds": stat_seconds})
+
+        if errors:
+            mtime_ns = None
+
+        return sub_dirs, files, tallies, errors, mtime_ns, False
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _merge(self,
+               files,
+               tallies,
+               errors,
+               dir_d=None,
+               sub_dirs=None,
+               mtime_ns=None,
+               reused=False):
+        """
+        Merges the results of enumerating a directory into the scan. Must be called with the condition lock held.
+
+        :param files: A list of (name, stat result, checksum or None) tuples. Items given directly to the scanner are
+               passed as (path, stat result, None) tuples with dir_d set to None.
+        :param tallies: A dictionary of skip counters.
+        :param errors: A list of (error, path, is_dir) tuples.
+        :param dir_d: The directory that was enumerated, if any.
+        :param sub_dirs: The list of (path, depth) tuples of the sub-directories found in the directory.
+        :param mtime_ns: The modification time of the directory if a DirRecord should be kept for it, None otherwise.
+        :param reused: True if the directory was reused from the index rather than enumerated.
+
+        :return: Nothing.
+        """
+
+        if self.spill is not None:
+            file_ids = list()
+            try:
+                for item, stat_result, checksum_str in files:
+                    parent_d, name = os.path.split(item) if dir_d is None else (dir_d, item)
+                    self.spill.add(extsort.scan_record(parent_d, name, stat_result, checksum_str))
+            except OSError as e:
+                # The spill directory is full or cannot be written to. Stop the scan rather than carry on without
+                # the files.
+                self.spill_error = e
+                self._stop = True
+        elif dir_d is None:
+            file_ids = [self.files.add(*os.path.split(file_p), stat_result, checksum_str)
+                        for file_p, stat_result, checksum_str in files]
+        else:
+            # The files of a directory reused from the index are not stat'ed, so they are marked as such (see Session).
+            file_ids = [self.files.add(dir_d, name, stat_result, checksum_str, reused)
+                        for name, stat_result, checksum_str in files]
+        self.bytes_found += sum(stat_result.st_size for _, stat_result, _ in files)
+
+        if dir_d is not None:
+            if reused:
+                self.dirs_reused += 1
+            else:
+                self.dirs_rescanned += 1
+            if mtime_ns is not None and self.record_dirs:
+                self.dir_records[dir_d] = DirRecord(mtime_ns,
+                                                    [sub_dir_d for sub_dir_d, sub_dir_depth in sub_dirs],
+                                                    file_ids,
+                                                    dict(tallies))
+
+        for key, value in tallies.items():
+            setattr(self, key, getattr(self, key) + value)
+
+        for error, path, is_dir in errors:
+            if is_dir:
+                self._record_error(error,
+                                   path,
+                                   self.dir_permission_err_dirs,
+                                   self.dir_not_found_err_dirs,
+                                   self.dir_generic_err_dirs)
+            else:
+                self._record_error(error,
+                                   path,
+                                   self.file_permission_err_files,
+                                   self.file_not_found_err_files,
+                                   self.file_generic_err_files)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _next_dir(self,
+                  worker_index):
+        """
+        Waits for and returns the next directory for a worker to enumerate: from the end of the worker's own queue if it
+        has any work, otherwise stolen from the front of another worker's queue. Must be called with the condition lock
+        held.
+
+        :param worker_index: The index of the worker asking for work.
+
+        :return: A (path, depth) tuple, or None if the scan is finished (or has been stopped).
+        """
+
+        while not self._stop:
+            if self._queues[worker_index]:
+                return self._queues[worker_index].pop()
+            for offset in range(1, self.workers):
+                victim = self._queues[(worker_index + offset) % self.workers]
+                if victim:
+                    return victim.popleft()
+            if self._pending == 0:
+                return None
+            self._condition.wait()
+        return None
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _worker(self,
+                worker_index):
+        """
+        The main loop of a worker thread.
+
+        :param worker_index: The index of this worker.
+
+        :return: Nothing.
+        """
+
+        while True:
+            with self._condition:
+                work = self._next_dir(worker_index)
+                if work is None:
+                    self._condition.notify_all()
+                    return
+
+            dir_d, depth = work
+            try:
+                sub_dirs, files, tallies, errors, mtime_ns, reused = self._scan_dir(dir_d, depth)
+
+                with self._condition:
+                    self._merge(files, tallies, errors, dir_d, sub_dirs, mtime_ns, reused)
+                    self._queues[worker_index].extend(sub_dirs)
+                    self._pending += len(sub_dirs) - 1
+                    if sub_dirs or self._pending == 0:
+                        self._condition.notify_all()
+            except Exception as e:
+                # Without this, the directory would never be counted as done: a lone worker would end the scan early
+                # as if it were complete, and any other workers would wait for it forever. Stop them all instead, and
+                # leave the error for finish to raise.
+                with self._condition:
+                    if self.worker_error is None:
+                        self.worker_error = e
+                    self._stop = True
+                    self._condition.notify_all()
+                return
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def start(self):
+        """
+        Accumulates any individual files given in items and starts the worker threads on the directories.
+
+        :return: Nothing.
+        """
+
+        self.started_ns = time.time_ns()
+
+        for i, item in enumerate(self.items):
+            if os.path.isdir(item) and not os.path.islink(item):
+                self._queues[i % self.workers].append((item, 0))
+                self._pending += 1
+                continue
+
+            tallies = collections.Counter()
+            errors = list()
+            files = list()
+            try:
+                if os.path.islink(item):
+                    tallies["skipped_links"] += 1
+                else:
+                    tallies["checked_count"] += 1
+                    if self._file_passes_filters(os.path.split(item)[1], tallies):
+                        stat_result = os.stat(item)
+                        if self.skip_zero_len and stat_result.st_size == 0:
+                            tallies["skipped_zero_len"] += 1
+                        else:
+                            files.append((item, stat_result, None))
+            except OSError as e:
+                errors.append((e, item, False))
+            self._merge(files, tallies, errors)
+
+        for worker_index in range(self.workers):
+            thread = threading.Thread(target=profiler.wrap(self._worker), args=(worker_index,), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def is_finished(self) -> bool:
+        """
+        Returns whether all worker threads have finished.
+
+        :return: True if the scan has finished.
+        """
+
+        return not any(thread.is_alive() for thread in self._threads)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def stop(self):
+        """
+        Asks the worker threads to stop after the directory each one is currently enumerating.
+
+        :return: Nothing.
+        """
+
+        with self._condition:
+            self._stop = True
+            self._condition.notify_all()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def finish(self):
+        """
+        Waits for the worker threads and, if more than one worker was used, sorts the accumulated files by directory
+        and name so that the results do not depend on which worker enumerated which directory. Files handed to a spill
+        sorter are put in order by the sorter instead.
+
+        :return: Nothing. Re-raises the first unexpected error that stopped a worker thread, if any.
+        """
+
+        for thread in self._threads:
+            thread.join()
+        self._threads = list()
+
+        if self.worker_error is not None:
+            raise self.worker_error
+
+        if self.workers > 1 and self.spill is None:
+            new_ids = self.files.sort()
+            for record in self.dir_records.values():
+                record.files = [new_ids[file_id] for file_id in record.files]
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def scan(self):
+        """
+        Runs the scan.
+
+        :return: A generator that periodically yields the number of files checked so far. Raises an OSError if the files
+                 could not be written to the spill sorter, and re-raises any unexpected error that stopped a worker
+                 thread.
+        """
+
+        self.start()
+        try:
+            while not self.is_finished():
+                self._threads[0].join(POLL_INTERVAL)
+                yield self.checked_count
+        finally:
+            self.stop()
+        self.finish()
+        if self.spill_error is not None:
+            raise self.spill_error
+        yield self.checked_count
@@ -0,0 +1,274 @@
+#! /usr/bin/env python3
+"""
+A module to keep a canonical scan resident in memory and answer queries about it from other processes over a Unix
+domain socket.
+
+Requests and responses are single lines of JSON. A request is a dictionary with a "command" key:
+
+    {"command": "query", "paths": [...]}   Compares each file to the canonical files. The response holds a "results"
+                                           list with one {"path", "status", "matches"} dictionary per path, in order.
+                                           The status is "D" (duplicate), "U" (unique), or "SE" (the file could not be
+                                           read).
+    {"command": "status"}                  Describes the canonical scan the server is answering from.
+    {"command": "refresh"}                 Rescans the canonical directory now, and responds with the new status.
+
+Any request that cannot be answered gets a response with an "error" key instead.
+"""
+import json
+import os
+import socket
+import socketserver
+import stat
+import threading
+import time
+
+DEFAULT_REFRESH_SECONDS = 60
+
+COMMANDS = ["query", "status", "refresh"]
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """
+    A class to answer the requests sent over a single client connection, one line at a time, until the client closes
+    it.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def handle(self):
+        """
+        Reads each request, and writes its response.
+
+        :return: Nothing.
+        """
+
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError:
+                response = {"error": "Malformed request: not JSON"}
+            else:
+                response = self.server.index_server.handle_request(request)
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    A class to accept client connections on a Unix domain socket, each on its own thread.
+    """
+
+    daemon_threads = True
+
+
+class IndexServer(object):
+    """
+    A class to answer queries from a resident session: the canonical directory is scanned once, the canonical files
+    are kept grouped by size in memory (along with every full checksum computed so far), and each batch of query files
+    is compared to them without scanning anything else.
+
+    The canonical directory is rescanned every refresh_seconds to pick up changes (any shards are snapshots, and are
+    not rescanned). Only the directories whose
+    modification times have changed are enumerated again, and checksums are kept for the files that have not changed,
+    so a refresh of a large, mostly unchanged tree costs one stat per directory. Queries are answered from the previous
+    scan until the new one is complete.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self,
+                 session_obj,
+                 socket_path,
+                 match_options=None,
+                 refresh_seconds=DEFAULT_REFRESH_SECONDS):
+        """
+        :param session_obj: A resident Session object whose canonical scan has finished.
+        :param socket_path: The path of the Unix domain socket to listen on.
+        :param match_options: An optional dictionary of the keyword arguments (name, file_type, parent, rel_path, ctime,
+               mtime, and skip_checksum) passed to the session's compare_paths for every query.
+        :param refresh_seconds: How many seconds to wait between rescans of the canonical directory. Set to 0 to never
+               rescan on a timer (a client may still ask for a refresh). Defaults to DEFAULT_REFRESH_SECONDS.
+
+        :return: Nothing.
+        """
+
+        self.session_obj = session_obj
+        self.socket_path = socket_path
+        self.match_options = match_options if match_options is not None else dict()
+        self.refresh_seconds = refresh_seconds
+
+        self.query_count = 0
+        self.file_count = 0
+        self.refresh_count = 0
+        self.last_refresh = time.time()
+        self.started = time.time()
+
+        self._server = None
+        self._refresh_thread = None
+        self._stop = threading.Event()
+        self._session_lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+
+        self.session_obj.replace_canonical_scan(self.session_obj.canonical_scan)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def handle_request(self,
+                       request) -> dict:
+        """
+        Answers a single request.
+
+        :param request: The request dictionary.
+
+        :return: The response dictionary.
+        """
+
+        if not isinstance(request, dict) or request.get("command") not in COMMANDS:
+            return {"error": f"Unknown command. Expected one of: {', '.join(COMMANDS)}"}
+
+        if request["command"] == "status":
+            return self.status()
+
+        if request["command"] == "refresh":
+            self.refresh()
+            return self.status()
+
+        paths = request.get("paths")
+        if not isinstance(paths, list) or not all(isinstance(path, str) for path in paths):
+            return {"error": "A query needs a list of paths"}
+
+        with self._session_lock:
+            results = self.session_obj.compare_paths(paths, **self.match_options)
+
+        with self._stats_lock:
+            self.query_count += 1
+            self.file_count += len(paths)
+
+        return {"results": [{"path": result["query_p"],
+                             "status": result["status"],
+                             "matches": result["matches"]} for result in results]}
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def status(self) -> dict:
+        """
+        :return: A dictionary describing the canonical scan being answered from, and how busy the server has been.
+        """
+
+        with self._stats_lock:
+            return {"canonical_dirs": self.session_obj.canonical_roots,
+                    "canonical_files": len(self.session_obj.canonical_files),
+                    "shards": len(self.session_obj.canonical_shards),
+                    "hash": self.session_obj.hash_algorithm,
+                    "refreshes": self.refresh_count,
+                    "last_refresh": self.last_refresh,
+                    "queries": self.query_count,
+                    "files_queried": self.file_count,
+                    "uptime_seconds": time.time() - self.started}
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def refresh(self):
+        """
+        Rescans the canonical directory, then swaps the new scan in once no query is running. Only one refresh runs at
+        a time; a refresh asked for while another is running waits for it and then runs again.
+
+        :return: Nothing.
+        """
+
+        with self._refresh_lock:
+            scan_obj = self.session_obj.rescan_canonical()
+            with self._session_lock:
+                self.session_obj.replace_canonical_scan(scan_obj)
+            with self._stats_lock:
+                self.refresh_count += 1
+                self.last_refresh = time.time()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _refresh_periodically(self):
+        """
+        Refreshes the canonical scan every refresh_seconds until the server is shut down.
+
+        :return: Nothing.
+        """
+
+        while not self._stop.wait(self.refresh_seconds):
+            try:
+                self.refresh()
+            except OSError:
+                continue
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _remove_stale_socket(self):
+        """
+        Removes a socket file left behind by a server that is no longer running.
+
+        :return: Nothing. Raises a FileExistsError if the path exists and is not a socket, or if another server is
+                 already listening on it.
+        """
+
+        try:
+            mode = os.lstat(self.socket_path).st_mode
+        except FileNotFoundError:
+            return
+
+        if not stat.S_ISSOCK(mode):
+            raise FileExistsError(f"Socket path exists and is not a socket: {self.socket_path}")
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(self.socket_path)
+        except ConnectionRefusedError:
+            os.remove(self.socket_path)
+            return
+        finally:
+            client.close()
+        raise FileExistsError(f"Another server is already listening on: {self.socket_path}")
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def start(self):
+        """
+        Starts listening on the socket (readable and writable by the current user only) and starts the refresh timer.
+        Call serve_forever to answer requests.
+
+        :return: Nothing.
+        """
+
+        self._remove_stale_socket()
+
+        old_umask = os.umask(0o177)
+        try:
+            self._server = _UnixServer(self.socket_path, _RequestHandler)
+        finally:
+            os.umask(old_umask)
+        self._server.index_server = self
+
+        if self.refresh_seconds > 0:
+            self._refresh_thread = threading.Thread(target=self._refresh_periodically, daemon=True)
+            self._refresh_thread.start()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def serve_forever(self):
+        """
+        Answers requests until the process is interrupted.
+
+        :return: Nothing.
+        """
+
+        self._server.serve_forever()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def shutdown(self):
+        """
+        Stops the refresh timer, closes the socket, and removes the socket file. Call once serve_forever has returned.
+
+        :return: Nothing.
+        """
+
+        self._stop.set()
+        if self._server is None:
+            return
+        self._server.server_close()
+        self._server = None
+        try:
+            os.remove(self.socket_path)
+        except FileNotFoundError:
+            pass
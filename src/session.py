@@ -0,0 +1,1848 @@
+#! /usr/bin/env python3
+"""
+A module to manage a compare session between one or more query items and a canonical directory.
+"""
+import collections
+from concurrent import futures
+import os.path
+import stat
+import threading
+
+from src import bytecompare
+from src import checksum
+from src import extsort
+from src.canonicalindex import CanonicalIndex, RACY_WINDOW_NS
+from src.filetable import FileStat, FileTable
+from src.ioscheduler import DEFAULT_DEVICE_WORKERS, IOScheduler
+from src.metrics import registry
+from src.profiling import profiler
+from src.scanner import Scanner
+
+DEFAULT_PARTIAL_CHECKSUM_SIZE = 64 * 1024
+
+# How many query files are planned (and their checksums read in disk order) at a time when the I/O scheduler is used.
+# Larger batches give the scheduler more files to order, at the cost of memory and of a longer wait between progress
+# updates.
+IO_SCHEDULE_BATCH_SIZE = 10000
+
+# The rules for picking which file of a cluster of identical files is kept by a self compare. "first" keeps the file in
+# the earliest query item given (then the first by path), "oldest" and "newest" go by modification time, and "shortest"
+# and "longest" by the length of the path.
+KEEPER_RULES = ["first", "oldest", "newest", "shortest", "longest"]
+
+
+class Session(object):
+    """
+    A class to manage a compare session: a scan of the query items, a scan of the canonical directory, and a compare
+    of every query file to the canonical files.
+
+    Checksums are read from and written to a persistent checksum cache (if one is given) so that files that have not
+    changed since a previous run are not re-read from disk.
+
+    Candidates are eliminated in stages that read progressively more data: first by exact size (no reads), then by the
+    metadata checks requested by the user (no reads), then by a partial checksum of the first, middle, and last
+    partial_checksum_size bytes, and only then by a full checksum. A query file with only a few candidates left at that
+    point is compared to them byte by byte instead, which stops reading at the first difference.
+
+    The canonical files may come from several canonical directories and from any number of canonical index shards
+    (built separately, for example one per file system or per host). The shards and the canonical scan are merged into a
+    single table of canonical files, in an order that does not depend on the order they were given in. A session may
+    also be run without a canonical directory, as a self compare that finds the duplicates among the query files
+    themselves (see do_self_compare).
+
+    If jobs is greater than 1, query files are compared on a pool of worker threads (file reads and checksums release
+    the GIL, so threads are enough to keep several disks and cores busy). Results are merged back into the session in
+    query scan order so the outcome does not depend on which worker finishes first.
+
+    If io_schedule is True, the query files are instead compared in batches: the checksums each batch will need are
+    worked out from the sizes and metadata first, and then read device by device in the order the files are laid out on
+    disk (see IOScheduler), so a spinning disk reads them in a sweep instead of seeking back and forth between them.
+
+    If max_memory is given, the scans do not keep their files in memory: each scan writes its files to sorted run files
+    on disk whenever it reaches its share of max_memory, and the compare merge-joins the two sorted streams of files by
+    size, holding only the canonical files of one size in memory at a time (see extsort). Results are then produced in
+    order of file size rather than in query scan order.
+
+    If previous_results are given, a query file that has not changed since an earlier compare of the same directories
+    is only compared to the canonical files that have changed since; its earlier result stands for the rest.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self,
+                 query_items,
+                 canonical_dir,
+                 query_skip_sub_dir=False,
+                 query_skip_hidden_files=False,
+                 query_skip_hidden_dirs=False,
+                 query_skip_zero_len=True,
+                 query_incl_dir_regexes=None,
+                 query_excl_dir_regexes=None,
+                 query_incl_file_regexes=None,
+                 query_excl_file_regexes=None,
+                 canonical_skip_sub_dir=False,
+                 canonical_skip_hidden_files=False,
+                 canonical_skip_hidden_dirs=False,
+                 canonical_skip_zero_len=True,
+                 canonical_incl_dir_regexes=None,
+                 canonical_excl_dir_regexes=None,
+                 canonical_incl_file_regexes=None,
+                 canonical_excl_file_regexes=None,
+                 checksum_cache=None,
+                 partial_checksum_size=DEFAULT_PARTIAL_CHECKSUM_SIZE,
+                 hash_algorithm=checksum.DEFAULT_ALGORITHM,
+                 jobs=1,
+                 scan_workers=1,
+                 canonical_index_path=None,
+                 canonical_shard_paths=None,
+                 resident=False,
+                 io_schedule=False,
+                 device_workers=DEFAULT_DEVICE_WORKERS,
+                 byte_compare_max=bytecompare.DEFAULT_MAX_CANDIDATES,
+                 previous_results=None,
+                 max_memory=None,
+                 spill_dir=None,
+                 report_frequency=10):
+        """
+        Sets up the session.
+
+        :param query_items: A list of query directories and/or files.
+        :param canonical_dir: The canonical directory, or a list of canonical directories. May be None (or an empty
+               list) for a session that only runs a self compare, or whose canonical files all come from shards.
+        :param query_skip_sub_dir: If True, sub-directories of the query directories are not scanned.
+        :param query_skip_hidden_files: If True, hidden query files are skipped.
+        :param query_skip_hidden_dirs: If True, hidden query sub-directories are skipped.
+        :param query_skip_zero_len: If True, zero length query files are skipped.
+        :param query_incl_dir_regexes: A list of regex patterns that query sub-directory names must match.
+        :param query_excl_dir_regexes: A list of regex patterns that query sub-directory names must not match.
+        :param query_incl_file_regexes: A list of regex patterns that query file names must match.
+        :param query_excl_file_regexes: A list of regex patterns that query file names must not match.
+        :param canonical_skip_sub_dir: If True, sub-directories of the canonical directory are not scanned.
+        :param canonical_skip_hidden_files: If True, hidden canonical files are skipped.
+        :param canonical_skip_hidden_dirs: If True, hidden canonical sub-directories are skipped.
+        :param canonical_skip_zero_len: If True, zero length canonical files are skipped.
+        :param canonical_incl_dir_regexes: A list of regex patterns that canonical sub-directory names must match.
+        :param canonical_excl_dir_regexes: A list of regex patterns that canonical sub-directory names must not match.
+        :param canonical_incl_file_regexes: A list of regex patterns that canonical file names must match.
+        :param canonical_excl_file_regexes: A list of regex patterns that canonical file names must not match.
+        :param checksum_cache: An optional ChecksumCache object. If None, checksums are computed from the files
+               directly.
+        :param partial_checksum_size: The number of bytes read from the start, middle, and end of each file for the
+               partial checksum stage. Files no larger than three times this size skip straight to the full checksum.
+               Set to 0 to disable the partial checksum stage. Defaults to DEFAULT_PARTIAL_CHECKSUM_SIZE.
+        :param hash_algorithm: The name of the hash algorithm used for checksums, one of checksum.HASH_ALGORITHMS.
+               Defaults to checksum.DEFAULT_ALGORITHM.
+        :param jobs: The number of worker threads used to compare files. Defaults to 1 (no worker threads).
+        :param scan_workers: The number of worker threads used by each of the query and canonical scans. Defaults to 1.
+        :param canonical_index_path: An optional path to a canonical index. If the index exists (and was built with the
+               same canonical scan settings), directories that have not changed since it was saved are not enumerated
+               again, and the checksums stored in it are reused. Call save_canonical_index after the compare to
+               update it.
+        :param canonical_shard_paths: An optional list of paths to canonical indexes (saved by other sessions, with any
+               scan settings) whose files are added to the canonical files. Their checksums are reused if they were
+               computed with the same hash algorithm.
+        :param resident: If True, the session is kept alive to answer many batches of queries (see compare_paths), and
+               the canonical scan keeps a record of every directory so that rescan_canonical can reuse the ones that
+               have not changed. Defaults to False.
+        :param io_schedule: If True, the checksums needed by the compare are read in physical disk order, one batch of
+               query files at a time, instead of in query scan order. Defaults to False.
+        :param device_workers: With io_schedule, the number of worker threads that read from each device at the same
+               time. Defaults to DEFAULT_DEVICE_WORKERS.
+        :param byte_compare_max: A query file with no more than this many candidates left for the full checksum stage
+               is compared to them byte by byte instead (stopping at the first difference), unless the full checksum
+               of any of the files is already known. Set to 0 to always use checksums. Defaults to
+               bytecompare.DEFAULT_MAX_CANDIDATES.
+        :param previous_results: An optional PreviousResults object holding the results of an earlier compare of the
+               same directories. Query and canonical files that have not changed since are not compared again.
+        :param max_memory: An optional number of bytes. If given, the query and canonical scans each spill their files
+               to sorted run files on disk whenever the files held in memory reach half of it, and the compare reads
+               them back by size. May not be used with canonical_index_path, canonical_shard_paths, or resident.
+        :param spill_dir: The directory the run files are written to when max_memory is given. Defaults to the system's
+               temporary directory.
+        :param report_frequency: How many query files to process between progress updates. Defaults to 10.
+
+        :return: Nothing. Raises a ValueError if a shard cannot be read, or if max_memory is given with settings that
+                 need every canonical file in memory.
+        """
+
+        if canonical_dir is None:
+            canonical_dirs = list()
+        elif isinstance(canonical_dir, str):
+            canonical_dirs = [canonical_dir]
+        else:
+            canonical_dirs = list(canonical_dir)
+
+        query_spill = None
+        canonical_spill = None
+        if max_memory is not None:
+            if canonical_index_path is not None or canonical_shard_paths or resident:
+                raise ValueError("A memory limit may not be used with a canonical index, shards, or a resident session")
+            query_spill = extsort.ExternalSorter(max_memory // 2, spill_dir, name="query_spill")
+            canonical_spill = extsort.ExternalSorter(max_memory // 2, spill_dir, name="canonical_spill")
+
+        self.canonical_shards = list()
+        for shard_path in canonical_shard_paths or list():
+            shard = CanonicalIndex(shard_path)
+            if not shard.load(None, hash_algorithm):
+                raise ValueError(f"Unable to read canonical index shard: {shard_path}")
+            self.canonical_shards.append(shard)
+
+        self.query_settings = {"skip_sub_dir": query_skip_sub_dir,
+                               "skip_hidden_files": query_skip_hidden_files,
+                               "skip_hidden_dirs": query_skip_hidden_dirs,
+                               "skip_zero_len": query_skip_zero_len,
+                               "incl_dir_regexes": query_incl_dir_regexes,
+                               "excl_dir_regexes": query_excl_dir_regexes,
+                               "incl_file_regexes": query_incl_file_regexes,
+                               "excl_file_regexes": query_excl_file_regexes}
+
+        self.query_scan = Scanner(items=query_items,
+                                  workers=scan_workers,
+                                  spill=query_spill,
+                                  name="query_scan",
+                                  **self.query_settings)
+
+        self.canonical_settings = {"skip_sub_dir": canonical_skip_sub_dir,
+                                   "skip_hidden_files": canonical_skip_hidden_files,
+                                   "skip_hidden_dirs": canonical_skip_hidden_dirs,
+                                   "skip_zero_len": canonical_skip_zero_len,
+                                   "incl_dir_regexes": canonical_incl_dir_regexes,
+                                   "excl_dir_regexes": canonical_excl_dir_regexes,
+                                   "incl_file_regexes": canonical_incl_file_regexes,
+                                   "excl_file_regexes": canonical_excl_file_regexes}
+
+        self.canonical_index = None
+        self.canonical_index_loaded = False
+        if canonical_index_path is not None:
+            self.canonical_index = CanonicalIndex(canonical_index_path)
+            self.canonical_index_loaded = self.canonical_index.load(self.canonical_settings, hash_algorithm)
+
+        self.canonical_scan = Scanner(items=canonical_dirs,
+                                      skip_sub_dir=canonical_skip_sub_dir,
+                                      skip_hidden_files=canonical_skip_hidden_files,
+                                      skip_hidden_dirs=canonical_skip_hidden_dirs,
+                                      skip_zero_len=canonical_skip_zero_len,
+                                      incl_dir_regexes=canonical_incl_dir_regexes,
+                                      excl_dir_regexes=canonical_excl_dir_regexes,
+                                      incl_file_regexes=canonical_incl_file_regexes,
+                                      excl_file_regexes=canonical_excl_file_regexes,
+                                      workers=scan_workers,
+                                      index=self.canonical_index if self.canonical_index_loaded else None,
+                                      record_dirs=self.canonical_index is not None or resident,
+                                      spill=canonical_spill,
+                                      name="canonical_scan")
+
+        self.query_items = query_items
+        self.canonical_dirs = canonical_dirs
+        self.canonical_roots = list(canonical_dirs)
+        for shard in self.canonical_shards:
+            self.canonical_roots.extend(root for root in shard.roots if root not in self.canonical_roots)
+        self.canonical_files = self.canonical_scan.files
+        self.checksum_cache = checksum_cache
+        self.partial_checksum_size = partial_checksum_size
+        self.hash_algorithm = hash_algorithm
+        self.jobs = max(jobs, 1)
+        self.scan_workers = scan_workers
+        self.resident = resident
+        self.io_scheduler = IOScheduler(device_workers) if io_schedule else None
+        self.byte_compare_max = byte_compare_max
+        self.previous_results = previous_results
+        self.report_frequency = max(report_frequency, 1)
+
+        self.duplicates = dict()
+        self.unique = list()
+        self.source_error_files = list()
+        self.possible_match_error_files = list()
+        self.skipped_self = list()
+        self.pre_computed_checksum_count = 0
+
+        self.duplicate_count = 0
+        self.unique_count = 0
+        self.source_error_count = 0
+        self.possible_match_error_count = 0
+        self.skipped_self_count = 0
+
+        self.result_handler = None
+        self.retain_results = True
+
+        self.size_candidate_count = 0
+        self.metadata_candidate_count = 0
+        self.partial_checksum_eliminated_count = 0
+        self.full_checksum_candidate_count = 0
+        self.hardlink_match_count = 0
+        self.previous_result_count = 0
+        self.keeper_count = 0
+        self.compared_bytes = 0
+
+        self._canonical_lookup = None
+        self._checksums = dict()
+        self._checksums_in_progress = dict()
+        self._checksums_lock = threading.Lock()
+        self._prefetched = set()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    @property
+    def scan_started_ns(self):
+        """
+        :return: The time (from time.time_ns()) at which the first of the query and canonical scans started, or None if
+                 neither has.
+        """
+
+        started = [scan_obj.started_ns for scan_obj in (self.query_scan, self.canonical_scan)
+                   if scan_obj.started_ns is not None]
+        return min(started) if started else None
+
+    # ------------------------------------------------------------------------------------------------------------------
+    @property
+    def canonical_file_count(self) -> int:
+        """
+        :return: The number of canonical files, whether they are held in memory or spilled to disk.
+        """
+
+        if self.canonical_scan.spill is not None:
+            return self.canonical_scan.initial_count
+        return len(self.canonical_files)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def do_query_scan(self):
+        """
+        Scans the query items.
+
+        :return: A generator that periodically yields the number of query files checked so far.
+        """
+
+        return self.query_scan.scan()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def do_canonical_scan(self):
+        """
+        Scans the canonical directory.
+
+        :return: A generator that periodically yields the number of canonical files checked so far.
+        """
+
+        return self.canonical_scan.scan()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def do_concurrent_scan(self):
+        """
+        Scans the query items and the canonical directory at the same time.
+
+        :return: A generator that periodically yields a tuple of the number of query files and the number of
+                 canonical files checked so far.
+        """
+
+        query_scan = self.query_scan.scan()
+        canonical_scan = self.canonical_scan.scan()
+
+        try:
+            query_counter = next(query_scan, None)
+            canonical_counter = next(canonical_scan, None)
+            while query_counter is not None or canonical_counter is not None:
+                yield self.query_scan.checked_count, self.canonical_scan.checked_count
+                if query_counter is not None:
+                    query_counter = next(query_scan, None)
+                if canonical_counter is not None:
+                    canonical_counter = next(canonical_scan, None)
+        finally:
+            query_scan.close()
+            canonical_scan.close()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def save_canonical_index(self):
+        """
+        Saves the canonical scan, along with any full checksums of canonical files computed (or reused) during this
+        session, to the canonical index. Does nothing if the session was not given a canonical index path.
+
+        :return: Nothing.
+        """
+
+        if self.canonical_index is None:
+            return
+
+        checksums = dict()
+        with self._checksums_lock:
+            for (file_p, sample_size), checksum_str in self._checksums.items():
+                if sample_size is None:
+                    checksums[file_p] = checksum_str
+
+        self.canonical_index.save(scan_obj=self.canonical_scan,
+                                  settings=self.canonical_settings,
+                                  scan_started_ns=self.canonical_scan.started_ns,
+                                  checksums=checksums,
+                                  checksum_algorithm=self.hash_algorithm)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def rescan_canonical(self):
+        """
+        Scans the canonical directory again, without changing the session. Directories whose modification time has not
+        changed since the current canonical scan enumerated them are not enumerated again (just as with a canonical
+        index), and the full checksums of canonical files known to the session are carried over for every file whose
+        size and modification time have not changed. Only a resident session records its directories, so for any
+        other session every directory is enumerated again.
+
+        :return: The new Scanner object, with its scan finished. Pass it to replace_canonical_scan to start using it.
+        """
+
+        previous_scan = self.canonical_scan
+        cutoff_ns = previous_scan.started_ns - RACY_WINDOW_NS
+
+        previous = CanonicalIndex(index_path=None)
+        previous.files = previous_scan.files
+        previous.dirs = {dir_d: record for dir_d, record in previous_scan.dir_records.items()
+                         if record.mtime_ns < cutoff_ns}
+
+        with self._checksums_lock:
+            checksums = {file_p: checksum_str for (file_p, sample_size), checksum_str in self._checksums.items()
+                         if sample_size is None}
+        for file_id in range(len(previous.files)):
+            checksum_str = checksums.get(previous.files.path(file_id))
+            if checksum_str is not None and previous.files.mtimes[file_id] < cutoff_ns:
+                previous.files.checksums[file_id] = checksum_str
+
+        scan_obj = Scanner(items=previous_scan.items,
+                           workers=self.scan_workers,
+                           index=previous,
+                           record_dirs=True,
+                           name="canonical_scan",
+                           **self.canonical_settings)
+        for _ in scan_obj.scan():
+            pass
+        return scan_obj
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def replace_canonical_scan(self,
+                               scan_obj):
+        """
+        Starts comparing to the files of a new canonical scan (from rescan_canonical). Every checksum the session holds
+        is dropped, except for the full checksums that the new scan (and the shards) carried over for unchanged
+        canonical files. Must not be called while a compare is running.
+
+        :param scan_obj: The Scanner object of the new canonical scan.
+
+        :return: Nothing.
+        """
+
+        self.canonical_scan = scan_obj
+        self._merge_canonical_files()
+        self._canonical_lookup = self._build_canonical_lookup()
+
+        with self._checksums_lock:
+            self._checksums = dict()
+        self._reuse_index_checksums()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def checksum_canonical_files(self):
+        """
+        Computes the full checksum of every file found by the canonical scan that does not have one yet (on a pool of
+        worker threads if jobs is greater than 1), so that save_canonical_index stores them. A compare against the saved
+        index, for example as a shard on another host, then never needs to read those canonical files. Files that
+        cannot be read are skipped.
+
+        :return: A generator that yields the number of canonical files checked so far.
+        """
+
+        self._reuse_index_checksums()
+
+        canonical_files = self.canonical_scan.files
+        count = 0
+        for count, checksum_str in enumerate(self._map_in_order(self._canonical_checksum, range(len(canonical_files))),
+                                             start=1):
+            if count % self.report_frequency == 0:
+                yield count
+        yield count
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _canonical_checksum(self,
+                            file_id):
+        """
+        :param file_id: The id of a file in the canonical scan.
+
+        :return: The full checksum of the file, or None if it cannot be read.
+        """
+
+        canonical_files = self.canonical_scan.files
+        canonical_p = canonical_files.path(file_id)
+        if canonical_files.from_index[file_id]:
+            self._check_index_stat(canonical_files, file_id, canonical_p)
+        try:
+            return self._checksum(canonical_p, canonical_files.stat(file_id))
+        except OSError:
+            return None
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _merge_canonical_files(self):
+        """
+        Merges the files of the canonical scan and of every shard into self.canonical_files. Without shards, the
+        canonical files are simply those of the canonical scan.
+
+        :return: Nothing.
+        """
+
+        if not self.canonical_shards:
+            self.canonical_files = self.canonical_scan.files
+            return
+
+        tables = [self.canonical_scan.files] + [shard.files for shard in self.canonical_shards]
+        self.canonical_files = FileTable.merged(tables)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _reuse_index_checksums(self):
+        """
+        Copies the checksums that the canonical files carried over from the canonical index and the shards (for every
+        canonical file whose size and modification time are unchanged since the index or shard was saved) into this
+        session. Checksums computed with a different hash algorithm are never carried over. The checksums of files in
+        directories reused from the index are left out until the file has been stat'ed (see _check_index_stat).
+
+        :return: Nothing.
+        """
+
+        canonical_files = self.canonical_files
+        with self._checksums_lock:
+            for file_id, checksum_str in canonical_files.checksums.items():
+                if not canonical_files.from_index[file_id]:
+                    self._checksums[(canonical_files.path(file_id), None)] = checksum_str
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _check_index_stat(self,
+                          files,
+                          file_id,
+                          file_p):
+        """
+        Stats a canonical file that was taken from the canonical index without being stat'ed (its directory had not
+        changed), the first time it is needed. A file modified in place does not change the modification time of its
+        directory, so if its size, modification time, or status change time no longer match the index, its stat is
+        replaced and its stored checksum is dropped, and the file is read again. Otherwise its stored checksum is used.
+
+        :param files: The FileTable that holds the file.
+        :param file_id: The id of the file in the table.
+        :param file_p: The path to the file.
+
+        :return: Nothing.
+        """
+
+        try:
+            stat_result = os.stat(file_p)
+        except OSError:
+            # The file will fail to be read (and be reported) when it is compared, so there is nothing to replace.
+            stat_result = None
+
+        with self._checksums_lock:
+            if not files.from_index[file_id]:
+                return
+
+            indexed_stat = files.stat(file_id)
+            if stat_result is None or (stat_result.st_size,
+                                       stat_result.st_mtime_ns,
+                                       stat_result.st_ctime_ns) != (indexed_stat.st_size,
+                                                                    indexed_stat.st_mtime_ns,
+                                                                    indexed_stat.st_ctime_ns):
+                files.checksums.pop(file_id, None)
+                if stat_result is not None:
+                    files.set_stat(file_id, stat_result)
+            elif file_id in files.checksums:
+                self._checksums.setdefault((file_p, None), files.checksums[file_id])
+            files.from_index[file_id] = 0
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _reset_results(self,
+                       result_handler,
+                       retain_results):
+        """
+        Clears the results and counters of any earlier compare, ready for a new one.
+
+        :param result_handler: An optional function that is called with each result dictionary.
+        :param retain_results: If False, results are only counted and passed to the result handler.
+
+        :return: Nothing.
+        """
+
+        self.result_handler = result_handler
+        self.retain_results = retain_results
+        self.duplicate_count = 0
+        self.unique_count = 0
+        self.source_error_count = 0
+        self.possible_match_error_count = 0
+        self.skipped_self_count = 0
+
+        self.duplicates = dict()
+        self.unique = list()
+        self.source_error_files = list()
+        self.possible_match_error_files = list()
+        self.skipped_self = list()
+        self.pre_computed_checksum_count = 0
+        self.size_candidate_count = 0
+        self.metadata_candidate_count = 0
+        self.partial_checksum_eliminated_count = 0
+        self.full_checksum_candidate_count = 0
+        self.hardlink_match_count = 0
+        self.previous_result_count = 0
+        self.keeper_count = 0
+        self.compared_bytes = 0
+
+    # ------------------------------------------------------------------------------------------------------------------
+    @staticmethod
+    def _match_keys(name,
+                    file_type,
+                    parent,
+                    rel_path,
+                    ctime,
+                    mtime) -> list:
+        """
+        Builds the list of metadata keys that must match for two files to be duplicates.
+
+        :param name: If True, file names must match.
+        :param file_type: If True, file extensions must match.
+        :param parent: If True, the names of the parent directories must match.
+        :param rel_path: If True, the paths relative to the scan roots must match.
+        :param ctime: If True, the creation times must match.
+        :param mtime: If True, the modification times must match.
+
+        :return: A list of keys of the metadata dictionary built by _get_metadata.
+        """
+
+        match_keys = list()
+        for key, active in (("name", name),
+                            ("file_type", file_type),
+                            ("parent", parent),
+                            ("rel_path", rel_path),
+                            ("ctime", ctime),
+                            ("mtime", mtime)):
+            if active:
+                match_keys.append(key)
+        return match_keys
+
+    # ------------------------------------------------------------------------------------------------------------------
+    @staticmethod
+    def _new_result(query_p) -> dict:
+        """
+        :param query_p: The path to the query file.
+
+        :return: A result dictionary for the query file, with a status of "SE" until the compare decides otherwise.
+        """
+
+        result = dict()
+        result["query_p"] = query_p
+        result["status"] = "SE"
+        result["matches"] = list()
+        result["skipped_self"] = 0
+        result["possible_match_errors"] = list()
+        result["size_candidate"] = False
+        result["metadata_candidate"] = False
+        result["num_size_candidates"] = 0
+        result["num_metadata_candidates"] = 0
+        result["partial_checksum_eliminated"] = False
+        result["full_checksum_candidate"] = False
+        result["hardlink_matches"] = 0
+        result["previous_result"] = False
+        return result
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _get_root(self,
+                  file_p,
+                  roots):
+        """
+        Returns the root (from a list of roots) that a file lives in. If the file IS one of the roots (i.e. a query item
+        was a file, not a directory), the file's parent directory is returned.
+
+        :param file_p: The path to the file.
+        :param roots: A list of directories and/or files.
+
+        :return: The root path.
+        """
+
+        for root in roots:
+            if file_p == root:
+                return os.path.split(file_p)[0]
+            if file_p.startswith(root.rstrip(os.path.sep) + os.path.sep):
+                return root
+        return os.path.split(file_p)[0]
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _get_metadata(self,
+                      file_p,
+                      root,
+                      stat_result) -> dict:
+        """
+        Returns the metadata that may be used to compare a file to other files.
+
+        :param file_p: The path to the file.
+        :param root: The root directory of the scan the file was found in. Used to build the relative path.
+        :param stat_result: The FileStat of the file, as recorded by the scan.
+
+        :return: A dictionary of metadata.
+        """
+
+        parent_d, name = os.path.split(file_p)
+
+        metadata = dict()
+        metadata["stat"] = stat_result
+        metadata["size"] = stat_result.st_size
+        metadata["name"] = name
+        metadata["file_type"] = os.path.splitext(name)[1]
+        metadata["parent"] = os.path.split(parent_d)[1]
+        metadata["rel_path"] = os.path.relpath(file_p, root)
+        metadata["ctime"] = stat_result.creation_time
+        metadata["mtime"] = stat_result.st_mtime
+
+        return metadata
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _checksum(self,
+                  file_p,
+                  stat_result,
+                  sample_size=None) -> str:
+        """
+        Returns the checksum of a file, reusing one computed earlier in this session, then one stored in the checksum
+        cache, before finally reading the file. If another worker is already checksumming the same file, waits for
+        that result instead of reading the file a second time.
+
+        :param file_p: The path to the file.
+        :param stat_result: The os.stat_result of the file.
+        :param sample_size: If given, a partial checksum of sample_size bytes from the start, middle, and end of the
+               file is returned instead of a full checksum.
+
+        :return: The checksum as a string.
+        """
+
+        key = (file_p, sample_size)
+        with self._checksums_lock:
+            if key in self._checksums:
+                # The first use of a checksum read ahead by the I/O scheduler is not a reuse.
+                if key in self._prefetched:
+                    self._prefetched.discard(key)
+                else:
+                    self.pre_computed_checksum_count += 1
+                return self._checksums[key]
+            in_progress = self._checksums_in_progress.get(key)
+            if in_progress is None:
+                self._checksums_in_progress[key] = threading.Event()
+
+        if in_progress is not None:
+            in_progress.wait()
+            with self._checksums_lock:
+                if key in self._checksums:
+                    self.pre_computed_checksum_count += 1
+                    return self._checksums[key]
+            return self._checksum(file_p, stat_result, sample_size)
+
+        try:
+            if self.checksum_cache is not None:
+                checksum_str = self.checksum_cache.checksum(file_p, stat_result, sample_size, self.hash_algorithm)
+            elif sample_size is None:
+                checksum_str = checksum.checksum_for_file(file_p, self.hash_algorithm)
+            else:
+                checksum_str = checksum.partial_checksum_for_file(file_p, stat_result.st_size, sample_size,
+                                                                  self.hash_algorithm)
+            with self._checksums_lock:
+                self._checksums[key] = checksum_str
+        finally:
+            with self._checksums_lock:
+                self._checksums_in_progress.pop(key).set()
+
+        return checksum_str
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _filter_on_checksum(self,
+                            query_p,
+                            query_metadata,
+                            candidates,
+                            result,
+                            sample_size=None) -> list:
+        """
+        Returns the candidates whose checksum matches the query file's checksum.
+
+        :param query_p: The path to the query file.
+        :param query_metadata: The metadata dictionary of the query file.
+        :param candidates: A list of (path, metadata) tuples of canonical files.
+        :param result: The result dictionary of the query file. Any canonical files that cannot be read are added to
+               its list of possible match errors.
+        :param sample_size: If given, partial checksums are compared instead of full checksums.
+
+        :return: The list of (path, metadata) tuples that match. Raises an OSError if the query file cannot be read.
+        """
+
+        query_checksum = self._checksum(query_p, query_metadata["stat"], sample_size)
+
+        matches = list()
+        for canonical_p, canonical_metadata in candidates:
+            try:
+                canonical_checksum = self._checksum(canonical_p, canonical_metadata["stat"], sample_size)
+            except OSError:
+                result["possible_match_errors"].append(canonical_p)
+                continue
+            if canonical_checksum == query_checksum:
+                matches.append((canonical_p, canonical_metadata))
+
+        return matches
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _use_byte_compare(self,
+                          query_p,
+                          query_stat,
+                          candidates) -> bool:
+        """
+        Decides whether a query file is compared to its remaining candidates byte by byte rather than by checksum. Only
+        small groups are, and only if no file in the group has a full checksum known already (in this session or in
+        the checksum cache): a known checksum means that file need not be read at all. Checksums found in the cache are
+        kept in the session, so they are not looked up again.
+
+        :param query_p: The path to the query file.
+        :param query_stat: The FileStat of the query file.
+        :param candidates: A list of (path, metadata) tuples of canonical files.
+
+        :return: True if the group should be compared byte by byte.
+        """
+
+        if len(candidates) > self.byte_compare_max:
+            return False
+
+        files = [(query_p, query_stat)]
+        files.extend((canonical_p, canonical_metadata["stat"]) for canonical_p, canonical_metadata in candidates)
+
+        with self._checksums_lock:
+            if any((file_p, None) in self._checksums for file_p, stat_result in files):
+                return False
+
+        if self.checksum_cache is not None:
+            for file_p, stat_result in files:
+                checksum_str = self.checksum_cache.get(stat_result, self.hash_algorithm)
+                if checksum_str is not None:
+                    with self._checksums_lock:
+                        self._checksums[(file_p, None)] = checksum_str
+                    return False
+
+        return True
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _filter_on_bytes(self,
+                         query_p,
+                         query_stat,
+                         candidates,
+                         result) -> list:
+        """
+        Returns the candidates whose contents are identical to the query file's, comparing them byte by byte. If any
+        are, the query file's full checksum (which is also theirs) is kept in the session and the checksum cache.
+
+        :param query_p: The path to the query file.
+        :param query_stat: The FileStat of the query file.
+        :param candidates: A list of (path, metadata) tuples of canonical files.
+        :param result: The result dictionary of the query file. Any canonical files that cannot be read are added to
+               its list of possible match errors.
+
+        :return: The list of (path, metadata) tuples that match. Raises an OSError if the query file cannot be read.
+        """
+
+        matched_paths, errors, checksum_str = bytecompare.compare_files(query_p,
+                                                                        [candidate[0] for candidate in candidates],
+                                                                        self.hash_algorithm)
+        result["possible_match_errors"].extend(errors)
+        matches = [candidate for candidate in candidates if candidate[0] in matched_paths]
+
+        if checksum_str is not None:
+            files = [(query_p, query_stat)]
+            files.extend((canonical_p, canonical_metadata["stat"]) for canonical_p, canonical_metadata in matches)
+            with self._checksums_lock:
+                for file_p, stat_result in files:
+                    self._checksums[(file_p, None)] = checksum_str
+            if self.checksum_cache is not None:
+                for file_p, stat_result in files:
+                    self.checksum_cache.put(stat_result, checksum_str, self.hash_algorithm)
+
+        return matches
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _full_checksums_known(self,
+                              candidates) -> bool:
+        """
+        Checks whether the full checksum of every candidate is already known (from the canonical index, a shard, or
+        earlier in the session). If so, the partial checksum stage would only add reads, so it is skipped.
+
+        :param candidates: A list of (path, metadata) tuples of canonical files.
+
+        :return: True if no candidate needs to be read to compare full checksums.
+        """
+
+        # A checksum read ahead by the I/O scheduler was read because the plan for this batch needed it, so it does
+        # not change the decision the plan made.
+        with self._checksums_lock:
+            return all((canonical_p, None) in self._checksums and (canonical_p, None) not in self._prefetched
+                       for canonical_p, canonical_metadata in candidates)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    @staticmethod
+    def _same_entry(query_p,
+                    query_stat,
+                    canonical_stat) -> bool:
+        """
+        Returns True if a canonical file is the query file itself, reached through another path (for example, through
+        a bind mount or a symlinked directory): it shares the query file's device and inode, but the file has only one
+        link. Deleting either path would delete both, so it is never a duplicate. The query file is only stat'ed when
+        the device and inode match.
+
+        :param query_p: The path to the query file.
+        :param query_stat: The FileStat of the query file.
+        :param canonical_stat: The FileStat of the canonical file.
+
+        :return: True if the canonical file is the same directory entry as the query file.
+        """
+
+        if not query_stat.st_ino:
+            return False
+        if canonical_stat.st_ino != query_stat.st_ino or canonical_stat.st_dev != query_stat.st_dev:
+            return False
+        try:
+            return os.stat(query_p).st_nlink == 1
+        except OSError:
+            return False
+
+    # ------------------------------------------------------------------------------------------------------------------
+    @staticmethod
+    def _hardlinked_candidates(query_stat,
+                               candidates) -> set:
+        """
+        Finds the candidates that are the same file on disk as the query file (hard links to the same inode on the
+        same device). These are duplicates by definition, so they never need to be checksummed. A candidate that shares
+        the inode of a file with a single link is the query file itself, and has already been dropped by
+        _metadata_candidates (see _same_entry), so every candidate found here is a separate link.
+
+        :param query_stat: The FileStat of the query file.
+        :param candidates: A list of (path, metadata) tuples of canonical files.
+
+        :return: The set of paths of the candidates that share the query file's device and inode.
+        """
+
+        if not query_stat.st_ino:
+            return set()
+
+        linked = set()
+        for canonical_p, canonical_metadata in candidates:
+            canonical_stat = canonical_metadata["stat"]
+            if canonical_stat.st_ino == query_stat.st_ino and canonical_stat.st_dev == query_stat.st_dev:
+                linked.add(canonical_p)
+        return linked
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _build_canonical_lookup(self) -> dict:
+        """
+        Groups every canonical file by size. Only the file ids are stored; the metadata of a canonical file
+        is built when a query file of the same size needs it.
+
+        :return: A dictionary keyed on file size, where each value is a list of canonical file ids.
+        """
+
+        lookup = dict()
+        for file_id, size in enumerate(self.canonical_files.sizes):
+            lookup.setdefault(size, list()).append(file_id)
+        return lookup
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _metadata_candidates(self,
+                             query_p,
+                             query_metadata,
+                             canonical_lookup,
+                             match_keys,
+                             result) -> list:
+        """
+        Finds the canonical files that are the same size as a query file and pass the metadata checks. Neither check
+        reads any file.
+
+        :param query_p: The path to the query file.
+        :param query_metadata: The metadata dictionary of the query file.
+        :param canonical_lookup: The dictionary of canonical files grouped by size.
+        :param match_keys: The list of metadata keys that must match.
+        :param result: The result dictionary of the query file. Its size and metadata candidate counts (and its count
+               of times the file was compared with itself, under its own path or another one) are filled in.
+
+        :return: A list of (path, metadata) tuples of the candidate canonical files.
+        """
+
+        canonical_files = self.canonical_files
+        same_size = list()
+        for file_id in canonical_lookup.get(query_metadata["size"], list()):
+            canonical_p = canonical_files.path(file_id)
+            if canonical_files.from_index[file_id]:
+                self._check_index_stat(canonical_files, file_id, canonical_p)
+                if canonical_files.sizes[file_id] != query_metadata["size"]:
+                    continue
+            canonical_stat = canonical_files.stat(file_id)
+            if canonical_p == query_p or self._same_entry(query_p, query_metadata["stat"], canonical_stat):
+                result["skipped_self"] += 1
+                continue
+            canonical_root = self._get_root(canonical_p, self.canonical_roots)
+            same_size.append((canonical_p, self._get_metadata(canonical_p, canonical_root, canonical_stat)))
+        result["size_candidate"] = len(same_size) > 0
+        result["num_size_candidates"] = len(same_size)
+
+        candidates = list()
+        for canonical_p, canonical_metadata in same_size:
+            if all(query_metadata[key] == canonical_metadata[key] for key in match_keys):
+                candidates.append((canonical_p, canonical_metadata))
+        result["metadata_candidate"] = len(candidates) > 0
+        result["num_metadata_candidates"] = len(candidates)
+
+        return candidates
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _split_on_previous(self,
+                           query_p,
+                           query_stat,
+                           candidates,
+                           result) -> tuple:
+        """
+        Finds the candidates whose result from the previous compare still holds (see PreviousResults), so that only
+        the candidates that have changed since are compared to the query file.
+
+        :param query_p: The path to the query file.
+        :param query_stat: The FileStat of the query file.
+        :param candidates: A list of (path, metadata) tuples of canonical files.
+        :param result: The result dictionary of the query file. Whether a previous result was used is filled in.
+
+        :return: A tuple of (the set of paths of the candidates that still match the query file, the list of (path,
+                 metadata) tuples of the candidates that still need to be compared).
+        """
+
+        if self.previous_results is None:
+            return set(), candidates
+
+        split = self.previous_results.split_candidates(query_p, query_stat, candidates)
+        if split is None:
+            return set(), candidates
+
+        result["previous_result"] = True
+        return split
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _compare_file(self,
+                      query_p,
+                      query_stat,
+                      canonical_lookup,
+                      match_keys,
+                      skip_checksum) -> dict:
+        """
+        Compares a single query file to the canonical files. Does not modify the session's results, so it is safe to
+        call from worker threads. The returned result is merged into the session by _record_result.
+
+        :param query_p: The path to the query file.
+        :param query_stat: The FileStat of the query file, as recorded by the query scan.
+        :param canonical_lookup: The dictionary of canonical files grouped by size.
+        :param match_keys: The list of metadata keys that must match.
+        :param skip_checksum: If True, files that pass the metadata checks are considered duplicates without being
+               checksummed.
+
+        :return: A result dictionary.
+        """
+
+        result = self._new_result(query_p)
+
+        query_metadata = self._get_metadata(query_p, self._get_root(query_p, self.query_items), query_stat)
+        candidates = self._metadata_candidates(query_p, query_metadata, canonical_lookup, match_keys, result)
+
+        if candidates and not skip_checksum:
+            linked = self._hardlinked_candidates(query_stat, candidates)
+            result["hardlink_matches"] = len(linked)
+            unlinked = [candidate for candidate in candidates if candidate[0] not in linked]
+            previous, unlinked = self._split_on_previous(query_p, query_stat, unlinked, result)
+            # Hard linked candidates, and candidates that matched in the previous compare, match without being read.
+            known = linked.union(previous)
+            try:
+                use_partial = 0 < self.partial_checksum_size and 3 * self.partial_checksum_size < query_metadata["size"]
+                if unlinked and use_partial and not self._full_checksums_known(unlinked):
+                    unlinked = self._filter_on_checksum(query_p, query_metadata, unlinked, result,
+                                                        self.partial_checksum_size)
+                    result["partial_checksum_eliminated"] = len(unlinked) == 0 and not known
+                if unlinked:
+                    result["full_checksum_candidate"] = True
+                    if self._use_byte_compare(query_p, query_stat, unlinked):
+                        unlinked = self._filter_on_bytes(query_p, query_stat, unlinked, result)
+                    else:
+                        unlinked = self._filter_on_checksum(query_p, query_metadata, unlinked, result)
+            except OSError:
+                if not known:
+                    return result
+                unlinked = list()
+            matched = known.union(canonical_p for canonical_p, canonical_metadata in unlinked)
+            candidates = [candidate for candidate in candidates if candidate[0] in matched]
+
+        if candidates:
+            result["status"] = "D"
+            result["matches"] = [canonical_p for canonical_p, canonical_metadata in candidates]
+        else:
+            result["status"] = "U"
+
+        return result
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _record_result(self,
+                       result):
+        """
+        Merges the result of comparing a single query file into the session, and passes it on to the result handler
+        (if there is one).
+
+        :param result: The result dictionary returned by _compare_file.
+
+        :return: Nothing.
+        """
+
+        query_p = result["query_p"]
+
+        if result["status"] == "D":
+            self.duplicate_count += 1
+        elif result["status"] == "U":
+            self.unique_count += 1
+        else:
+            self.source_error_count += 1
+        self.skipped_self_count += result["skipped_self"]
+        self.possible_match_error_count += len(result["possible_match_errors"])
+
+        if self.retain_results:
+            if result["status"] == "D":
+                self.duplicates[query_p] = result["matches"]
+            elif result["status"] == "U":
+                self.unique.append(query_p)
+            else:
+                self.source_error_files.append(query_p)
+            self.skipped_self.extend([query_p] * result["skipped_self"])
+            self.possible_match_error_files.extend(result["possible_match_errors"])
+
+        if self.result_handler is not None:
+            self.result_handler(result)
+
+        self.size_candidate_count += result["size_candidate"]
+        self.metadata_candidate_count += result["metadata_candidate"]
+        self.partial_checksum_eliminated_count += result["partial_checksum_eliminated"]
+        self.full_checksum_candidate_count += result["full_checksum_candidate"]
+        self.hardlink_match_count += result["hardlink_matches"] > 0
+        self.previous_result_count += result["previous_result"]
+
+        if registry.enabled:
+            registry.update({"compare_files": 1,
+                             "compare_size_candidates": result["num_size_candidates"],
+                             "compare_metadata_candidates": result["num_metadata_candidates"],
+                             "compare_hardlink_matches": result["hardlink_matches"]})
+            registry.maximum("compare_max_size_candidates", result["num_size_candidates"])
+            registry.maximum("compare_max_metadata_candidates", result["num_metadata_candidates"])
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _compare_files_in_pool(self,
+                               canonical_lookup,
+                               match_keys,
+                               skip_checksum):
+        """
+        Compares the query files on a pool of worker threads. Only a limited number of files are in flight at any one
+        time, and results are recorded strictly in query scan order as soon as all earlier files have finished.
+
+        :param canonical_lookup: The dictionary of canonical files grouped by size.
+        :param match_keys: The list of metadata keys that must match.
+        :param skip_checksum: If True, files that pass the metadata checks are considered duplicates without being
+               checksummed.
+
+        :return: A generator that yields the number of query files completed so far (in any order).
+        """
+
+        max_in_flight = self.jobs * 4
+        query_files = self.query_scan.files
+        query_ids = iter(range(len(query_files)))
+        compare_file = profiler.wrap(self._compare_file)
+        in_flight = dict()
+        finished = dict()
+        next_index = 0
+        submitted = 0
+        count = 0
+
+        executor = futures.ThreadPoolExecutor(max_workers=self.jobs)
+        try:
+            while True:
+                while len(in_flight) < max_in_flight:
+                    query_id = next(query_ids, None)
+                    if query_id is None:
+                        break
+                    future = executor.submit(compare_file,
+                                             query_files.path(query_id),
+                                             query_files.stat(query_id),
+                                             canonical_lookup,
+                                             match_keys,
+                                             skip_checksum)
+                    in_flight[future] = submitted
+                    submitted += 1
+
+                if not in_flight:
+                    break
+
+                done, not_done = futures.wait(in_flight, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    index = in_flight.pop(future)
+                    finished[index] = future.result()
+                    self.compared_bytes += query_files.sizes[index]
+                    count += 1
+                    if count % self.report_frequency == 0:
+                        yield count
+
+                while next_index in finished:
+                    self._record_result(finished.pop(next_index))
+                    next_index += 1
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        yield count
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _compare_files_scheduled(self,
+                                 canonical_lookup,
+                                 match_keys):
+        """
+        Compares the query files one batch at a time: the checksums each batch needs are read ahead in disk order by the
+        I/O scheduler, and then the files of the batch are compared in query scan order (reading nothing more, unless a
+        read ahead failed).
+
+        :param canonical_lookup: The dictionary of canonical files grouped by size.
+        :param match_keys: The list of metadata keys that must match.
+
+        :return: A generator that yields the number of query files processed so far.
+        """
+
+        query_files = self.query_scan.files
+        count = 0
+        for batch_start in range(0, len(query_files), IO_SCHEDULE_BATCH_SIZE):
+            query_ids = range(batch_start, min(batch_start + IO_SCHEDULE_BATCH_SIZE, len(query_files)))
+            self._prefetch_checksums(query_ids, canonical_lookup, match_keys)
+            yield count
+
+            for query_id in query_ids:
+                self._record_result(self._compare_file(query_files.path(query_id),
+                                                       query_files.stat(query_id),
+                                                       canonical_lookup,
+                                                       match_keys,
+                                                       False))
+                self.compared_bytes += query_files.sizes[query_id]
+                count += 1
+                if count % self.report_frequency == 0:
+                    yield count
+
+        yield count
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _prefetch_checksums(self,
+                            query_ids,
+                            canonical_lookup,
+                            match_keys):
+        """
+        Works out which checksums the compare of a batch of query files will need, and reads them in disk order. The
+        partial checksums are read first, and only the files whose partial checksums still match go on to have their
+        full checksums read, exactly as _compare_file would decide.
+
+        :param query_ids: The ids of the query files in the batch.
+        :param canonical_lookup: The dictionary of canonical files grouped by size.
+        :param match_keys: The list of metadata keys that must match.
+
+        :return: Nothing.
+        """
+
+        query_files = self.query_scan.files
+        pending = list()
+        partial_reads = dict()
+        for query_id in query_ids:
+            query_p = query_files.path(query_id)
+            query_stat = query_files.stat(query_id)
+            query_metadata = self._get_metadata(query_p, self._get_root(query_p, self.query_items), query_stat)
+            candidates = self._metadata_candidates(query_p, query_metadata, canonical_lookup, match_keys,
+                                                   self._new_result(query_p))
+            linked = self._hardlinked_candidates(query_stat, candidates)
+            unlinked = [candidate for candidate in candidates if candidate[0] not in linked]
+            unlinked = self._split_on_previous(query_p, query_stat, unlinked, self._new_result(query_p))[1]
+            if not unlinked:
+                continue
+
+            use_partial = 0 < self.partial_checksum_size and 3 * self.partial_checksum_size < query_metadata["size"]
+            use_partial = use_partial and not self._full_checksums_known(unlinked)
+            unlinked = [(canonical_p, canonical_metadata["stat"]) for canonical_p, canonical_metadata in unlinked]
+            pending.append((query_p, query_stat, unlinked, use_partial))
+            if use_partial:
+                partial_reads.update([(query_p, query_stat)] + unlinked)
+
+        self._read_scheduled(partial_reads, self.partial_checksum_size)
+
+        full_reads = dict()
+        with self._checksums_lock:
+            for query_p, query_stat, unlinked, use_partial in pending:
+                if use_partial:
+                    query_checksum = self._checksums.get((query_p, self.partial_checksum_size))
+                    if query_checksum is None:
+                        continue
+                    unlinked = [(canonical_p, canonical_stat) for canonical_p, canonical_stat in unlinked
+                                if self._checksums.get((canonical_p, self.partial_checksum_size)) == query_checksum]
+                    if not unlinked:
+                        continue
+                full_reads.update([(query_p, query_stat)] + unlinked)
+
+        self._read_scheduled(full_reads, None)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _read_scheduled(self,
+                        reads,
+                        sample_size):
+        """
+        Reads the checksums of files in disk order with the I/O scheduler, skipping any that are already known. Each
+        checksum read is remembered as read ahead, so its first use by the compare is not counted as a reuse.
+
+        :param reads: A dictionary of the stat results of the files to read, keyed on path.
+        :param sample_size: The sample size of the partial checksums to read, or None for full checksums.
+
+        :return: Nothing.
+        """
+
+        with self._checksums_lock:
+            reads = [(file_p, stat_result) for file_p, stat_result in reads.items()
+                     if (file_p, sample_size) not in self._checksums]
+
+        def read(file_p, stat_result):
+            self._checksum(file_p, stat_result, sample_size)
+            with self._checksums_lock:
+                self._prefetched.add((file_p, sample_size))
+
+        self.io_scheduler.run(read, reads)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _compare_files_external(self,
+                                match_keys,
+                                skip_checksum):
+        """
+        Compares the query files to the canonical files one size at a time, reading both scans back from their spill
+        sorters in order of size (see extsort.merge_join). Only the canonical files of the size being compared are held
+        in memory, and the checksums computed for one size are dropped before the next, since files of different sizes
+        are never compared. The run files are deleted once the compare ends.
+
+        :param match_keys: The list of metadata keys that must match.
+        :param skip_checksum: If True, files that pass the metadata checks are considered duplicates without being
+               checksummed.
+
+        :return: A generator that yields the number of query files processed so far.
+        """
+
+        count = 0
+        try:
+            groups = extsort.merge_join(self.query_scan.spill.sorted(), self.canonical_scan.spill.sorted())
+            for size, query_records, canonical_records in groups:
+
+                # The canonical files of this size stand in for all of the canonical files while the query files of
+                # this size are compared.
+                self.canonical_files = FileTable()
+                for record in canonical_records:
+                    self.canonical_files.add(record[1],
+                                             record[2],
+                                             extsort.record_stat(record),
+                                             extsort.record_checksum(record))
+                canonical_lookup = {size: range(len(self.canonical_files))}
+
+                def compare_file(record):
+                    return self._compare_file(extsort.record_path(record),
+                                              extsort.record_stat(record),
+                                              canonical_lookup,
+                                              match_keys,
+                                              skip_checksum)
+
+                for result in self._map_in_order(compare_file, query_records):
+                    self._record_result(result)
+                    self.compared_bytes += size
+                    count += 1
+                    if count % self.report_frequency == 0:
+                        yield count
+
+                with self._checksums_lock:
+                    self._checksums = dict()
+        finally:
+            self.query_scan.spill.close()
+            self.canonical_scan.spill.close()
+
+        yield count
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def do_compare(self,
+                   name=False,
+                   file_type=False,
+                   parent=False,
+                   rel_path=False,
+                   ctime=False,
+                   mtime=False,
+                   skip_checksum=False,
+                   result_handler=None,
+                   retain_results=True):
+        """
+        Compares every query file to the canonical files. Results are counted in self.duplicate_count,
+        self.unique_count, self.source_error_count, self.possible_match_error_count, and self.skipped_self_count. Unless
+        retain_results is False, the results themselves are also accumulated in self.duplicates, self.unique,
+        self.source_error_files, self.possible_match_error_files, and self.skipped_self. The sizes of the query files
+        compared so far are added up in self.compared_bytes, for progress messages.
+
+        :param name: If True, file names must match.
+        :param file_type: If True, file extensions must match.
+        :param parent: If True, the names of the parent directories must match.
+        :param rel_path: If True, the paths relative to the scan roots must match.
+        :param ctime: If True, the creation times must match.
+        :param mtime: If True, the modification times must match.
+        :param skip_checksum: If True, files that pass the metadata checks are considered duplicates without being
+               checksummed.
+        :param result_handler: An optional function that is called with each result dictionary, in query scan order,
+               as soon as it is available (for example, to stream the results to a log file).
+        :param retain_results: If False, results are only counted and passed to the result handler, not kept in
+               memory. Defaults to True.
+
+        :return: A generator that yields the number of query files processed so far.
+        """
+
+        self._reset_results(result_handler, retain_results)
+        match_keys = self._match_keys(name, file_type, parent, rel_path, ctime, mtime)
+
+        if self.query_scan.spill is not None:
+            yield from self._compare_files_external(match_keys, skip_checksum)
+            return
+
+        self._merge_canonical_files()
+        self._reuse_index_checksums()
+        canonical_lookup = self._build_canonical_lookup()
+
+        if self.io_scheduler is not None and not skip_checksum:
+            yield from self._compare_files_scheduled(canonical_lookup, match_keys)
+            return
+
+        if self.jobs > 1:
+            yield from self._compare_files_in_pool(canonical_lookup, match_keys, skip_checksum)
+            return
+
+        query_files = self.query_scan.files
+        count = 0
+        for count, query_id in enumerate(range(len(query_files)), start=1):
+            self._record_result(self._compare_file(query_files.path(query_id),
+                                                   query_files.stat(query_id),
+                                                   canonical_lookup,
+                                                   match_keys,
+                                                   skip_checksum))
+            self.compared_bytes += query_files.sizes[query_id]
+            if count % self.report_frequency == 0:
+                yield count
+
+        yield count
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def compare_paths(self,
+                      paths,
+                      name=False,
+                      file_type=False,
+                      parent=False,
+                      rel_path=False,
+                      ctime=False,
+                      mtime=False,
+                      skip_checksum=False) -> list:
+        """
+        Compares a batch of files, given by path, to the canonical files. Unlike do_compare, the files do not have to
+        have been found by the query scan, and the results are returned instead of being merged into the session, so a
+        resident session may answer any number of batches, from several threads at once. The canonical files are
+        grouped by size once, and the grouping is kept until the canonical scan is replaced.
+
+        :param paths: A list of paths to the files to compare.
+        :param name: If True, file names must match.
+        :param file_type: If True, file extensions must match.
+        :param parent: If True, the names of the parent directories must match.
+        :param rel_path: If True, the paths relative to the query items must match.
+        :param ctime: If True, the creation times must match.
+        :param mtime: If True, the modification times must match.
+        :param skip_checksum: If True, files that pass the metadata checks are considered duplicates without being
+               checksummed.
+
+        :return: A list of result dictionaries, in the same order as the paths. A path that cannot be stat'ed, or that
+                 is not a regular file, has a status of "SE".
+        """
+
+        match_keys = self._match_keys(name, file_type, parent, rel_path, ctime, mtime)
+
+        canonical_lookup = self._canonical_lookup
+        if canonical_lookup is None:
+            self._merge_canonical_files()
+            self._reuse_index_checksums()
+            canonical_lookup = self._canonical_lookup = self._build_canonical_lookup()
+
+        return list(self._map_in_order(lambda file_p: self._compare_path(file_p,
+                                                                         canonical_lookup,
+                                                                         match_keys,
+                                                                         skip_checksum),
+                                       paths))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _compare_path(self,
+                      query_p,
+                      canonical_lookup,
+                      match_keys,
+                      skip_checksum) -> dict:
+        """
+        Compares a single file, given by path, to the canonical files.
+
+        :param query_p: The path to the file.
+        :param canonical_lookup: The dictionary of canonical files grouped by size.
+        :param match_keys: The list of metadata keys that must match.
+        :param skip_checksum: If True, files that pass the metadata checks are considered duplicates without being
+               checksummed.
+
+        :return: A result dictionary.
+        """
+
+        query_p = os.path.abspath(query_p)
+        try:
+            stat_result = os.stat(query_p)
+        except OSError:
+            return self._new_result(query_p)
+        if not stat.S_ISREG(stat_result.st_mode):
+            return self._new_result(query_p)
+
+        return self._compare_file(query_p, FileStat.from_stat(stat_result), canonical_lookup, match_keys, skip_checksum)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def do_self_compare(self,
+                        name=False,
+                        file_type=False,
+                        parent=False,
+                        rel_path=False,
+                        ctime=False,
+                        mtime=False,
+                        skip_checksum=False,
+                        keeper_rule="first",
+                        result_handler=None,
+                        retain_results=True):
+        """
+        Finds the duplicates among the query files themselves. The canonical directory is not used.
+
+        Instead of comparing each file to its own list of candidates, the query files are grouped in a few linear
+        passes. Each pass reads more data than the one before, but only looks at the files that are still in a group of
+        two or more: first by size (no reads), then by the metadata checks requested (no reads), then by partial
+        checksum, and finally by full checksum. Every group left at the end is a cluster of identical files. One file
+        of each cluster is kept (picked by keeper_rule) and every other file in it is recorded as a duplicate of the
+        keeper, so the results have the same form as those of do_compare and may be written to a result log for
+        deleteFiles. Keepers are counted in self.keeper_count but are not recorded. Files that are not in a cluster are
+        recorded as unique. A file that was scanned twice (because it is under more than one query item) is only
+        compared once, and the repeat is counted in self.skipped_self_count.
+
+        :param name: If True, file names must match.
+        :param file_type: If True, file extensions must match.
+        :param parent: If True, the names of the parent directories must match.
+        :param rel_path: If True, the paths relative to the scan roots must match.
+        :param ctime: If True, the creation times must match.
+        :param mtime: If True, the modification times must match.
+        :param skip_checksum: If True, files that pass the metadata checks are considered duplicates without being
+               checksummed.
+        :param keeper_rule: How the file to keep is picked from each cluster, one of KEEPER_RULES. Defaults to "first".
+        :param result_handler: An optional function that is called with each result dictionary, in query scan order.
+        :param retain_results: If False, results are only counted and passed to the result handler, not kept in
+               memory. Defaults to True.
+
+        :return: A generator that yields the number of query files settled so far. Raises a ValueError if the keeper
+                 rule is unknown.
+        """
+
+        if keeper_rule not in KEEPER_RULES:
+            raise ValueError(f"Unknown keeper rule: {keeper_rule}")
+
+        self._reset_results(result_handler, retain_results)
+        match_keys = self._match_keys(name, file_type, parent, rel_path, ctime, mtime)
+
+        query_files = self.query_scan.files
+        num_files = len(query_files)
+        size_candidates = [0] * num_files
+        metadata_candidates = [0] * num_files
+        partial_eliminated = set()
+        full_candidates = set()
+        errors = set()
+        repeats = set()
+
+        by_size = dict()
+        for file_id, size in enumerate(query_files.sizes):
+            by_size.setdefault(size, list()).append(file_id)
+
+        groups = list()
+        for file_ids in by_size.values():
+            if len(file_ids) > 1:
+                file_ids = self._drop_repeated_paths(file_ids, repeats)
+            if len(file_ids) > 1:
+                groups.append(file_ids)
+                for file_id in file_ids:
+                    size_candidates[file_id] = len(file_ids) - 1
+        del by_size
+        yield num_files - sum(len(group) for group in groups)
+
+        if match_keys:
+            groups = self._split_on_metadata(groups, match_keys)
+            yield num_files - sum(len(group) for group in groups)
+        for group in groups:
+            for file_id in group:
+                metadata_candidates[file_id] = len(group) - 1
+
+        if not skip_checksum:
+            if 0 < self.partial_checksum_size:
+                sampled = [group for group in groups if 3 * self.partial_checksum_size < query_files.sizes[group[0]]]
+                groups = [group for group in groups if 3 * self.partial_checksum_size >= query_files.sizes[group[0]]]
+                settled = num_files - sum(len(group) for group in sampled + groups)
+                sampled, eliminated = yield from self._split_on_checksum(sampled,
+                                                                         self.partial_checksum_size,
+                                                                         errors,
+                                                                         settled,
+                                                                         last_pass=False)
+                partial_eliminated.update(eliminated)
+                groups.extend(sampled)
+
+            for group in groups:
+                full_candidates.update(group)
+            settled = num_files - sum(len(group) for group in groups)
+            groups, eliminated = yield from self._split_on_checksum(groups, None, errors, settled, last_pass=True)
+
+        keepers = dict()
+        for cluster in groups:
+            keeper_id = self._choose_keeper(cluster, keeper_rule)
+            for file_id in cluster:
+                keepers[file_id] = keeper_id
+        self.keeper_count = len(groups)
+
+        for file_id in range(num_files):
+            query_p = query_files.path(file_id)
+            if file_id in repeats:
+                self.skipped_self_count += 1
+                if self.retain_results:
+                    self.skipped_self.append(query_p)
+                continue
+
+            keeper_id = keepers.get(file_id)
+            if keeper_id == file_id:
+                continue
+
+            result = self._new_result(query_p)
+            result["size_candidate"] = size_candidates[file_id] > 0
+            result["num_size_candidates"] = size_candidates[file_id]
+            result["metadata_candidate"] = metadata_candidates[file_id] > 0
+            result["num_metadata_candidates"] = metadata_candidates[file_id]
+            result["partial_checksum_eliminated"] = file_id in partial_eliminated
+            result["full_checksum_candidate"] = file_id in full_candidates
+            if keeper_id is not None:
+                result["status"] = "D"
+                result["matches"] = [query_files.path(keeper_id)]
+                if (query_files.inodes[file_id] and query_files.inodes[file_id] == query_files.inodes[keeper_id] and
+                        query_files.devices[file_id] == query_files.devices[keeper_id]):
+                    result["hardlink_matches"] = 1
+            elif file_id not in errors:
+                result["status"] = "U"
+            self._record_result(result)
+
+        yield num_files
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _item_index(self,
+                    file_p) -> int:
+        """
+        :param file_p: The path to a query file.
+
+        :return: The position in the list of query items of the item the file was found under (or is).
+        """
+
+        for i, item in enumerate(self.query_items):
+            if file_p == item or file_p.startswith(item.rstrip(os.path.sep) + os.path.sep):
+                return i
+        return len(self.query_items)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _choose_keeper(self,
+                       file_ids,
+                       keeper_rule) -> int:
+        """
+        Picks the file to keep from a cluster of identical files. Ties are broken by path, so the choice does not depend
+        on the order the files were scanned in.
+
+        :param file_ids: The list of query file ids in the cluster.
+        :param keeper_rule: One of KEEPER_RULES.
+
+        :return: The file id of the keeper.
+        """
+
+        query_files = self.query_scan.files
+
+        if keeper_rule == "first":
+            keys = {file_id: (self._item_index(query_files.path(file_id)),) for file_id in file_ids}
+        elif keeper_rule == "oldest":
+            keys = {file_id: (query_files.mtimes[file_id],) for file_id in file_ids}
+        elif keeper_rule == "newest":
+            keys = {file_id: (-query_files.mtimes[file_id],) for file_id in file_ids}
+        elif keeper_rule == "shortest":
+            keys = {file_id: (len(query_files.path(file_id)),) for file_id in file_ids}
+        else:
+            keys = {file_id: (-len(query_files.path(file_id)),) for file_id in file_ids}
+
+        return min(file_ids, key=lambda file_id: keys[file_id] + (query_files.path(file_id),))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _drop_repeated_paths(self,
+                             file_ids,
+                             repeats) -> list:
+        """
+        Removes any file that appears more than once in a list of query file ids (which happens when one query item
+        is inside another). A file must never be reported as a duplicate of itself.
+
+        :param file_ids: A list of query file ids.
+        :param repeats: A set that the ids of the repeated files are added to.
+
+        :return: The list of file ids, keeping the first id of each path.
+        """
+
+        query_files = self.query_scan.files
+        paths = set()
+        unique_ids = list()
+        for file_id in file_ids:
+            file_p = query_files.path(file_id)
+            if file_p in paths:
+                repeats.add(file_id)
+                continue
+            paths.add(file_p)
+            unique_ids.append(file_id)
+        return unique_ids
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _split_on_metadata(self,
+                           groups,
+                           match_keys) -> list:
+        """
+        Splits each group of query files into smaller groups of files whose metadata match.
+
+        :param groups: A list of lists of query file ids.
+        :param match_keys: The list of metadata keys that must match.
+
+        :return: The list of groups of two or more files that still match.
+        """
+
+        query_files = self.query_scan.files
+        matched_groups = list()
+        for group in groups:
+            by_metadata = dict()
+            for file_id in group:
+                file_p = query_files.path(file_id)
+                root = self._get_root(file_p, self.query_items)
+                metadata = self._get_metadata(file_p, root, query_files.stat(file_id))
+                by_metadata.setdefault(tuple(metadata[key] for key in match_keys), list()).append(file_id)
+            matched_groups.extend(file_ids for file_ids in by_metadata.values() if len(file_ids) > 1)
+        return matched_groups
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _query_checksum(self,
+                        file_id,
+                        sample_size=None):
+        """
+        :param file_id: The id of a query file.
+        :param sample_size: If given, a partial checksum is returned instead of a full checksum.
+
+        :return: The checksum of the query file, or None if it cannot be read.
+        """
+
+        query_files = self.query_scan.files
+        try:
+            return self._checksum(query_files.path(file_id), query_files.stat(file_id), sample_size)
+        except OSError:
+            return None
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _map_in_order(self,
+                      function,
+                      items):
+        """
+        Calls a function on each item (on a pool of worker threads if jobs is greater than 1) and yields the results in
+        the order of the items. Only a limited number of items are in flight at any one time.
+
+        :param function: The function to call. It must be safe to call from worker threads.
+        :param items: A list of the items to call it on.
+
+        :return: A generator that yields the results.
+        """
+
+        if self.jobs == 1:
+            for item in items:
+                yield function(item)
+            return
+
+        max_in_flight = self.jobs * 4
+        function = profiler.wrap(function)
+        in_flight = collections.deque()
+
+        executor = futures.ThreadPoolExecutor(max_workers=self.jobs)
+        try:
+            for item in items:
+                in_flight.append(executor.submit(function, item))
+                if len(in_flight) >= max_in_flight:
+                    yield in_flight.popleft().result()
+            while in_flight:
+                yield in_flight.popleft().result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _split_on_checksum(self,
+                           groups,
+                           sample_size,
+                           errors,
+                           settled,
+                           last_pass):
+        """
+        Splits each group of query files into smaller groups of files with the same checksum, in a single pass over all
+        of the groups. Only one file of each set of hard links in a group is checksummed; the others share its
+        checksum.
+
+        :param groups: A list of lists of query file ids.
+        :param sample_size: If given, partial checksums are compared instead of full checksums.
+        :param errors: A set that the ids of any files that cannot be read are added to.
+        :param settled: The number of query files that were settled before this pass.
+        :param last_pass: If True, the files that still match once their group is split are settled as well (they
+               belong to a cluster).
+
+        :return: A generator that periodically yields the number of query files settled so far, and returns a tuple of
+                 the list of groups of two or more files that still match and the list of ids of the files that no
+                 longer match any other file.
+        """
+
+        query_files = self.query_scan.files
+
+        linked = dict()
+        to_checksum = list()
+        for group in groups:
+            inodes = dict()
+            for file_id in group:
+                if query_files.inodes[file_id]:
+                    first_id = inodes.setdefault((query_files.devices[file_id], query_files.inodes[file_id]), file_id)
+                    if first_id != file_id:
+                        linked[file_id] = first_id
+                        continue
+                to_checksum.append(file_id)
+
+        checksums = self._map_in_order(lambda file_id: self._query_checksum(file_id, sample_size), to_checksum)
+
+        matched_groups = list()
+        eliminated = list()
+        last_settled = settled
+        for group in groups:
+            group_checksums = dict()
+            for file_id in group:
+                if file_id not in linked:
+                    group_checksums[file_id] = next(checksums)
+
+            by_checksum = dict()
+            for file_id in group:
+                checksum_str = group_checksums[linked.get(file_id, file_id)]
+                if checksum_str is None:
+                    errors.add(file_id)
+                    settled += 1
+                else:
+                    by_checksum.setdefault(checksum_str, list()).append(file_id)
+
+            for file_ids in by_checksum.values():
+                if len(file_ids) > 1:
+                    matched_groups.append(file_ids)
+                    if last_pass:
+                        settled += len(file_ids)
+                else:
+                    eliminated.extend(file_ids)
+                    settled += 1
+
+            if settled - last_settled >= self.report_frequency:
+                last_settled = settled
+                yield settled
+
+        return matched_groups, eliminated
@@ -0,0 +1,255 @@
+#! /usr/bin/env python3
+"""
+A module to build synthetic query and canonical directory trees with a controlled shape, for benchmarking.
+"""
+import math
+import os
+import random
+import shutil
+
+SIZE_DISTRIBUTIONS = ["fixed", "uniform", "lognormal"]
+
+WRITE_CHUNK_SIZE = 1024 * 1024
+
+
+class TreeSpec(object):
+    """
+    A class to describe the shape of a pair of synthetic trees. The same spec (including the seed) always builds the
+    same trees, byte for byte.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self,
+                 file_count=1000,
+                 canonical_file_count=None,
+                 min_size=1024,
+                 max_size=1024 * 1024,
+                 size_distribution="lognormal",
+                 duplicate_ratio=0.5,
+                 same_size_ratio=0.1,
+                 depth=3,
+                 fan_out=4,
+                 hidden_ratio=0.05,
+                 seed=0):
+        """
+        :param file_count: The number of files in the query tree. Defaults to 1000.
+        :param canonical_file_count: The number of files in the canonical tree. Defaults to file_count.
+        :param min_size: The smallest file size in bytes. Defaults to 1 KiB.
+        :param max_size: The largest file size in bytes. Defaults to 1 MiB.
+        :param size_distribution: How file sizes are picked between min_size and max_size: "fixed" (every file is
+               max_size), "uniform", or "lognormal" (mostly small files with a long tail of large ones). Defaults to
+               "lognormal".
+        :param duplicate_ratio: The fraction of query files that are exact copies of a canonical file. Defaults to 0.5.
+        :param same_size_ratio: The fraction of query files that are copies of a canonical file with a single byte
+               changed at a random offset: the same size, but different contents. Defaults to 0.1.
+        :param depth: How many levels of sub-directories each tree has. Defaults to 3.
+        :param fan_out: How many sub-directories each directory has (above the last level). Defaults to 4.
+        :param hidden_ratio: The fraction of files whose names start with a ".". Defaults to 0.05.
+        :param seed: The seed for the random number generator. Defaults to 0.
+
+        :return: Nothing.
+        """
+
+        if size_distribution not in SIZE_DISTRIBUTIONS:
+            raise ValueError(f"Unknown size distribution: {size_distribution}")
+        if not 0 < min_size <= max_size:
+            raise ValueError("The minimum size must be greater than 0 and no larger than the maximum size")
+        if duplicate_ratio < 0 or same_size_ratio < 0 or duplicate_ratio + same_size_ratio > 1:
+            raise ValueError("The duplicate and same size ratios must be positive and add up to no more than 1")
+
+        self.file_count = file_count
+        self.canonical_file_count = file_count if canonical_file_count is None else canonical_file_count
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size_distribution = size_distribution
+        self.duplicate_ratio = duplicate_ratio
+        self.same_size_ratio = same_size_ratio
+        self.depth = depth
+        self.fan_out = fan_out
+        self.hidden_ratio = hidden_ratio
+        self.seed = seed
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def to_dict(self) -> dict:
+        """
+        :return: The spec as a dictionary that can be serialized as JSON.
+        """
+
+        return dict(vars(self))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _dir_paths(depth,
+               fan_out) -> list:
+    """
+    Lists the relative paths of every directory in a tree of the given depth and fan out, including the root ("").
+
+    :param depth: The number of levels of sub-directories.
+    :param fan_out: The number of sub-directories of each directory above the last level.
+
+    :return: A list of relative directory paths.
+    """
+
+    dir_paths = [""]
+    level = [""]
+    for level_index in range(depth):
+        level = [os.path.join(parent_d, f"dir_{level_index}_{i:03d}") for parent_d in level for i in range(fan_out)]
+        dir_paths.extend(level)
+    return dir_paths
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _random_size(rng,
+                 spec) -> int:
+    """
+    Picks a file size from the spec's size distribution.
+
+    :param rng: The random.Random object to use.
+    :param spec: The TreeSpec.
+
+    :return: The size in bytes.
+    """
+
+    if spec.size_distribution == "fixed":
+        return spec.max_size
+
+    if spec.size_distribution == "uniform":
+        return rng.randint(spec.min_size, spec.max_size)
+
+    mu = (math.log(spec.min_size) + math.log(spec.max_size)) / 2
+    sigma = max((math.log(spec.max_size) - math.log(spec.min_size)) / 6, 1e-9)
+    return min(max(int(rng.lognormvariate(mu, sigma)), spec.min_size), spec.max_size)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _file_name(rng,
+               spec,
+               prefix,
+               index) -> str:
+    """
+    Builds a file name, hidden or not according to the spec's hidden ratio.
+
+    :param rng: The random.Random object to use.
+    :param spec: The TreeSpec.
+    :param prefix: A prefix for the name.
+    :param index: The index of the file, to make the name unique.
+
+    :return: The file name.
+    """
+
+    name = f"{prefix}_{index:07d}.dat"
+    if rng.random() < spec.hidden_ratio:
+        return f".{name}"
+    return name
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _write_random_file(file_p,
+                       size,
+                       seed):
+    """
+    Writes a file of random bytes.
+
+    :param file_p: The path to the file.
+    :param size: The size of the file in bytes.
+    :param seed: The seed for the contents of the file.
+
+    :return: Nothing.
+    """
+
+    rng = random.Random(seed)
+    with open(file_p, "wb") as file_f:
+        remaining = size
+        while remaining > 0:
+            chunk_size = min(remaining, WRITE_CHUNK_SIZE)
+            file_f.write(rng.randbytes(chunk_size))
+            remaining -= chunk_size
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def build_trees(root_d,
+                spec) -> dict:
+    """
+    Builds a canonical tree and a query tree under root_d, in directories named "canonical" and "query". Neither may
+    already exist.
+
+    The canonical tree is made of files of random contents. The query tree is made of exact copies of randomly chosen
+    canonical files (some canonical files are copied more than once), copies of canonical files with one byte changed,
+    and files of random contents and sizes that exist only in the query tree. Both trees share the same directory
+    structure, and files are spread across it at random.
+
+    :param root_d: The directory to build the trees in. It is created if needed.
+    :param spec: The TreeSpec describing the trees.
+
+    :return: A dictionary describing the trees that were built: their paths and the number of files and bytes of each
+             kind.
+    """
+
+    rng = random.Random(spec.seed)
+
+    canonical_d = os.path.join(root_d, "canonical")
+    query_d = os.path.join(root_d, "query")
+    for tree_d in (canonical_d, query_d):
+        if os.path.exists(tree_d):
+            raise FileExistsError(f"Directory already exists: {tree_d}")
+
+    dir_paths = _dir_paths(spec.depth, spec.fan_out)
+    for tree_d in (canonical_d, query_d):
+        for dir_p in dir_paths:
+            os.makedirs(os.path.join(tree_d, dir_p), exist_ok=True)
+
+    summary = {"canonical_dir": canonical_d,
+               "query_dir": query_d,
+               "dirs": len(dir_paths),
+               "canonical_files": 0,
+               "canonical_bytes": 0,
+               "query_files": 0,
+               "query_bytes": 0,
+               "duplicates": 0,
+               "same_size_different": 0,
+               "unique": 0,
+               "hidden_files": 0}
+
+    canonical_files = list()
+    for index in range(spec.canonical_file_count):
+        name = _file_name(rng, spec, "canonical", index)
+        file_p = os.path.join(canonical_d, rng.choice(dir_paths), name)
+        size = _random_size(rng, spec)
+        _write_random_file(file_p, size, rng.getrandbits(64))
+        canonical_files.append((file_p, size))
+        summary["canonical_files"] += 1
+        summary["canonical_bytes"] += size
+        summary["hidden_files"] += name.startswith(".")
+
+    duplicate_count = round(spec.file_count * spec.duplicate_ratio)
+    same_size_count = min(round(spec.file_count * spec.same_size_ratio), spec.file_count - duplicate_count)
+    if not canonical_files:
+        duplicate_count = same_size_count = 0
+
+    for index in range(spec.file_count):
+        name = _file_name(rng, spec, "query", index)
+        file_p = os.path.join(query_d, rng.choice(dir_paths), name)
+
+        if index < duplicate_count + same_size_count:
+            source_p, size = rng.choice(canonical_files)
+            shutil.copyfile(source_p, file_p)
+            if index < duplicate_count:
+                summary["duplicates"] += 1
+            else:
+                offset = rng.randrange(size)
+                with open(file_p, "r+b") as file_f:
+                    file_f.seek(offset)
+                    byte = file_f.read(1)
+                    file_f.seek(offset)
+                    file_f.write(bytes([byte[0] ^ 0xFF]))
+                summary["same_size_different"] += 1
+        else:
+            size = _random_size(rng, spec)
+            _write_random_file(file_p, size, rng.getrandbits(64))
+            summary["unique"] += 1
+
+        summary["query_files"] += 1
+        summary["query_bytes"] += size
+        summary["hidden_files"] += name.startswith(".")
+
+    return summary
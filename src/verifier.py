@@ -0,0 +1,361 @@
+#! /usr/bin/env python3
+"""
+A module to verify that the duplicates listed in a compareFolders log are still duplicates before they are deleted or
+renamed.
+"""
+import collections
+from concurrent import futures
+import os.path
+import threading
+import time
+
+from bvzcomparefiles import comparefiles
+
+from src import bytecompare
+from src import checksum
+from src.metrics import registry
+from src.profiling import profiler
+
+
+class Verifier(object):
+    """
+    A class to check that a query file still matches its canonical file: same size, the same metadata for every option
+    the original compare was run with, and (unless skipped) the same checksum.
+
+    A query file that is a hard link to its canonical file (the same device and inode) has the same contents by
+    definition, so neither file is checksummed.
+
+    The checksum of each canonical file is computed only once and then reused, since the same canonical file is often
+    the match for many query files. Until a canonical file's checksum is known, a query file is compared to it byte by
+    byte instead, which stops at the first difference (and, if they are identical, gives the canonical file's checksum
+    for any later query files). The verifier may be shared between threads: if two threads need the checksum of the
+    same canonical file at the same time, one reads the file and the other waits for its result.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self,
+                 options,
+                 skip_checksum=False,
+                 checksum_cache=None,
+                 hash_algorithm=checksum.DEFAULT_ALGORITHM,
+                 byte_compare=True):
+        """
+        :param options: A dictionary of which options to do a comparison on.
+        :param skip_checksum: If True, the checksums are not compared.
+        :param checksum_cache: An optional ChecksumCache object to read checksums from (and write them to).
+        :param hash_algorithm: The name of the hash algorithm to use. Defaults to checksum.DEFAULT_ALGORITHM.
+        :param byte_compare: If True, a query file whose canonical file's checksum is not known yet is compared to it
+               byte by byte rather than by checksum. Defaults to True.
+
+        :return: Nothing.
+        """
+
+        self.options = options
+        self.skip_checksum = skip_checksum
+        self.checksum_cache = checksum_cache
+        self.hash_algorithm = hash_algorithm
+        self.byte_compare = byte_compare
+
+        self.canonical_checksum_reused_count = 0
+        self.hardlinked_count = 0
+        self.verified_bytes = 0
+
+        self._canonical_checksums = dict()
+        self._canonical_checksums_in_progress = dict()
+        self._verified_canonicals = dict()
+        self._lock = threading.Lock()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _checksum(self,
+                  file_p) -> str:
+        """
+        Returns the checksum of a file, from the checksum cache if there is one.
+
+        :param file_p: The path to the file.
+
+        :return: The checksum as a string.
+        """
+
+        if self.checksum_cache is not None:
+            return self.checksum_cache.checksum(file_p, algorithm=self.hash_algorithm)
+        return checksum.checksum_for_file(file_p, self.hash_algorithm)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _canonical_checksum(self,
+                            canonical_p) -> str:
+        """
+        Returns the checksum of a canonical file, computing it only the first time it is asked for.
+
+        :param canonical_p: The path to the canonical file.
+
+        :return: The checksum as a string.
+        """
+
+        with self._lock:
+            if canonical_p in self._canonical_checksums:
+                self.canonical_checksum_reused_count += 1
+                return self._canonical_checksums[canonical_p]
+            in_progress = self._canonical_checksums_in_progress.get(canonical_p)
+            if in_progress is None:
+                self._canonical_checksums_in_progress[canonical_p] = threading.Event()
+
+        if in_progress is not None:
+            in_progress.wait()
+            return self._canonical_checksum(canonical_p)
+
+        try:
+            checksum_str = self._checksum(canonical_p)
+            with self._lock:
+                self._canonical_checksums[canonical_p] = checksum_str
+        finally:
+            with self._lock:
+                self._canonical_checksums_in_progress.pop(canonical_p).set()
+
+        return checksum_str
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _use_byte_compare(self,
+                          canonical_p) -> bool:
+        """
+        Decides whether a query file is compared to its canonical file byte by byte: only if the canonical file's
+        checksum is not known yet (here or in the checksum cache), since a known checksum means only the query file
+        has to be read. A checksum found in the cache is kept, so it is not looked up again.
+
+        :param canonical_p: The path to the canonical file.
+
+        :return: True if the files should be compared byte by byte.
+        """
+
+        if not self.byte_compare:
+            return False
+
+        with self._lock:
+            if canonical_p in self._canonical_checksums or canonical_p in self._canonical_checksums_in_progress:
+                return False
+
+        if self.checksum_cache is not None:
+            checksum_str = self.checksum_cache.get(os.stat(canonical_p), self.hash_algorithm)
+            if checksum_str is not None:
+                with self._lock:
+                    self._canonical_checksums.setdefault(canonical_p, checksum_str)
+                return False
+
+        return True
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _compare_bytes(self,
+                       query_p,
+                       canonical_p) -> bool:
+        """
+        Compares a query file to its canonical file byte by byte. If they are identical, the checksum computed along the
+        way is kept as the canonical file's checksum (and stored in the checksum cache for both files).
+
+        :param query_p: The path to the query file.
+        :param canonical_p: The path to the canonical file.
+
+        :return: True if the files are identical. Raises an OSError if either file cannot be read.
+        """
+
+        stat_results = None
+        if self.checksum_cache is not None:
+            stat_results = (os.stat(query_p), os.stat(canonical_p))
+
+        matched_paths, errors, checksum_str = bytecompare.compare_files(query_p, [canonical_p], self.hash_algorithm)
+        if errors:
+            raise OSError(f"Unable to read canonical file: {canonical_p}")
+        if not matched_paths:
+            return False
+
+        with self._lock:
+            self._canonical_checksums.setdefault(canonical_p, checksum_str)
+        if stat_results is not None:
+            for stat_result in stat_results:
+                self.checksum_cache.put(stat_result, checksum_str, self.hash_algorithm)
+        return True
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def verify(self,
+               query_p,
+               canonical_p) -> bool:
+        """
+        Checks that a query file is still a duplicate of its canonical file. Raises a ValueError describing the first
+        check that fails. The size of every query file that gets as far as its metadata checks is added to
+        self.verified_bytes, for progress messages.
+
+        :param query_p: The path to the query file.
+        :param canonical_p: The path to the canonical file.
+
+        :return: True if the query file is a duplicate, False if the query file no longer exists (nothing to do).
+        """
+
+        if not os.path.exists(query_p):
+            return False
+
+        try:
+            canonical_stat = os.stat(canonical_p)
+        except FileNotFoundError:
+            raise(ValueError("Canonical file is missing"))
+
+        # Two paths to the same inode are only separate copies if the inode has more than one link. Otherwise they are
+        # the same directory entry reached by two paths (through a bind mount or a symlinked directory, for example),
+        # and acting on the query file would also remove the canonical file.
+        query_stat = os.stat(query_p)
+        same_inode = query_stat.st_dev == canonical_stat.st_dev and query_stat.st_ino == canonical_stat.st_ino
+        if same_inode and query_stat.st_nlink == 1:
+            raise(ValueError("Query and canonical are the same file"))
+
+        query_metadata = comparefiles.get_metadata(query_p, os.path.sep)
+        canonical_metadata = comparefiles.get_metadata(canonical_p, os.path.sep)
+
+        if query_metadata["size"] != canonical_metadata["size"]:
+            raise(ValueError("Sizes do not match"))
+
+        with self._lock:
+            self.verified_bytes += query_metadata["size"]
+
+        if self.options["match_on_name"] and query_metadata["name"] != canonical_metadata["name"]:
+            raise(ValueError("Names do not match"))
+
+        if self.options["match_on_type"] and query_metadata["file_type"] != canonical_metadata["file_type"]:
+            raise(ValueError("File types do not match"))
+
+        if self.options["match_on_parent"] and query_metadata["parent"] != canonical_metadata["parent"]:
+            raise(ValueError("Parent directory names do not match"))
+
+        if self.options["match_on_relpath"] and query_metadata["rel_path"] != canonical_metadata["rel_path"]:
+            raise(ValueError("Relative paths do not match"))
+
+        if self.options["match_on_ctime"] and query_metadata["ctime"] != canonical_metadata["ctime"]:
+            raise (ValueError("Creation date and times do not match"))
+
+        if self.options["match_on_mtime"] and query_metadata["mtime"] != canonical_metadata["mtime"]:
+            raise(ValueError("Modification date and times do not match"))
+
+        if not self.skip_checksum:
+            if same_inode:
+                with self._lock:
+                    self.hardlinked_count += 1
+            elif self._use_byte_compare(canonical_p):
+                if not self._compare_bytes(query_p, canonical_p):
+                    raise(ValueError("Contents do not match"))
+            elif self._checksum(query_p) != self._canonical_checksum(canonical_p):
+                raise(ValueError("Checksums do not match"))
+
+        # A pair listed more than once in a log is verified once per record, so each verdict is kept until its own
+        # record is confirmed.
+        with self._lock:
+            self._verified_canonicals.setdefault((query_p, canonical_p), collections.deque()).append(
+                (canonical_stat.st_dev, canonical_stat.st_ino, canonical_stat.st_size))
+        return True
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def confirm(self,
+                query_p,
+                canonical_p) -> bool:
+        """
+        Checks, just before a verified query file is deleted, renamed, or linked, that its canonical file is still the
+        file it was verified against (the same device, inode, and size). Records are verified ahead of the actions when
+        there are worker threads, so an earlier action in the same run may have removed the canonical file since: if
+        two files are each listed as the duplicate of the other, both pass verification, but only the first may go.
+        Likewise, if the same pair is listed twice, the query file may already have been acted on by the first record.
+
+        :param query_p: The path to the query file.
+        :param canonical_p: The path to the canonical file.
+
+        :return: True if the query file may be acted on, False if it no longer exists (nothing to do). Raises a
+                 ValueError if the canonical file is gone or is no longer the same file.
+        """
+
+        with self._lock:
+            verdicts = self._verified_canonicals.get((query_p, canonical_p))
+            verified = verdicts.popleft() if verdicts else None
+            if verdicts is not None and not verdicts:
+                del self._verified_canonicals[(query_p, canonical_p)]
+
+        if not os.path.exists(query_p):
+            return False
+
+        try:
+            canonical_stat = os.stat(canonical_p)
+        except FileNotFoundError:
+            raise(ValueError("Canonical file is missing"))
+
+        # Two paths to the same inode are only separate copies if the inode has more than one link. Otherwise they are
+        # the same directory entry reached by two paths (through a bind mount or a symlinked directory, for example),
+        # and acting on the query file would also remove the canonical file.
+        query_stat = os.stat(query_p)
+        same_inode = query_stat.st_dev == canonical_stat.st_dev and query_stat.st_ino == canonical_stat.st_ino
+        if same_inode and query_stat.st_nlink == 1:
+            raise(ValueError("Query and canonical are the same file"))
+
+        if verified != (canonical_stat.st_dev, canonical_stat.st_ino, canonical_stat.st_size):
+            raise(ValueError("Canonical file has changed since it was verified"))
+
+        return True
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def verify_record(self,
+                      record) -> tuple:
+        """
+        Verifies a single duplicate record from a compareFolders log, catching any errors.
+
+        :param record: A tuple of "D", the query file, and one or more canonical files. Only the first canonical file is
+               checked.
+
+        :return: A tuple of (record, whether the query file is a verified duplicate, an error string or None).
+        """
+
+        try:
+            query_p = record[1]
+            canonical_p = record[2]
+        except IndexError:
+            return record, False, "Index Error"
+
+        start = time.perf_counter()
+        try:
+            return record, self.verify(query_p, canonical_p), None
+        except (ValueError, OSError) as e:
+            return record, False, str(e)
+        finally:
+            registry.update({"verify_records": 1, "verify_seconds": time.perf_counter() - start})
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def verify_records(self,
+                       records,
+                       jobs=1):
+        """
+        Verifies duplicate records, on a pool of worker threads if jobs is greater than 1. Only a limited number of
+        records are in flight at any one time, and results are returned strictly in the order of the records, so the
+        caller can apply the deletes or renames (and collect errors) in log order on its own thread.
+
+        :param records: An iterable of duplicate records. It is consumed lazily.
+        :param jobs: The number of worker threads. Defaults to 1 (no worker threads).
+
+        :return: A generator that yields the result of verify_record for each record, in order.
+        """
+
+        if jobs <= 1:
+            for record in records:
+                yield self.verify_record(record)
+            return
+
+        max_in_flight = jobs * 4
+        records = iter(records)
+        verify_record = profiler.wrap(self.verify_record)
+        in_flight = collections.deque()
+
+        executor = futures.ThreadPoolExecutor(max_workers=jobs)
+        try:
+            while True:
+                while len(in_flight) < max_in_flight:
+                    record = next(records, None)
+                    if record is None:
+                        break
+                    in_flight.append(executor.submit(verify_record, record))
+
+                if not in_flight:
+                    break
+
+                yield in_flight.popleft().result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,175 @@
+#! /usr/bin/env python3
+"""
+Regression tests for acting on duplicates: records verified ahead of the actions (deleteFiles -j, and
+api.apply_deletions with jobs greater than 1), pairs listed more than once, and query and canonical paths that
+share an inode.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from src import api
+from src.verifier import Verifier
+
+
+class MutualDuplicatesTest(unittest.TestCase):
+    """
+    Two identical files that are each listed as the duplicate of the other (as when the query and canonical trees
+    overlap) must never both be removed, however far ahead of the actions the records are verified.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def setUp(self):
+        self.dir_d = tempfile.mkdtemp()
+        self.x_p = os.path.join(self.dir_d, "x.dat")
+        self.y_p = os.path.join(self.dir_d, "y.dat")
+        for file_p in (self.x_p, self.y_p):
+            with open(file_p, "wb") as f:
+                f.write(b"identical contents\n" * 1000)
+
+        self.records = [api.Duplicate(self.x_p, [self.y_p]), api.Duplicate(self.y_p, [self.x_p])]
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def tearDown(self):
+        shutil.rmtree(self.dir_d)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _apply(self,
+               action="delete",
+               jobs=4,
+               trial=False) -> list:
+        return list(api.apply_deletions(self.records, action=action, jobs=jobs, trial=trial))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _assert_one_acted_on(self,
+                             outcomes,
+                             outcome):
+        self.assertEqual([result.outcome for result in outcomes], [outcome, "error"])
+        self.assertEqual(outcomes[1].query_p, self.y_p)
+        self.assertTrue(os.path.isfile(self.y_p))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_delete_keeps_one_copy(self):
+        self._assert_one_acted_on(self._apply(), "deleted")
+        self.assertFalse(os.path.exists(self.x_p))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_delete_without_workers_keeps_one_copy(self):
+        self._assert_one_acted_on(self._apply(jobs=1), "deleted")
+        self.assertFalse(os.path.exists(self.x_p))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_rename_keeps_one_copy(self):
+        self._assert_one_acted_on(self._apply(action="rename"), "renamed")
+        self.assertFalse(os.path.exists(self.x_p))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_hardlink_keeps_one_copy(self):
+        self._assert_one_acted_on(self._apply(action="hardlink"), "linked")
+        self.assertTrue(os.path.samefile(self.x_p, self.y_p))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_trial_reports_what_a_real_run_would_do(self):
+        self._assert_one_acted_on(self._apply(trial=True), "deleted")
+        self.assertTrue(os.path.isfile(self.x_p))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_confirm_rejects_a_stale_verdict(self):
+        verifier = Verifier(options=api.verifier_options(""))
+        self.assertTrue(verifier.verify(self.x_p, self.y_p))
+        self.assertTrue(verifier.verify(self.y_p, self.x_p))
+
+        verifier.confirm(self.x_p, self.y_p)
+        os.remove(self.x_p)
+        with self.assertRaises(ValueError):
+            verifier.confirm(self.y_p, self.x_p)
+
+
+class RepeatedPairTest(unittest.TestCase):
+    """
+    A duplicate pair listed more than once in a log is acted on once, and its later records report that the query file
+    is already gone, however far ahead of the actions the records are verified.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def setUp(self):
+        self.dir_d = tempfile.mkdtemp()
+        self.query_p = os.path.join(self.dir_d, "x.dat")
+        self.canonical_p = os.path.join(self.dir_d, "y.dat")
+        for file_p in (self.query_p, self.canonical_p):
+            with open(file_p, "wb") as f:
+                f.write(b"identical contents\n" * 1000)
+
+        self.records = [api.Duplicate(self.query_p, [self.canonical_p])] * 2
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def tearDown(self):
+        shutil.rmtree(self.dir_d)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_second_record_is_missing(self):
+        for jobs in (1, 4):
+            for trial in (True, False):
+                with open(self.query_p, "wb") as f:
+                    f.write(b"identical contents\n" * 1000)
+                outcomes = list(api.apply_deletions(self.records, jobs=jobs, trial=trial))
+                self.assertEqual([result.outcome for result in outcomes], ["deleted", "missing"])
+                self.assertEqual(os.path.exists(self.query_p), trial)
+                self.assertTrue(os.path.isfile(self.canonical_p))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_each_verdict_is_confirmed_once(self):
+        verifier = Verifier(options=api.verifier_options(""))
+        self.assertTrue(verifier.verify(self.query_p, self.canonical_p))
+        self.assertTrue(verifier.verify(self.query_p, self.canonical_p))
+
+        self.assertTrue(verifier.confirm(self.query_p, self.canonical_p))
+        self.assertTrue(verifier.confirm(self.query_p, self.canonical_p))
+        with self.assertRaises(ValueError):
+            verifier.confirm(self.query_p, self.canonical_p)
+
+
+class SameFileTest(unittest.TestCase):
+    """
+    A query file and a canonical file that share an inode are only duplicates if they are separate links to it. A
+    single directory entry reached by two paths must never be acted on.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def setUp(self):
+        self.dir_d = tempfile.mkdtemp()
+        self.real_d = os.path.join(self.dir_d, "real")
+        os.mkdir(self.real_d)
+        self.query_p = os.path.join(self.real_d, "x.dat")
+        with open(self.query_p, "wb") as f:
+            f.write(b"only copy\n" * 1000)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def tearDown(self):
+        shutil.rmtree(self.dir_d)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_same_entry_through_another_path_is_refused(self):
+        alias_d = os.path.join(self.dir_d, "alias")
+        os.symlink(self.real_d, alias_d)
+        canonical_p = os.path.join(alias_d, "x.dat")
+
+        outcomes = list(api.apply_deletions([api.Duplicate(self.query_p, [canonical_p])]))
+        self.assertEqual([result.outcome for result in outcomes], ["error"])
+        self.assertEqual(outcomes[0].error, "Query and canonical are the same file")
+        self.assertTrue(os.path.isfile(self.query_p))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_hard_link_is_a_duplicate(self):
+        canonical_p = os.path.join(self.dir_d, "y.dat")
+        os.link(self.query_p, canonical_p)
+
+        outcomes = list(api.apply_deletions([api.Duplicate(self.query_p, [canonical_p])]))
+        self.assertEqual([result.outcome for result in outcomes], ["deleted"])
+        self.assertFalse(os.path.exists(self.query_p))
+        self.assertTrue(os.path.isfile(canonical_p))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+#! /usr/bin/env python3
+"""
+Tests for sorting scan records beyond the memory ceiling, and for pairing the sorted query and canonical records by
+size.
+"""
+import random
+import unittest
+
+from src import extsort
+from src.filetable import FileStat
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _record(size,
+            name) -> tuple:
+    return extsort.scan_record("/dir", name, FileStat(1, 0, size, 0, 0))
+
+
+class ExternalSorterTest(unittest.TestCase):
+    """
+    Records come back sorted by size whether or not they were spilled to run files.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_sorted_in_memory_and_spilled(self):
+        rng = random.Random(0)
+        records = [_record(rng.randrange(100), f"file{i}.dat") for i in range(5000)]
+        for max_memory in (extsort.DEFAULT_MAX_MEMORY, 10 * 1024):
+            sorter = extsort.ExternalSorter(max_memory=max_memory)
+            try:
+                for record in records:
+                    sorter.add(record)
+                self.assertEqual(len(sorter), len(records))
+                self.assertEqual(list(sorter.sorted()), sorted(records))
+                self.assertEqual(sorter.runs_written > 0, max_memory != extsort.DEFAULT_MAX_MEMORY)
+            finally:
+                sorter.close()
+
+
+class MergeJoinTest(unittest.TestCase):
+    """
+    Each size of query file is paired with exactly the canonical files of that size.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _join(self,
+              query_sizes,
+              canonical_sizes) -> list:
+        query_records = sorted(_record(size, f"q{i}") for i, size in enumerate(query_sizes))
+        canonical_records = sorted(_record(size, f"c{i}") for i, size in enumerate(canonical_sizes))
+        return [(size, [record[2] for record in query_group], [record[2] for record in canonical_group])
+                for size, query_group, canonical_group in extsort.merge_join(query_records, canonical_records)]
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_pairs_sizes(self):
+        self.assertEqual(self._join([1, 1, 3, 5], [0, 1, 2, 3, 3, 6]),
+                         [(1, ["q0", "q1"], ["c1"]),
+                          (3, ["q2"], ["c3", "c4"]),
+                          (5, ["q3"], [])])
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_no_canonical_records(self):
+        self.assertEqual(self._join([2, 4], []), [(2, ["q0"], []), (4, ["q1"], [])])
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_no_query_records(self):
+        self.assertEqual(self._join([], [1, 2]), [])
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_canonical_sizes_beyond_every_query_size(self):
+        self.assertEqual(self._join([1], [1, 7, 8, 9]), [(1, ["q0"], ["c0"])])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,174 @@
+#! /usr/bin/env python3
+"""
+Tests for reusing the results of a previous compare (compareFolders --since).
+"""
+import copy
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from src import resultlog
+from src.canonicalindex import RACY_WINDOW_NS
+from src.filetable import FileStat
+from src.incremental import PreviousResults
+
+SCAN_SETTINGS = {"skip_sub_dir": False,
+                 "skip_hidden_files": True,
+                 "skip_hidden_dirs": False,
+                 "skip_zero_len": True,
+                 "incl_dir_regexes": None,
+                 "excl_dir_regexes": None,
+                 "incl_file_regexes": None,
+                 "excl_file_regexes": None}
+
+
+class CheckSettingsTest(unittest.TestCase):
+    """
+    A previous compare is only reused if it scanned the same files, with the same settings, as the new one.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def setUp(self):
+        self.dir_d = tempfile.mkdtemp()
+        self.query_d = os.path.join(self.dir_d, "query")
+        self.canonical_d = os.path.join(self.dir_d, "canonical")
+        os.mkdir(self.query_d)
+        os.mkdir(self.canonical_d)
+
+        self.scan_settings = {"query": dict(SCAN_SETTINGS), "canonical": dict(SCAN_SETTINGS)}
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def tearDown(self):
+        shutil.rmtree(self.dir_d)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _previous_results(self,
+                          log_format,
+                          scan_settings) -> PreviousResults:
+        log_p = os.path.join(self.dir_d, f"previous.{log_format}")
+        result_log = resultlog.WRITER_CLASSES[log_format](log_p=log_p,
+                                                          options="",
+                                                          query_dirs=[self.query_d],
+                                                          canonical_dir=self.canonical_d,
+                                                          started_ns=time.time_ns(),
+                                                          scan_settings=scan_settings)
+        result_log.close()
+        return PreviousResults(log_p)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _check(self,
+               previous_results,
+               scan_settings):
+        previous_results.check_settings(options="",
+                                        hash_algorithm=resultlog.DEFAULT_HASH,
+                                        query_items=[self.query_d],
+                                        canonical_roots=[self.canonical_d],
+                                        skip_checksum=False,
+                                        scan_settings=scan_settings)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_same_settings_are_accepted(self):
+        for log_format in resultlog.WRITER_CLASSES:
+            self._check(self._previous_results(log_format, self.scan_settings), copy.deepcopy(self.scan_settings))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_different_canonical_filters_are_refused(self):
+        changed = copy.deepcopy(self.scan_settings)
+        changed["canonical"]["skip_hidden_dirs"] = True
+        for log_format in resultlog.WRITER_CLASSES:
+            with self.assertRaises(ValueError):
+                self._check(self._previous_results(log_format, self.scan_settings), changed)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_different_query_regexes_are_refused(self):
+        changed = copy.deepcopy(self.scan_settings)
+        changed["query"]["excl_file_regexes"] = [r"\.tmp$"]
+        for log_format in resultlog.WRITER_CLASSES:
+            with self.assertRaises(ValueError):
+                self._check(self._previous_results(log_format, self.scan_settings), changed)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_log_without_scan_settings_is_refused(self):
+        for log_format in resultlog.WRITER_CLASSES:
+            with self.assertRaises(ValueError):
+                self._check(self._previous_results(log_format, None), self.scan_settings)
+
+
+class SplitCandidatesTest(unittest.TestCase):
+    """
+    A previous result is only reused for the files that have not changed since the previous compare started.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def setUp(self):
+        self.dir_d = tempfile.mkdtemp()
+        self.started_ns = time.time_ns()
+
+        log_p = os.path.join(self.dir_d, "previous.log")
+        result_log = resultlog.ResultLogWriter(log_p=log_p,
+                                               options="",
+                                               query_dirs=[self.dir_d],
+                                               canonical_dir=self.dir_d,
+                                               started_ns=self.started_ns)
+        for result in ({"status": "D", "query_p": "/q/dup.dat", "matches": ["/c/a.dat"], "possible_match_errors": []},
+                       {"status": "U", "query_p": "/q/unique.dat", "matches": [], "possible_match_errors": []},
+                       {"status": "U", "query_p": "/q/pme.dat", "matches": [], "possible_match_errors": ["/c/x.dat"]},
+                       {"status": "SE", "query_p": "/q/se.dat", "matches": [], "possible_match_errors": []}):
+            result_log.write_result(result)
+        result_log.close()
+
+        self.previous_results = PreviousResults(log_p)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def tearDown(self):
+        shutil.rmtree(self.dir_d)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _stat(self,
+              changed=False) -> FileStat:
+        time_ns = self.started_ns if changed else self.started_ns - RACY_WINDOW_NS - 1
+        return FileStat(1, 1, 10, time_ns, time_ns)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _candidate(self,
+                   canonical_p,
+                   changed=False) -> tuple:
+        return canonical_p, {"stat": self._stat(changed)}
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_unchanged_files_reuse_the_previous_result(self):
+        candidates = [self._candidate("/c/a.dat"), self._candidate("/c/b.dat")]
+        self.assertEqual(self.previous_results.split_candidates("/q/dup.dat", self._stat(), candidates),
+                         ({"/c/a.dat"}, []))
+        self.assertEqual(self.previous_results.split_candidates("/q/unique.dat", self._stat(), candidates),
+                         (set(), []))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_changed_candidates_are_compared_again(self):
+        changed_a = self._candidate("/c/a.dat", changed=True)
+        changed_b = self._candidate("/c/b.dat", changed=True)
+        self.assertEqual(self.previous_results.split_candidates("/q/dup.dat", self._stat(), [changed_a, changed_b]),
+                         (set(), [changed_a, changed_b]))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_changed_query_file_is_not_reused(self):
+        candidates = [self._candidate("/c/a.dat")]
+        self.assertIsNone(self.previous_results.split_candidates("/q/dup.dat", self._stat(changed=True), candidates))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_query_file_without_a_usable_result_is_not_reused(self):
+        candidates = [self._candidate("/c/a.dat")]
+        for query_p in ("/q/new.dat", "/q/pme.dat", "/q/se.dat"):
+            self.assertIsNone(self.previous_results.split_candidates(query_p, self._stat(), candidates))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_change_time_counts_as_a_change(self):
+        stat_result = self._stat()
+        stat_result.st_ctime_ns = self.started_ns
+        self.assertTrue(self.previous_results.changed(stat_result))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+#! /usr/bin/env python3
+"""
+Tests for writing and reading the result log of a compare, in both formats, and in the text format written by older
+versions of compareFolders.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+
+from src import resultlog
+
+RESULTS = [{"status": "D", "query_p": "/q/a.dat", "matches": ["/c/a.dat", "/c/b.dat"], "possible_match_errors": []},
+           {"status": "U", "query_p": "/q/b.dat", "matches": [], "possible_match_errors": ["/c/locked.dat"]},
+           {"status": "SE", "query_p": "/q/c.dat", "matches": [], "possible_match_errors": []},
+           {"status": "D", "query_p": "/q/d\udcff.dat", "matches": ["/c/d.dat"], "possible_match_errors": []}]
+
+RECORDS = [("D", "/q/a.dat", "/c/a.dat", "/c/b.dat"),
+           ("U", "/q/b.dat"),
+           ("PME", "/c/locked.dat"),
+           ("SE", "/q/c.dat"),
+           ("D", "/q/d\udcff.dat", "/c/d.dat")]
+
+
+class ResultLogTest(unittest.TestCase):
+    """
+    Whatever is written to a log, in either format, is read back unchanged.
+    """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def setUp(self):
+        self.dir_d = tempfile.mkdtemp()
+        self.query_d = os.path.join(self.dir_d, "query")
+        self.canonical_d = os.path.join(self.dir_d, "canonical")
+        os.mkdir(self.query_d)
+        os.mkdir(self.canonical_d)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def tearDown(self):
+        shutil.rmtree(self.dir_d)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _write_log(self,
+                   log_format,
+                   complete=True,
+                   **kwargs) -> str:
+        log_p = os.path.join(self.dir_d, f"results.{log_format}")
+        result_log = resultlog.WRITER_CLASSES[log_format](log_p=log_p,
+                                                          options="nc",
+                                                          query_dirs=[self.query_d],
+                                                          canonical_dir=self.canonical_d,
+                                                          hash_algorithm="sha256",
+                                                          started_ns=1234,
+                                                          skip_checksum=True,
+                                                          **kwargs)
+        for result in RESULTS:
+            result_log.write_result(result)
+        result_log.close(complete=complete)
+        return log_p
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_records_round_trip(self):
+        for log_format in resultlog.LOG_FORMATS:
+            log_p = self._write_log(log_format)
+            self.assertEqual(resultlog.get_log_format(log_p), log_format)
+            self.assertEqual(list(resultlog.iter_records(log_p)), RECORDS)
+            self.assertEqual(list(resultlog.iter_records(log_p, {"D"})), [RECORDS[0], RECORDS[4]])
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_header_round_trip(self):
+        for log_format in resultlog.LOG_FORMATS:
+            header = resultlog.read_header(self._write_log(log_format))
+            self.assertEqual(header["options"], "nc")
+            self.assertEqual(header["hash"], "sha256")
+            self.assertEqual(header["query_dirs"], [self.query_d])
+            self.assertEqual(header["canonical_dir"], self.canonical_d)
+            self.assertEqual(header["canonical_roots"], [self.canonical_d])
+            self.assertEqual(header["skip_checksum"], True)
+            self.assertEqual(header["started_ns"], 1234)
+            self.assertNotIn("num_matches", header)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_trailer(self):
+        for log_format in resultlog.LOG_FORMATS:
+            for complete in (True, False):
+                trailer = resultlog.read_trailer(self._write_log(log_format, complete=complete))
+                self.assertEqual(trailer["num_matches"], 2)
+                self.assertEqual(trailer["num_unique"], 1)
+                self.assertEqual(trailer["num_source_errors"], 1)
+                self.assertEqual(trailer["num_possible_match_errors"], 1)
+                self.assertEqual(trailer["complete"], complete)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_block_index(self):
+        log_p = self._write_log("binary", fsync_record_frequency=2)
+        blocks = resultlog.read_trailer(log_p)["blocks"]
+        self.assertEqual([count for offset, count in blocks], [2, 2, 1])
+
+        with open(log_p, "rb") as log_f:
+            for offset, count in blocks:
+                log_f.seek(offset)
+                self.assertTrue(zlib.decompress(resultlog._read_frame(log_f)))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_cut_short_binary_log_keeps_complete_blocks(self):
+        log_p = self._write_log("binary", fsync_record_frequency=2)
+        last_offset = resultlog.read_trailer(log_p)["blocks"][-1][0]
+        with open(log_p, "r+b") as log_f:
+            log_f.truncate(last_offset + 10)
+
+        self.assertIsNone(resultlog.read_trailer(log_p))
+        self.assertEqual(list(resultlog.iter_records(log_p)), RECORDS[:4])
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def test_old_text_log(self):
+        log_p = os.path.join(self.dir_d, "old.log")
+        with open(log_p, "w") as log_f:
+            log_f.write("options=nc\n")
+            log_f.write(f"querydir0={self.query_d}\n")
+            log_f.write(f"canonicaldir={self.canonical_d}\n")
+            log_f.write("num_matches=1\n")
+            log_f.write("num_unique=1\n")
+            log_f.write(f"{resultlog.DELIMITER.join(RECORDS[0])}\n")
+            log_f.write(f"{resultlog.DELIMITER.join(RECORDS[1])}\n")
+
+        header = resultlog.read_header(log_p)
+        self.assertEqual(header["options"], "nc")
+        self.assertEqual(header["hash"], resultlog.DEFAULT_HASH)
+        self.assertEqual(header["query_dirs"], [self.query_d])
+        self.assertEqual(header["canonical_dir"], self.canonical_d)
+        self.assertEqual(header["num_matches"], 1)
+        self.assertEqual(header["num_unique"], 1)
+        self.assertNotIn("started_ns", header)
+
+        self.assertIsNone(resultlog.read_trailer(log_p))
+        self.assertEqual(list(resultlog.iter_records(log_p)), RECORDS[:2])
+
+
+if __name__ == "__main__":
+    unittest.main()